@@ -5,6 +5,7 @@ from .image_uncertainty import *
 from .image_arithm import *
 from .image_convert import *
 from .gamma_index import *
+from .gamma_benchmark import *
 from .roi_utils import *
 from .bounding_box import *
 from .image_crop import *
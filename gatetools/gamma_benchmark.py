@@ -0,0 +1,248 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+#Benchmark of the gamma index implementations with reproducible synthetic dose distributions.
+
+import numpy as np
+import itk
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+from .gamma_index import GammaEvaluator
+import logging
+logger=logging.getLogger(__name__)
+
+# The implementations that are timed: GammaEvaluator options, and whether the pass rate is computed
+# (GammaEvaluator.pass_rate) instead of the gamma image (GammaEvaluator.evaluate).
+# The "equal_geometry" engine is only used for dose pairs with equal geometry.
+gamma_benchmark_engines = {
+    "equal_geometry": dict(method="equal_geometry"),
+    "unequal_geometry": dict(method="unequal_geometry"),
+    "spatial_index": dict(method="spatial_index"),
+    "pruned": dict(prune_levels=(8,4,2)),
+    "parallel": dict(n_workers=4),
+    "pass_rate": dict(pass_rate=True),
+}
+
+gamma_benchmark_kinds = ("gauss","gradient","mc")
+gamma_benchmark_sizes = (32,64,128,256)
+
+def _benchmark_dose(kind,x,y,z,extent):
+    """
+    Convenience function for `gamma_benchmark_pair`: the smooth dose of the given `kind` at the positions x, y and z
+    (arrays that broadcast to the grid), for a cubic volume with side `extent` centered at the origin. The maximum dose is about 1.
+    """
+    if kind == "gradient":
+        # depth dose like decrease along z, with a penumbra at the lateral field edges
+        w, p = 0.3*extent, 0.02*extent
+        lateral = 0.25*(1.-np.tanh((np.abs(x)-w)/p))*(1.-np.tanh((np.abs(y)-w)/p))
+        return lateral*np.exp(-(z+0.5*extent)/extent)
+    # Gaussian blob (also the smooth part of the "mc" dose)
+    s2 = 2.*(extent/6.)**2
+    return np.exp(-(x*x)/s2)*np.exp(-(y*y)/s2)*np.exp(-(z*z)/s2)
+
+def gamma_benchmark_pair(kind,size,geometry="equal",spacing=2.,seed=42):
+    """
+    Reproducible synthetic (reference,target) dose image pair for benchmarks of the gamma index, with `size`**3 reference voxels
+    of `spacing` mm, centered at the origin. The maximum dose is about 1. The `kind` of dose distribution is one of:
+    * "gauss": a Gaussian blob; the target is shifted by 1 mm in x and y and scaled by 1.02.
+    * "gradient": a field with sharp lateral penumbras and a dose gradient in depth; the target is shifted by 1.5 mm in x and z.
+    * "mc": a Gaussian blob; the target has Monte Carlo like noise, with a relative standard deviation
+      of 2% at the maximum that increases as 1/sqrt(dose) for lower doses.
+    With `geometry` "unequal", the target voxels are 1.25 times larger and shifted by a third of a reference voxel,
+    covering the same volume. The target dose is computed at the target voxel centers.
+    The images have pixel type float. The same arguments always give the same images.
+    """
+    if kind not in gamma_benchmark_kinds:
+        raise ValueError("unknown benchmark dose kind '{}', should be one of {}".format(kind,", ".join(gamma_benchmark_kinds)))
+    if geometry not in ("equal","unequal"):
+        raise ValueError("geometry should be 'equal' or 'unequal', got '{}'".format(geometry))
+    extent = size*spacing
+    rng = np.random.RandomState(seed)
+    shift = {"gauss":(1.,1.,0.),"gradient":(1.5,0.,1.5),"mc":(0.,0.,0.)}[kind]
+    images = []
+    for target in (False,True):
+        if target and geometry == "unequal":
+            s = 1.25*spacing
+            n = int(round(extent/s))
+            origin = -0.5*(n-1)*s+spacing/3.
+        else:
+            s, n = spacing, size
+            origin = -0.5*(n-1)*s
+        pos = origin+s*np.arange(n,dtype=np.float32)
+        d = shift if target else (0.,0.,0.)
+        # (z,y,x) array for ITK
+        a = _benchmark_dose(kind,pos[np.newaxis,np.newaxis,:]-d[0],pos[np.newaxis,:,np.newaxis]-d[1],pos[:,np.newaxis,np.newaxis]-d[2],extent)
+        a = a.astype(np.float32)
+        if target and kind == "gauss":
+            a *= 1.02
+        if target and kind == "mc":
+            a += (0.02*np.sqrt(a)*rng.standard_normal(a.shape)).astype(np.float32)
+            np.maximum(a,0.,out=a)
+        img = itk.image_from_array(a)
+        img.SetOrigin([float(origin)]*3)
+        img.SetSpacing([float(s)]*3)
+        images.append(img)
+    return tuple(images)
+
+def _benchmark_run(evaluator,target,pass_rate):
+    """
+    Convenience function for `run_gamma_benchmark`: compute the gamma index once, returns the pass rate summary.
+    """
+    if pass_rate:
+        s = evaluator.pass_rate(target)
+        return s["ncomputed"], s["pass_rate"], s["gamma_mean"]
+    g = itk.array_view_from_image(evaluator.evaluate(target))
+    computed = g[g>=0.]
+    n = len(computed)
+    return n, (np.sum(computed<=1.)/n if n>0 else np.nan), (np.mean(computed,dtype=float) if n>0 else np.nan)
+
+def run_gamma_benchmark(sizes=gamma_benchmark_sizes,kinds=gamma_benchmark_kinds,geometries=("equal","unequal"),engines=None,
+                    dd=3.,dta=3.,threshold=0.05,max_gamma=None,repeat=1,time_limit=None,memory=False,seed=42):
+    """
+    Time the gamma index implementations (see `gamma_benchmark_engines`; `engines` is a list of names, default all)
+    for the synthetic dose pairs of `gamma_benchmark_pair`, for all combinations of `sizes`, `kinds` and `geometries`.
+    The default `sizes` (`gamma_benchmark_sizes`) are also the default of `gt_gamma_benchmark`, so that the outputs can be compared.
+    The gamma index is computed with `GammaEvaluator` with the given dd (percent), dta, threshold (absolute dose, the
+    maximum dose is about 1) and max_gamma. The evaluator is created for each run, so the time includes the
+    preparation of the reference. Each run is repeated `repeat` times, and the fastest time is reported.
+    If `time_limit` (seconds) is given, then an engine is not run for larger sizes (of the same kind and geometry) once it took longer than that.
+    With `memory`, an extra run is done with `tracemalloc` to record the peak memory (of numpy arrays, not of ITK images).
+    Returns a dictionary (that can be written with `json.dump`) with the machine and software information, the parameters,
+    and a list of results with, for each run: kind, size, geometry, engine, the number of voxels, the fastest time
+    ("seconds", None if skipped), all times, the number of computed voxels, the pass rate and the mean gamma value.
+    """
+    engines = list(gamma_benchmark_engines) if engines is None else list(engines)
+    for engine in engines:
+        if engine not in gamma_benchmark_engines:
+            raise ValueError("unknown benchmark engine '{}', should be one of {}".format(engine,", ".join(gamma_benchmark_engines)))
+    results = []
+    for kind in kinds:
+        for geometry in geometries:
+            slow = set()
+            for size in sorted(sizes):
+                ref, target = gamma_benchmark_pair(kind,size,geometry,seed=seed)
+                nref, ntarget = int(np.prod(ref.GetLargestPossibleRegion().GetSize())), int(np.prod(target.GetLargestPossibleRegion().GetSize()))
+                for engine in engines:
+                    if engine == "equal_geometry" and geometry != "equal":
+                        continue
+                    record = dict(kind=kind,size=size,geometry=geometry,engine=engine,n_ref=nref,n_target=ntarget)
+                    if engine in slow:
+                        logger.info("{} {} {}^3: skipping {} (took longer than {} s for a smaller size)".format(kind,geometry,size,engine,time_limit))
+                        record.update(seconds=None,skipped=True)
+                        results.append(record)
+                        continue
+                    options = dict(gamma_benchmark_engines[engine])
+                    pass_rate = options.pop("pass_rate",False)
+                    times = []
+                    for i in range(repeat):
+                        t0 = time.perf_counter()
+                        evaluator = GammaEvaluator(ref,dd=dd,dta=dta,threshold=threshold,max_gamma=max_gamma,**options)
+                        ncomputed, prate, gmean = _benchmark_run(evaluator,target,pass_rate)
+                        times.append(time.perf_counter()-t0)
+                        del evaluator
+                    record.update(seconds=min(times),times=times,ncomputed=int(ncomputed),pass_rate=float(prate),gamma_mean=float(gmean))
+                    if memory:
+                        tracemalloc.start()
+                        _benchmark_run(GammaEvaluator(ref,dd=dd,dta=dta,threshold=threshold,max_gamma=max_gamma,**options),target,pass_rate)
+                        record.update(peak_memory_mb=tracemalloc.get_traced_memory()[1]/2.**20)
+                        tracemalloc.stop()
+                    logger.info("{} {} {}^3 {}: {:.3f} s, pass rate {:.4f}".format(kind,geometry,size,engine,record["seconds"],record["pass_rate"]))
+                    if time_limit is not None and record["seconds"] > time_limit:
+                        slow.add(engine)
+                    results.append(record)
+    try:
+        from importlib.metadata import version as _distribution_version
+        version = _distribution_version("gatetools")
+    except Exception:
+        import gatetools
+        version = getattr(gatetools, "__version__", None)
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "gatetools": version,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "itk": itk.Version.GetITKVersion(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "parameters": dict(dd=dd,dta=dta,threshold=threshold,max_gamma=max_gamma,repeat=repeat,seed=seed,
+                           engines={e:gamma_benchmark_engines[e] for e in engines}),
+        "results": results,
+    }
+
+def gamma_benchmark_compare(baseline,current,tolerance=0.2,pass_rate_tolerance=1e-3,min_seconds=0.1):
+    """
+    Compare two benchmarks (as returned by `run_gamma_benchmark`, or read with `json.load`).
+    For every run (same kind, size, geometry and engine) that was timed in both benchmarks, returns a dictionary with the
+    kind, size, geometry and engine, the "baseline" and "current" times, the "speedup" (baseline time/current time),
+    "regression" (True if the current run is more than a fraction `tolerance` slower; runs that take less than `min_seconds`
+    are too noisy and are never a regression), the pass rate difference "pass_rate_change" and "changed" (True if the
+    pass rates differ by more than `pass_rate_tolerance`).
+    """
+    def key(r):
+        return (r["kind"],r["size"],r["geometry"],r["engine"])
+    old = {key(r):r for r in baseline["results"] if r.get("seconds") is not None}
+    comparison = []
+    for r in current["results"]:
+        if r.get("seconds") is None or key(r) not in old:
+            continue
+        b = old[key(r)]
+        change = r["pass_rate"]-b["pass_rate"]
+        comparison.append(dict(kind=r["kind"],size=r["size"],geometry=r["geometry"],engine=r["engine"],
+                               baseline=b["seconds"],current=r["seconds"],speedup=b["seconds"]/r["seconds"],
+                               regression=r["seconds"]>max((1.+tolerance)*b["seconds"],min_seconds),
+                               pass_rate_change=change,changed=bool(abs(change)>pass_rate_tolerance)))
+    return comparison
+
+#####################################################################################
+import unittest
+import json
+from .logging_conf import LoggedTestCase
+
+class Test_GammaBenchmark(LoggedTestCase):
+    def test_pair(self):
+        logger.debug('Test_GammaBenchmark test_pair')
+        for kind in gamma_benchmark_kinds:
+            ref1, target1 = gamma_benchmark_pair(kind,12,"unequal")
+            ref2, target2 = gamma_benchmark_pair(kind,12,"unequal")
+            self.assertTrue(np.array_equal(itk.array_view_from_image(target1),itk.array_view_from_image(target2)))
+            self.assertEqual(itk.array_view_from_image(ref1).shape,(12,12,12))
+            self.assertEqual(itk.array_view_from_image(target1).shape,(10,10,10))
+            self.assertAlmostEqual(np.max(itk.array_view_from_image(ref1)),1.,delta=0.2)
+        with self.assertRaises(ValueError):
+            gamma_benchmark_pair("flat",12)
+    def test_benchmark(self):
+        logger.debug('Test_GammaBenchmark test_benchmark')
+        bench = json.loads(json.dumps(run_gamma_benchmark(sizes=(8,12),kinds=("gauss",),max_gamma=2.,memory=True)))
+        results = bench["results"]
+        # all engines for equal geometry, all except equal_geometry for unequal geometry
+        self.assertEqual(len(results),2*(2*len(gamma_benchmark_engines)-1))
+        for r in results:
+            self.assertGreater(r["seconds"],0.)
+            self.assertGreater(r["ncomputed"],0)
+            self.assertIn("peak_memory_mb",r)
+        # the engines agree on the pass rate (the pruned gamma values are bounds, but the pass/fail decision is exact)
+        for geometry in ("equal","unequal"):
+            rates = [r["pass_rate"] for r in results if r["size"] == 12 and r["geometry"] == geometry]
+            self.assertAlmostEqual(min(rates),max(rates))
+        comparison = gamma_benchmark_compare(bench,bench)
+        self.assertEqual(len(comparison),len(results))
+        self.assertFalse(any(c["regression"] or c["changed"] for c in comparison))
+        slower = json.loads(json.dumps(bench))
+        slower["results"][0]["seconds"] *= 2.
+        comparison = gamma_benchmark_compare(bench,slower,min_seconds=0.)
+        self.assertTrue(comparison[0]["regression"])
+        self.assertEqual(sum(c["regression"] for c in comparison),1)
+    def test_time_limit(self):
+        logger.debug('Test_GammaBenchmark test_time_limit')
+        bench = run_gamma_benchmark(sizes=(8,12),kinds=("mc",),geometries=("equal",),engines=["equal_geometry"],time_limit=0.)
+        self.assertEqual([r["seconds"] is None for r in bench["results"]],[False,True])
+
+# vim: set et ts=4 ai sw=4:
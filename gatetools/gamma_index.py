@@ -7,12 +7,35 @@
 
 #Compare two 3D images using the gamma index formalism as introduced by Daniel Low (1998).
 
+import sys
 import numpy as np
 import itk
 import logging
+import multiprocessing
+import concurrent.futures
+import collections
 from tqdm import tqdm
 logger=logging.getLogger(__name__)
 
+def _native_zeros(shape,dtype,ndim=3):
+    """
+    Convenience function for the functions below: an array of zeros with the (x,y,z) `shape` of the swapped views
+    of ITK arrays that are used in this module, but with the memory layout of ITK images ((z,y,x) in C order).
+    The last `ndim` dimensions are the image dimensions, leading dimensions (e.g. one per criterion) are outermost.
+    Elementwise operations with the swapped views are then done in memory order, and the result can be written
+    into an ITK image buffer without transposing copies.
+    """
+    n = len(shape)-ndim
+    a = np.zeros(tuple(shape[:n])+tuple(shape[n:][::-1]),dtype=dtype)
+    return a.transpose(tuple(range(n))+tuple(range(len(shape)-1,n-1,-1)))
+
+def _float_type(*arrays):
+    """
+    Convenience function for the functions below: the floating point type for computations with the dose arrays,
+    float32 unless one of them has a higher precision (gamma images are stored in float32 anyway).
+    """
+    return np.result_type(np.float32,*[a.dtype for a in arrays])
+
 def _reldiff2(dref,dtarget,ddref):
     """
     Convenience function for implementation of the following functions.
@@ -23,9 +46,478 @@ def _reldiff2(dref,dtarget,ddref):
     reldd2=(ddiff/ddref)**2
     return reldd2
 
+def _sorted_offsets(relspacing,shape,g2max):
+    """
+    Generator for the integer neighbourhood offsets of a voxel, sorted by spatial distance.
+    The `relspacing` is the voxel spacing divided by the DTA, so distances are in units of DTA.
+    Each iteration yields a band of offsets as a (n,3) integer array together with their squared
+    distances, such that the squared distances increase within a band and from band to band.
+    The zero offset is not included, neither are offsets that are larger than the image `shape`.
+    The generator stops after the band that reaches a squared distance of `g2max`.
+    Generating the offsets band by band avoids allocating the full search box for large `g2max`.
+    """
+    relspacing = np.asarray(relspacing,dtype=float)
+    rmax = np.asarray(shape,dtype=int)-1
+    lo, hi = 0., 4.*np.max(relspacing)**2
+    while lo <= g2max:
+        r = np.minimum(np.floor(np.sqrt(hi)/relspacing).astype(int),rmax)
+        ix,iy,iz = np.meshgrid(*[np.arange(-ri,ri+1) for ri in r],indexing='ij')
+        d2 = (relspacing[0]*ix)**2 + (relspacing[1]*iy)**2 + (relspacing[2]*iz)**2
+        band = (d2>lo) if lo==0. else (d2>=lo)
+        band &= (d2<hi)
+        order = np.argsort(d2[band],kind='stable')
+        yield np.stack((ix[band],iy[band],iz[band]),axis=1)[order], d2[band][order]
+        if (r==rmax).all() and hi > np.max(d2):
+            # the band covered the entire image
+            break
+        lo, hi = hi, 2*hi
+
+# the 8 corners of a voxel cell, in the order of the columns of the weights of `_interpolation_weights`
+_corners = np.array([(cx,cy,cz) for cx in (0,1) for cy in (0,1) for cz in (0,1)])
+
+def _interpolation_weights(k):
+    """
+    Trilinear interpolation weights for the sub-voxel positions m/k (m=0,...,k-1) along one axis.
+    Returns a (k,2) array with the weights of the voxels at the lower and upper side.
+    """
+    m = np.arange(k)/k
+    return np.stack((1.-m,m),axis=1)
+
+def _interpolate_box(aref,lo,hi,k):
+    """
+    Trilinear interpolation of `aref` on a virtual grid that is `k` times finer than the grid of `aref`,
+    for the fine indices lo<=f<hi (the fine index f corresponds to the position f/k in voxel units).
+    Only the box of reference voxels that is needed is read, and the interpolation is done axis by axis.
+    """
+    if k == 1:
+        return aref[lo[0]:hi[0],lo[1]:hi[1],lo[2]:hi[2]]
+    weights = _interpolation_weights(k)
+    f = [np.arange(l,h) for l,h in zip(lo,hi)]
+    olo = [fi[0]//k for fi in f]
+    a = aref[tuple(slice(o,min(fi[-1]//k+2,n)) for o,fi,n in zip(olo,f,aref.shape))]
+    for axis,(fi,o) in enumerate(zip(f,olo)):
+        i0 = fi//k-o
+        i1 = np.minimum(i0+1,a.shape[axis]-1) # the upper voxel has weight 0 if it is outside
+        wshape = [1,1,1]
+        wshape[axis] = len(fi)
+        w = weights[fi%k]
+        a = np.take(a,i0,axis=axis)*w[:,0].reshape(wshape) + np.take(a,i1,axis=axis)*w[:,1].reshape(wshape)
+    return a
+
+def _gamma2_equal_geometry(aref,atarget,mask,spacing,dd,dta,verbose=False,max_gamma=None,zrange=None,interp_factor=1):
+    """
+    Compute the squared gamma index for all voxels in `mask`, for reference and target arrays with equal geometry.
+    The neighbourhood offsets are traversed in order of increasing distance, and for each
+    offset the (shifted) reference array is compared with the target array using array operations,
+    keeping a running minimum of gamma squared. A voxel is "decided" as soon as the distance
+    of the next offset exceeds its running minimum, and the traversal stops when all voxels are decided.
+    The shifted arrays are restricted to the bounding box of the mask. When only few voxels are
+    still undecided, the shifted arrays are replaced by an explicit list of the undecided voxels,
+    which are compared with the reference for many offsets at once.
+    If `dd` and `dta` are sequences of equal length instead of numbers, then the squared gamma index is computed
+    for each (dd,dta) criterion in a single traversal, in order of the distance in units of the largest DTA.
+    The dose differences are computed once per offset for all criteria, and a voxel is decided when it is
+    decided for every criterion, so the cost is close to the cost of the criterion with the largest search radius.
+    The values for each criterion are equal to float32 precision (not bitwise) to the values computed with that
+    criterion alone, as the distances are scaled from the largest DTA.
+    If `max_gamma` is given, then the search radius is limited to `max_gamma` (in units of DTA),
+    a voxel is also decided once a gamma value less or equal to 1 is found, and gamma values
+    larger than `max_gamma` are set to `max_gamma`.
+    If `zrange=(z0,z1)` is given, then only the target slab `atarget[:,:,z0:z1]` is computed and `mask`
+    should have the shape of that slab. The neighbours outside of the slab are read directly from `aref`.
+    If `interp_factor` is larger than 1, then the reference is evaluated on a virtual grid that is `interp_factor`
+    times finer (within the reference volume). The offsets are then fine offsets, and the reference value for
+    an offset is computed from the shifted reference arrays of the corners of its cell, with trilinear weights
+    that are computed once per offset, so that no upsampled copy of the reference is made.
+    Returns an array with the shape of `mask` (with shape `(n,)+mask.shape` for n criteria), zero for voxels outside of the mask.
+    The array has the memory layout of ITK images (see `_native_zeros`), and is float32 unless the inputs have a higher precision.
+    """
+    multi = np.ndim(dd) > 0
+    ftype = _float_type(aref,atarget)
+    dd = np.atleast_1d(np.asarray(dd,dtype=ftype))
+    dta = np.atleast_1d(np.asarray(dta,dtype=float))
+    ncrit = len(dd)
+    # offsets are sorted by their distance in units of the largest DTA, w converts to units of the DTA of each criterion
+    relspacing = np.asarray(spacing,dtype=float)/np.max(dta)
+    w = (np.max(dta)/dta)**2
+    shape = atarget.shape
+    z0, z1 = (0,shape[2]) if zrange is None else zrange
+    # fine offsets f=k*o+m, with the integer offset o and the sub-voxel position m/k (k=1: no interpolation)
+    k_interp = interp_factor
+    fineshape = [(n-1)*k_interp+1 for n in shape]
+    weights = _interpolation_weights(k_interp).astype(ftype)
+    # bounding box of the mask, in the coordinates of the full arrays
+    bbox = []
+    for axis,offset in zip(range(3),(0,0,z0)):
+        nonzero = np.nonzero(np.any(mask,axis=tuple(a for a in range(3) if a!=axis)))[0]
+        bbox.append((nonzero[0]+offset,nonzero[-1]+1+offset) if len(nonzero)>0 else (offset,offset))
+    box = tuple(slice(b0,b1) for b0,b1 in bbox[:2])+(slice(bbox[2][0]-z0,bbox[2][1]-z0),)
+    ntot = np.prod([b1-b0 for b0,b1 in bbox])
+    g2 = _native_zeros((ncrit,)+mask.shape,ftype)
+    ddiff = atarget[:,:,z0:z1][mask]-aref[:,:,z0:z1][mask]
+    for c in range(ncrit):
+        g2[c][mask] = (ddiff/dd[c])**2
+    g2pass = 0. if max_gamma is None else 1.
+    g2cap = np.inf if max_gamma is None else max_gamma**2
+    nmask = np.sum(mask)
+    active = _native_zeros((ncrit,)+mask.shape,bool)
+    # criteria that are decided for all voxels (this is final, since the running minima only decrease)
+    closed = np.zeros(ncrit,dtype=bool)
+    if verbose:
+        pbar = tqdm(total=nmask, leave=False)
+    ndone = 0
+    # explicit list of undecided voxels, for the second stage
+    idx = None
+    g2max = max(min(np.max(g2[c]),g2cap)/w[c] for c in range(ncrit))
+    for offsets,d2s in _sorted_offsets(relspacing/k_interp,fineshape,g2max):
+        # integer offsets, and the trilinear weights of the 8 corners of the cell and whether the upper corners are needed
+        offsets, submesh = np.divmod(offsets,k_interp)
+        cweights = np.prod([weights[submesh[:,a]][:,_corners[:,a]] for a in range(3)],axis=0)
+        cupper = submesh>0
+        # the criterion with the largest DTA has w=1, so it is the last one to reach the cap
+        ncap = np.searchsorted(d2s,g2cap,side='right')
+        k = 0
+        # first stage: shifted arrays, one offset at a time
+        while idx is None and k < ncap:
+            (dx,dy,dz),d2 = offsets[k],d2s[k]
+            for c in np.nonzero(np.logical_not(closed))[0]:
+                if d2*w[c] > g2cap:
+                    active[c][box] = False
+                else:
+                    np.greater(g2[c][box],max(d2*w[c],g2pass),out=active[c][box])
+                closed[c] = ncrit > 1 and not active[c][box].any()
+            anyactive = active[0] if ncrit == 1 else np.any(active,axis=0)
+            nactive = np.count_nonzero(anyactive)
+            if verbose:
+                pbar.update(nmask-nactive-ndone)
+            ndone = nmask-nactive
+            if nactive == 0:
+                break
+            if 16*nactive < ntot:
+                idx = np.nonzero(anyactive)
+                ga = g2[(slice(None),)+idx]
+                gopen = active[(slice(None),)+idx]
+                idx = (idx[0],idx[1],idx[2]+z0)
+                dtarget = atarget[idx]
+                break
+            k += 1
+            ranges = [(max(-d,0,b0),min(n-max(d+c,0),b1)) for d,c,n,(b0,b1) in zip((dx,dy,dz),cupper[k-1],shape,bbox)]
+            if any(i1<=i0 for i0,i1 in ranges):
+                continue
+            t = tuple(slice(i0,i1) for i0,i1 in ranges)
+            tslab = t[:2]+(slice(t[2].start-z0,t[2].stop-z0),)
+            if cweights[k-1,0] == 1.:
+                ddiff = atarget[t]-aref[tuple(slice(i0+d,i1+d) for d,(i0,i1) in zip((dx,dy,dz),ranges))]
+            else:
+                ddiff = np.array(atarget[t],dtype=ftype)
+                for corner,cw in zip(_corners,cweights[k-1]):
+                    if cw > 0.:
+                        ddiff -= cw*aref[tuple(slice(i0+d+c,i1+d+c) for d,c,(i0,i1) in zip((dx,dy,dz),corner,ranges))]
+            for c in np.nonzero(np.logical_not(closed))[0]:
+                g2mesh = (ddiff/dd[c])**2
+                g2mesh += d2*w[c]
+                g2t = g2[c][tslab]
+                np.minimum(g2t,g2mesh,out=g2t,where=active[c][tslab])
+        # second stage: list of undecided voxels, many offsets at a time
+        while idx is not None and k < ncap and ga.shape[1] > 0:
+            nvox = ga.shape[1]
+            kmax = min(k+max(1,2**18//nvox),ncap)
+            j = [i[:,np.newaxis]+o[np.newaxis,:] for i,o in zip(idx,offsets[k:kmax].T)]
+            up = [cu[np.newaxis,:] for cu in cupper[k:kmax].T]
+            ok = (j[0]>=0)&(j[1]>=0)&(j[2]>=0)&(j[0]+up[0]<shape[0])&(j[1]+up[1]<shape[1])&(j[2]+up[2]<shape[2])
+            iok = np.nonzero(ok)
+            j = [ji[iok] for ji in j]
+            # dose differences, shared by all criteria (infinite for neighbours outside of the image)
+            ddiff = np.full(ok.shape,np.inf,dtype=ftype)
+            if (cweights[k:kmax,0] == 1.).all():
+                ddiff[iok] = dtarget[iok[0]]-aref[j[0],j[1],j[2]]
+            else:
+                dref = np.zeros(len(iok[0]),dtype=ftype)
+                for corner,cw in zip(_corners,cweights[k:kmax].T):
+                    if (cw > 0.).any():
+                        # the upper corner index may be outside of the image if its weight is zero
+                        dref += cw[iok[1]]*aref[tuple(np.minimum(ji+ci,n-1) for ji,ci,n in zip(j,corner,shape))]
+                ddiff[iok] = dtarget[iok[0]]-dref
+            for c in range(ncrit):
+                # only the voxels that are still undecided for this criterion
+                rows = np.nonzero(gopen[c])[0]
+                if len(rows) == 0:
+                    continue
+                d2c = d2s[k:kmax]*w[c]
+                # beyond the cap the search stops, so no voxel can be undecided there
+                g2stop = np.where(d2c>g2cap,np.inf,np.maximum(d2c,g2pass))
+                # g2run[:,i] is the running minimum before offset k+i, the last column is the running minimum after the last offset
+                g2run = np.empty((len(rows),kmax-k+1),dtype=ftype)
+                g2run[:,0] = ga[c,rows]
+                g2run[:,1:] = (ddiff[rows]/dd[c])**2 + d2c[np.newaxis,:]
+                np.minimum.accumulate(g2run,axis=1,out=g2run)
+                # the search for a voxel stops at the first offset for which it is decided
+                nsearch = np.sum(g2run[:,:-1]>g2stop[np.newaxis,:],axis=1)
+                ga[c,rows] = g2run[np.arange(len(rows)),nsearch]
+                gopen[c,rows] = nsearch == kmax-k
+            undecided = np.any(gopen,axis=0)
+            if not undecided.all():
+                # store the final values and shrink the list of undecided voxels
+                done = np.logical_not(undecided)
+                g2[:,idx[0][done],idx[1][done],idx[2][done]-z0] = ga[:,done]
+                idx = tuple(i[undecided] for i in idx)
+                ga = ga[:,undecided]
+                gopen = gopen[:,undecided]
+                dtarget = dtarget[undecided]
+                if verbose:
+                    pbar.update(np.sum(done))
+            k = kmax
+        if idx is None and k < ncap:
+            # all voxels decided in the first stage
+            break
+        if idx is not None and ga.shape[1] == 0:
+            break
+        if ncap < len(d2s):
+            # reached max_gamma
+            break
+    if idx is not None:
+        g2[:,idx[0],idx[1],idx[2]-z0] = ga
+    if verbose:
+        pbar.close()
+    np.minimum(g2,g2cap,out=g2)
+    return g2 if multi else g2[0]
+
+def _gamma2_planes(aref,atarget,mask,spacing,dd,dta,max_gamma=None):
+    """
+    Compute the squared gamma index for all voxels in `mask`, for a stack of 2D planes: the arrays have shape
+    (nplanes,nx,ny), the planes have equal geometry with the pixel `spacing` (sx,sy), and each target plane is only
+    compared with the reference plane with the same index.
+    The dose difference scale `dd` is an array that broadcasts to the shape of the stack: one value per plane
+    for global gamma, or one value per voxel for local gamma.
+    The in-plane offsets are traversed in order of increasing distance (see `_sorted_offsets`). For each offset the
+    shifted reference planes are compared with the target planes with array operations on the whole stack, keeping a
+    running minimum of gamma squared, until the distance of the offsets exceeds the running minimum of all voxels.
+    When only few voxels are still undecided, they are compared with the reference for many offsets at once instead.
+    If `max_gamma` is given, then the search radius is limited to `max_gamma` (in units of DTA), a voxel is also
+    decided once a gamma value less or equal to 1 is found, and gamma values larger than `max_gamma` are set to `max_gamma`.
+    Returns an array with the shape of `mask`, zero for voxels outside of the mask (float32 unless the inputs have a higher precision).
+    """
+    shape = atarget.shape
+    ftype = _float_type(aref,atarget)
+    dd = np.broadcast_to(np.asarray(dd,dtype=ftype),shape)
+    g2cap = np.inf if max_gamma is None else max_gamma**2
+    g2 = _native_zeros(shape,ftype,ndim=2)
+    g2[mask] = _reldiff2(aref[mask],atarget[mask],dd[mask])
+    todo = mask & (g2 > 0.)
+    if max_gamma is not None:
+        todo &= g2 > 1.
+    g2max = min(np.max(g2,initial=0.),g2cap)
+    relspacing = np.append(np.asarray(spacing,dtype=float)/dta,1.)
+    for offsets, d2 in _sorted_offsets(relspacing,shape[1:]+(1,),g2max):
+        if not np.any(todo) or (len(d2)>0 and d2[0] > g2cap):
+            break
+        inrange = d2 <= g2cap
+        offsets, d2 = offsets[inrange,:2], d2[inrange]
+        nvoxels = np.sum(todo)
+        if nvoxels > todo.size//32:
+            # shifted planes
+            for (dx,dy),d2o in zip(offsets,d2):
+                tbox = (slice(None),slice(max(0,-dx),shape[1]-max(0,dx)),slice(max(0,-dy),shape[2]-max(0,dy)))
+                rbox = (slice(None),slice(max(0,dx),shape[1]+min(0,dx)),slice(max(0,dy),shape[2]+min(0,dy)))
+                g2o = _reldiff2(aref[rbox],atarget[tbox],dd[tbox]) + d2o
+                np.minimum(g2[tbox],np.where(todo[tbox],g2o,np.inf),out=g2[tbox])
+        else:
+            # explicit list of the undecided voxels, compared with chunks of offsets
+            p, i, j = np.nonzero(todo)
+            dtarget, ddtarget = atarget[p,i,j][:,np.newaxis], dd[p,i,j][:,np.newaxis]
+            g2todo = g2[p,i,j]
+            nchunk = max(1,2**22//nvoxels)
+            for o0 in range(0,len(d2),nchunk):
+                ii = i[:,np.newaxis]+offsets[np.newaxis,o0:o0+nchunk,0]
+                jj = j[:,np.newaxis]+offsets[np.newaxis,o0:o0+nchunk,1]
+                valid = (ii>=0)&(ii<shape[1])&(jj>=0)&(jj<shape[2])
+                dref = aref[p[:,np.newaxis],np.clip(ii,0,shape[1]-1),np.clip(jj,0,shape[2]-1)]
+                g2o = np.where(valid,_reldiff2(dref,dtarget,ddtarget)+d2[np.newaxis,o0:o0+nchunk],np.inf)
+                np.minimum(g2todo,np.min(g2o,axis=1),out=g2todo)
+            g2[p,i,j] = g2todo
+        # voxels with a running minimum below the distance of this band are decided
+        if len(d2) > 0:
+            todo &= g2 > d2[-1]
+        if max_gamma is not None:
+            todo &= g2 > 1.
+    np.minimum(g2,g2cap,out=g2)
+    return g2
+
+def _block_minmax(aref,b):
+    """
+    Downsample `aref` into blocks of b x b x b voxels (smaller at the upper edges), keeping the minimum and the maximum of each block.
+    """
+    amin, amax = aref, aref
+    for axis,n in enumerate(aref.shape):
+        starts = np.arange(0,n,b)
+        amin = np.minimum.reduceat(amin,starts,axis=axis)
+        amax = np.maximum.reduceat(amax,starts,axis=axis)
+    return amin, amax
+
+def _gamma2_bounds(aref,atarget,mask,refgeometry,targetgeometry,dd,dta,levels,margin,max_gamma=None,minmax=None):
+    """
+    Prove with cheap bounds that voxels in `mask` pass or fail, for coarse-to-fine pruning of the gamma computation.
+    * Upper bound: the gamma value with the closest reference voxel. Voxels with an upper bound <= 1-margin pass.
+    * Lower bound, for each block size b in `levels` (coarse to fine): the reference is downsampled into blocks of b^3 voxels,
+      keeping the minimum and maximum dose of each block. For a target voxel with position x and dose d, gamma squared is at
+      least the minimum over the blocks of dist(x,block)^2/dta^2 + dist(d,[min,max])^2/dd^2. Only the blocks within a
+      distance thr*dta are visited, with thr=1+margin (or max_gamma, if that is smaller), so voxels for which all these
+      blocks give at least thr^2 fail.
+    The geometries are given as (origin,spacing) tuples and `mask` should only contain voxels in the overlap.
+    If `dd` and `dta` are sequences, then the bounds are computed for each criterion.
+    If a dictionary `minmax` is given, then it is used as a cache for the block minimum and maximum of `aref` (by block size).
+    Returns the squared bounds (the upper bound for passing voxels and thr^2 for failing voxels), a boolean array that
+    flags the pruned voxels (both with the shape of `mask`, or with shape (n,)+mask.shape for n criteria), and a report:
+    a list of (level,npass,nfail) tuples with the number of pruned voxels (for all criteria together) at each level,
+    where the level is "closest" for the upper bound and the block size for the lower bounds.
+    """
+    multi = np.ndim(dd) > 0
+    dd = np.atleast_1d(np.asarray(dd,dtype=float))
+    dta = np.atleast_1d(np.asarray(dta,dtype=float))
+    ncrit = len(dd)
+    areforigin, arefspacing = refgeometry
+    atargetorigin, atargetspacing = targetgeometry
+    thr = 1.+margin if max_gamma is None else min(1.+margin,max_gamma)
+    iref, inside = _nearest_indices(refgeometry,targetgeometry,aref.shape,atarget.shape)
+    itarget = np.nonzero(mask)
+    ihome = np.stack([ir[it] for ir,it in zip(iref,itarget)],axis=1)
+    xtarget = np.stack([o+it*s for o,it,s in zip(atargetorigin,itarget,atargetspacing)],axis=1)
+    dtarget = atarget[itarget]
+    # upper bound: closest reference voxel
+    rclose2 = np.sum((xtarget-(areforigin+ihome*arefspacing))**2,axis=1)
+    dclose = aref[tuple(ihome.T)]
+    g2 = np.array([_reldiff2(dclose,dtarget,dd[c]) + rclose2/dta[c]**2 for c in range(ncrit)])
+    pruned = g2 <= (1.-margin)**2
+    report = [("closest",np.sum(pruned),0)]
+    for b in levels:
+        if minmax is None:
+            bmin, bmax = _block_minmax(aref,b)
+        else:
+            if b not in minmax:
+                minmax[b] = _block_minmax(aref,b)
+            bmin, bmax = minmax[b]
+        # range of the voxel centers in each block
+        blo = [o+np.arange(0,n,b)*s for o,n,s in zip(areforigin,aref.shape,arefspacing)]
+        bhi = [o+(np.minimum(np.arange(0,n,b)+b,n)-1)*s for o,n,s in zip(areforigin,aref.shape,arefspacing)]
+        nfail = 0
+        for c in range(ncrit):
+            # blocks further away than this from the block of the closest reference voxel are at a distance of at least thr*dta
+            r = np.ceil(thr*dta[c]/(b*arefspacing)).astype(int)
+            offsets = np.stack(np.meshgrid(*[np.arange(-ri,ri+1) for ri in r],indexing='ij'),axis=-1).reshape(-1,3)
+            todo = np.nonzero(np.logical_not(pruned[c]))[0]
+            nchunk = max(1,2**20//len(offsets))
+            for i0 in range(0,len(todo),nchunk):
+                t = todo[i0:i0+nchunk]
+                blocks = ihome[t][:,np.newaxis,:]//b+offsets[np.newaxis,:,:]
+                valid = np.all((blocks>=0)&(blocks<bmin.shape),axis=2)
+                blocks = np.where(valid[:,:,np.newaxis],blocks,0)
+                lb2 = np.zeros(blocks.shape[:2])
+                for axis in range(3):
+                    x = xtarget[t,axis][:,np.newaxis]
+                    gap = np.maximum(0.,np.maximum(blo[axis][blocks[:,:,axis]]-x,x-bhi[axis][blocks[:,:,axis]]))
+                    lb2 += gap**2/dta[c]**2
+                bi = tuple(blocks[:,:,axis] for axis in range(3))
+                d = dtarget[t][:,np.newaxis]
+                lb2 += np.maximum(0.,np.maximum(bmin[bi]-d,d-bmax[bi]))**2/dd[c]**2
+                lb2[np.logical_not(valid)] = np.inf
+                fail = t[np.min(lb2,axis=1)>=thr**2]
+                pruned[c,fail] = True
+                g2[c,fail] = thr**2
+                nfail += len(fail)
+        report.append((b,0,nfail))
+    g2full = _native_zeros((ncrit,)+mask.shape,_float_type(aref,atarget))
+    prunedfull = _native_zeros((ncrit,)+mask.shape,bool)
+    for c in range(ncrit):
+        g2full[c][mask] = g2[c]
+        prunedfull[c][mask] = pruned[c]
+    if multi:
+        return g2full, prunedfull, report
+    return g2full[0], prunedfull[0], report
+
+def _gamma2_pruned(compute,aref,atarget,mask,refgeometry,targetgeometry,dd,dta,levels,margin,max_gamma=None,minmax=None):
+    """
+    Coarse-to-fine gamma computation: voxels that pass or fail by a margin according to the bounds of
+    `_gamma2_bounds` are pruned, and `compute(mask)` computes the exact squared gamma index only for the other voxels.
+    The number of pruned voxels at each level is logged (at the "info" level). The `minmax` cache is passed on to `_gamma2_bounds`.
+    Returns the squared gamma index (for the pruned voxels the bound) and the report of `_gamma2_bounds`.
+    """
+    if not 0. <= margin < 1.:
+        raise ValueError("prune_margin should be at least 0 and less than 1, got {}".format(margin))
+    if len(levels) == 0 or min(levels) < 1:
+        raise ValueError("prune_levels should be a list of block sizes, got {}".format(levels))
+    g2, pruned, report = _gamma2_bounds(aref,atarget,mask,refgeometry,targetgeometry,dd,dta,levels,margin,max_gamma,minmax)
+    # the exact computation is needed for all voxels that are not pruned for every criterion
+    exact = mask & np.logical_not(np.all(pruned.reshape((-1,)+mask.shape),axis=0))
+    for level,npass,nfail in report:
+        logger.info("gamma pruning level {}: {} pass, {} fail".format(level,npass,nfail))
+    logger.info("gamma pruning: {} out of {} voxels need the exact computation".format(np.sum(exact),np.sum(mask)))
+    if np.any(exact):
+        g2exact = compute(exact)
+        g2[...,exact] = g2exact[...,exact]
+    return g2, report
+
+def _have_equal_geometry(img1,img2):
+    """
+    Check whether two images have the same origin, spacing and size.
+    """
+    return np.allclose(img1.GetOrigin(),img2.GetOrigin()) and \
+           np.allclose(img1.GetSpacing(),img2.GetSpacing()) and \
+           tuple(img1.GetLargestPossibleRegion().GetSize()) == tuple(img2.GetLargestPossibleRegion().GetSize())
+
+def _gamma_criteria(dd,dta,criteria):
+    """
+    Convenience function for the functions below: returns the `dd` and `dta` arguments for the gamma computation,
+    as given for a single criterion, or as arrays if a list of (dd,dta) pairs is given with `criteria`.
+    """
+    if criteria is None:
+        return dd, dta
+    criteria = np.array(criteria,dtype=float)
+    if criteria.ndim != 2 or criteria.shape[1] != 2 or len(criteria) == 0:
+        raise ValueError("criteria should be a non-empty list of (dd,dta) pairs, got {}".format(criteria.tolist()))
+    return criteria[:,0], criteria[:,1]
+
+def _gamma_image(g2,mask,defvalue,imgtarget):
+    """
+    Convenience function for the functions below: converts squared gamma values (in (x,y,z) order, or (x,y) for 2D images)
+    to a gamma image with the geometry of the target image.
+    """
+    # ITK does not support double precision images by default => float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    # The gamma values are written directly into the buffer of the output image, without temporary copies.
+    gimg=itk.Image[itk.F,imgtarget.GetImageDimension()].New()
+    gimg.SetRegions(imgtarget.GetLargestPossibleRegion())
+    gimg.CopyInformation(imgtarget)
+    gimg.Allocate()
+    g=itk.array_view_from_image(gimg).T
+    g[...]=defvalue
+    np.sqrt(g2,out=g,where=mask,casting='same_kind')
+    return gimg
+
+def _target_mask(roi_mask,imgtarget):
+    """
+    Convenience function for the functions below: the voxels of the target image that are inside `roi_mask`, as a boolean
+    array in (x,y,z) order. The `roi_mask` is an image with nonzero values inside the region of interest (e.g. from
+    `region_of_interest.get_mask`), or a list of such images (then the union is used). If a mask image has another
+    geometry than the target image, then for each target voxel the mask voxel with the closest center is used,
+    and target voxels outside of the mask image are outside of the region of interest.
+    """
+    if isinstance(roi_mask,(list,tuple)):
+        masks = [_target_mask(m,imgtarget) for m in roi_mask]
+        return np.logical_or.reduce(masks) if len(masks)>0 else None
+    amask = itk.array_view_from_image(roi_mask).swapaxes(0,2)
+    if _have_equal_geometry(roi_mask,imgtarget):
+        return amask != 0
+    maskgeometry = (np.array(roi_mask.GetOrigin(),dtype=float),np.array(roi_mask.GetSpacing(),dtype=float))
+    targetgeometry = (np.array(imgtarget.GetOrigin(),dtype=float),np.array(imgtarget.GetSpacing(),dtype=float))
+    targetshape = tuple(imgtarget.GetLargestPossibleRegion().GetSize())
+    imask, inside = _nearest_indices(maskgeometry,targetgeometry,amask.shape,targetshape)
+    imask = [np.clip(i,0,n-1) for i,n in zip(imask,amask.shape)]
+    overlap = inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,:]
+    return (amask[np.ix_(*imask)] != 0) & overlap
+
 def get_gamma_index(ref,target,**kwargs):
     """
-    Compare two 3D images using the gamma index formalism as introduced by Daniel Low (1998).
+    Compare two 3D (or 2D) images using the gamma index formalism as introduced by Daniel Low (1998).
     The positional arguments 'ref' and 'target' should behave like ITK image objects.
     Possible keyword arguments include:
     * dd indicates "dose difference" scale as a relative value, in units of percent
@@ -33,99 +525,77 @@ def get_gamma_index(ref,target,**kwargs):
     * ddpercent is a flag, True (default) means that dd is given in percent, False means that dd is absolute.
     * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * threshold indicates minimum dose value (exclusive) for calculating gamma values
+    * max_gamma (optional) limits the search radius to max_gamma*dta. The search for a voxel stops
+      as soon as a gamma value less or equal to 1 is found (the voxel passes), so for passing voxels the
+      gamma value is an upper bound rather than the minimum. Gamma values larger than max_gamma are set to max_gamma,
+      so max_gamma should be larger than 1.
+    * n_workers (default 1) is the number of processes to use. With more than one process, the target image is
+      split into slabs along z, which are computed in parallel (requires python 3.8 or newer, with older versions
+      the computation is serial, with a warning).
+      The result is identical to the result with a single process.
+    * criteria (optional) is a list of (dd,dta) pairs, e.g. [(1,1),(2,2),(3,3)], to compute the gamma index for several
+      criteria at once (dd and dta are then ignored). The neighbourhood search is shared by all criteria, so the cost is
+      close to the cost of the criterion with the largest search radius. The gamma values of each criterion are equal
+      to float32 precision to the values computed with that criterion alone.
+    * interp_factor (default 1, equal_geometry and unequal_geometry methods only) is an integer: with a value k larger
+      than 1 the gamma index is evaluated on a virtual reference grid that is k times finer, interpolated trilinearly from
+      the reference voxels. This reduces the pessimistic bias of coarse reference grids, without upsampling the reference image.
+    * prune_levels (optional) enables coarse-to-fine pruning, e.g. prune_levels=[8,4,2]. Voxels for which the gamma value
+      with the closest reference voxel is at most 1-prune_margin pass. For each block size in prune_levels, a lower bound for
+      gamma is computed from the minimum and maximum dose in blocks of the reference image, and voxels with a lower bound of
+      at least 1+prune_margin (or max_gamma, if that is smaller) fail. The exact search is only done for the other voxels.
+      The pass/fail decision is the same as without pruning, but the pruned voxels get the bound as gamma value. The number
+      of pruned voxels at each level is logged at the "info" level. Not available together with interp_factor.
+    * prune_margin (default 0.1), see prune_levels.
+    * method (default "auto") selects the implementation: "equal_geometry" (for images with the same origin, spacing and size),
+      "unequal_geometry" (search a box of reference voxels around each target voxel), "spatial_index" (index the reference voxels
+      once and find the nearest reference voxel in (x/dta,y/dta,z/dta,dose/dd) space for all target voxels with batched queries,
+      see `gamma_index_3d_spatial_index`) or "auto" (use "equal_geometry" if possible and "unequal_geometry" otherwise).
+    * dose_floor (optional, spatial_index method only), see `gamma_index_3d_spatial_index`.
+    * roi_mask (optional) is a mask image (nonzero inside), e.g. from `region_of_interest.get_mask`, or a list of mask images.
+      Only the target voxels inside the mask (or the union of the masks) are computed. A mask image with another geometry
+      than the target image is sampled at the target voxel centers. Use `gamma_roi_pass_rates` for the pass rate per ROI.
     * verbose is a flag, True will result in a progress bar. All other chatter goes to the "debug" level.
-    Returns an image with the same geometry as the target image.
+    To compare many target images with the same reference, create a `GammaEvaluator` once and use its `evaluate` method.
+    Returns an image with the same geometry as the target image (a list with one image per criterion if criteria is given).
     For all target voxels in the overlap between ref and target that have d>dmin, a gamma index value is given.
     For all other voxels the "defvalue" is given.
-    TODO: allow 2D images, by creating 3D images with a 1-bin Z dimension. Should be very easy.
-    The 3D gamma image computed using these "fake 3D" images can then be collapsed back to a 2D image.
-    """
-    if (np.allclose(ref.GetOrigin(),target.GetOrigin())) and \
-       (np.allclose(ref.GetSpacing(),target.GetSpacing())) and \
-       (ref.GetLargestPossibleRegion().GetSize() == ref.GetLargestPossibleRegion().GetSize() ):
-        logger.debug("Images with equal geometry, using the slightly faster implementation.")
-        return gamma_index_3d_equal_geometry(ref,target,**kwargs)
-    else:
-        logger.debug("Images with different geometry, using the slightly slower implementation.")
-        return gamma_index_3d_unequal_geometry(ref,target,**kwargs)
-
+    For 2D images the gamma index is computed with `gamma_index_2d` (the keyword arguments dd, ddpercent, dta, threshold,
+    defvalue and max_gamma, and local for local gamma, are passed on).
+    """
+    if ref.GetImageDimension() == 2 and target.GetImageDimension() == 2:
+        return gamma_index_2d(ref,target,**kwargs)
+    roi_mask = kwargs.pop("roi_mask",None)
+    return GammaEvaluator(ref,**kwargs).evaluate(target,roi_mask)
 
 # FIXME: Should this function remain public or be made private (by prefixing it with an _underscore)?
-# TODO: Discuss whether to keep this function. It is 30% faster than the
-# "unequal geometry" implementation on the same input images. Is that worth it?
-def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False):
+# The neighbourhood search is vectorized (see `_gamma2_equal_geometry`), which makes this
+# function orders of magnitude faster than the "unequal geometry" implementation on the same input images.
+def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,max_gamma=None,n_workers=1,criteria=None,interp_factor=1,
+                                  prune_levels=None,prune_margin=0.1):
     """
     Compare two images with equal geometry, using the gamma index formalism as introduced by Daniel Low (1998).
     * ddpercent indicates "dose difference" scale as a relative value, in units percent (the dd value is this percentage of the max dose in the reference image)
     * ddabs indicates "dose difference" scale as an absolute value
     * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * threshold indicates minimum dose value (exclusive) for calculating gamma values: target voxels with dose<=threshold are skipped and get assigned gamma=defvalue.
-    Returns an image with the same geometry as the target image.
+    * max_gamma (optional) limits the search radius to max_gamma*dta and stops the search for a voxel once it passes (see `get_gamma_index`).
+    * n_workers is the number of processes to use (see `get_gamma_index`).
+    * criteria (optional) is a list of (dd,dta) pairs that replaces dd and dta (see `get_gamma_index`).
+    * interp_factor (default 1) evaluates the reference on a k times finer virtual grid (see `get_gamma_index`).
+    * prune_levels and prune_margin (optional) enable coarse-to-fine pruning (see `get_gamma_index`).
+    Returns an image with the same geometry as the target image (a list with one image per criterion if criteria is given).
     For all target voxels that have d>threshold, a gamma index value is given.
     For all other voxels the "defvalue" is given.
     If geometries of the input images are not equal, then a `ValueError` is raised.
     """
-    aref=itk.array_view_from_image(imgref).swapaxes(0,2)
-    atarget=itk.array_view_from_image(imgtarget).swapaxes(0,2)
-    if aref.shape != atarget.shape:
-        raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
-    if not np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()):
-        raise ValueError("input images have different geometries ({} vs {} spacing)".format(imgref.GetSpacing(),imgtarget.GetSpacing()))
-    if not np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin()):
-        raise ValueError("input images have different geometries ({} vs {} origin)".format(imgref.GetOrigin(),imgtarget.GetOrigin()))
-    if ddpercent:
-        dd *= 0.01*np.max(aref)
-    relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
-    inv_spacing = np.ones(3,dtype=float)/relspacing
-    g00=np.ones(aref.shape,dtype=float)*-1
-    mask=atarget>threshold
-    g00[mask]=np.sqrt(_reldiff2(aref[mask],atarget[mask],dd))
-    nx,ny,nz = atarget.shape
-    ntot = nx*ny*nz
-    nmask = np.sum(mask)
-    logger.debug("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
-    logger.debug("{} target voxels have a dose > {}.".format(nmask,threshold))
-    g2 = np.zeros((nx,ny,nz),dtype=float)
-    if verbose:
-        pbar = tqdm(total=nmask, leave=False)
-    for x in range(nx):
-        for y in range(ny):
-            for z in range(nz):
-                if g00[x,y,z] < 0:
-                    continue
-                igmax=np.round(g00[x,y,z]*inv_spacing).astype(int) # maybe we should use "floor" instead of "round"
-                if (igmax==0).all():
-                    g2[x,y,z]=g00[x,y,z]**2
-                else:
-                    ixmin = max(x-igmax[0],0)
-                    ixmax = min(x+igmax[0]+1,nx)
-                    iymin = max(y-igmax[1],0)
-                    iymax = min(y+igmax[1]+1,ny)
-                    izmin = max(z-igmax[2],0)
-                    izmax = min(z+igmax[2]+1,nz)
-                    ix,iy,iz = np.meshgrid(np.arange(ixmin,ixmax),
-                                           np.arange(iymin,iymax),
-                                           np.arange(izmin,izmax),indexing='ij')
-                    g2mesh = _reldiff2(aref[ix,iy,iz],atarget[x,y,z],dd)
-                    g2mesh += ((relspacing[0]*(ix-x)))**2
-                    g2mesh += ((relspacing[1]*(iy-y)))**2
-                    g2mesh += ((relspacing[2]*(iz-z)))**2
-                    g2[x,y,z] = np.min(g2mesh)
-                if verbose:
-                    pbar.update(1)
-    if verbose:
-        pbar.close()
-    g=np.sqrt(g2)
-    g[np.logical_not(mask)]=defvalue
-    # ITK does not support double precision images by default => cast down to float32.
-    # Also: only the first few digits of gamma index values are interesting.
-    gimg=itk.image_from_array(g.swapaxes(0,2).astype(np.float32).copy())
-    gimg.CopyInformation(imgtarget)
-    logger.debug(f"Computed {nmask} gamma values assuming EQUAL geometry in target and reference")
-    return gimg
+    return GammaEvaluator(imgref,dd=dd,dta=dta,ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose,
+                          max_gamma=max_gamma,n_workers=n_workers,criteria=criteria,interp_factor=interp_factor,
+                          prune_levels=prune_levels,prune_margin=prune_margin,method="equal_geometry").evaluate(imgtarget)
 
 # FIXME: should this function remain public or be made private (by prefixing it with an _underscore)?
-def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False):
+def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,max_gamma=None,n_workers=1,criteria=None,interp_factor=1,
+                                    prune_levels=None,prune_margin=0.1):
     """
     Compare 3-dimensional arrays with possibly different spacing and different origin, using the
     gamma index formalism, popular in medical physics.
@@ -135,112 +605,749 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     * If `ddpercent` is False, then dd is taken as an absolute value.
     * `dta` indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
-    Returns an image with the same geometry as the target image.
+    * `max_gamma` (optional) limits the search radius to max_gamma*dta and stops the search for a voxel once it passes (see `get_gamma_index`).
+    * `n_workers` is the number of processes to use (see `get_gamma_index`).
+    * `criteria` (optional) is a list of (dd,dta) pairs that replaces dd and dta (see `get_gamma_index`).
+    * `interp_factor` (default 1) evaluates the reference on a k times finer virtual grid (see `get_gamma_index`).
+    * `prune_levels` and `prune_margin` (optional) enable coarse-to-fine pruning (see `get_gamma_index`).
+    Returns an image with the same geometry as the target image (a list with one image per criterion if criteria is given).
     For all target voxels that are in the overlap region with the refernce image and that have d>threshold,
     a gamma index value is given. For all other voxels the "defvalue" is given.
     """
-    # get arrays
-    aref = itk.array_view_from_image(imgref).swapaxes(0,2)
-    atarget = itk.array_view_from_image(imgtarget).swapaxes(0,2)
+    return GammaEvaluator(imgref,dd=dd,dta=dta,ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose,
+                          max_gamma=max_gamma,n_workers=n_workers,criteria=criteria,interp_factor=interp_factor,
+                          prune_levels=prune_levels,prune_margin=prune_margin,method="unequal_geometry").evaluate(imgtarget)
+
+def gamma_index_3d_spatial_index(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,max_gamma=None,n_workers=1,criteria=None,dose_floor=None,
+                                 prune_levels=None,prune_margin=0.1):
+    """
+    Compare two 3D images (with possibly different spacing and different origin, but not rotated w.r.t. each other)
+    using the gamma index formalism, with a spatial index on the reference voxels (see `_gamma2_spatial_index`).
+    Instead of searching a box of reference voxels around every target voxel, the reference voxels are indexed once
+    as points with scaled coordinates (x/dta,y/dta,z/dta,dose/dd), and the gamma value of each target voxel is the
+    distance to the nearest such point, which is found with batched queries for all target voxels.
+    The arguments dd, ddpercent, dta, threshold, defvalue, max_gamma, n_workers and criteria have the same meaning
+    as for `gamma_index_3d_unequal_geometry`.
+    * `prune_levels` and `prune_margin` (optional) enable coarse-to-fine pruning (see `get_gamma_index`).
+    * `dose_floor` (optional): only reference voxels with a dose larger than dose_floor are indexed. This makes the
+      index smaller, but the result is then only exact if the nearest reference voxels have a dose above the floor.
+    Returns an image with the same geometry as the target image (a list with one image per criterion if criteria is given).
+    """
+    return GammaEvaluator(imgref,dd=dd,dta=dta,ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose,
+                          max_gamma=max_gamma,n_workers=n_workers,criteria=criteria,dose_floor=dose_floor,
+                          prune_levels=prune_levels,prune_margin=prune_margin,method="spatial_index").evaluate(imgtarget)
+
+def gamma_pass_rate(ref,target,dta=3.,dd=3.,ddpercent=True,threshold=0.,max_gamma=None,nbins=50,chunk_size=2**22,verbose=False,criteria=None,interp_factor=1,
+                    rois=None):
+    """
+    Compute the gamma index pass rate of the `target` image w.r.t. the `ref` image, without creating gamma images.
+    The arguments dd, ddpercent, dta, threshold, max_gamma, criteria and interp_factor have the same meaning as for `get_gamma_index`.
+    The target image is processed in slabs along z of at most `chunk_size` voxels. For each slab only
+    running counters, a histogram with fixed bins and the list of failing voxels are kept, so that
+    the peak memory use does not depend on the size of the images (except for the list of failing voxels).
+    The histogram has `nbins` bins between 0 and `max_gamma` (or between 0 and 2 if max_gamma is not given),
+    larger gamma values are counted in the last bin.
+    Returns a dictionary with:
+    * "ncomputed": the number of target voxels for which a gamma value was computed
+    * "npass" and "nfail": the number of these voxels with gamma<=1 and gamma>1, respectively
+    * "pass_rate": npass/ncomputed (NaN if no gamma value was computed)
+    * "gamma_mean" and "gamma_max": mean and maximum gamma value
+    * "histogram" and "bin_edges": the gamma histogram
+    * "failing": (nfail,3) integer array with the ITK indices (i,j,k) of the failing voxels, sorted by linear index
+    * "failing_gamma": the gamma values of the failing voxels
+    If criteria is given, then a list with such a dictionary for each criterion is returned.
+    If `rois` is given, it should be a dictionary with ROI names and mask images (see the roi_mask argument of `get_gamma_index`).
+    Then only the target voxels in the union of the ROIs are computed, and a dictionary with the summary (or the list of
+    summaries, for several criteria) for each ROI is returned.
+    """
+    evaluator = GammaEvaluator(ref,dd=dd,dta=dta,ddpercent=ddpercent,threshold=threshold,max_gamma=max_gamma,
+                               verbose=verbose,criteria=criteria,interp_factor=interp_factor)
+    return evaluator.pass_rate(target,nbins=nbins,chunk_size=chunk_size,rois=rois)
+
+def gamma_roi_pass_rates(gamma,rois):
+    """
+    Compute the gamma pass rate in regions of interest from a gamma image, e.g. computed with `get_gamma_index`.
+    `rois` is a dictionary with ROI names and mask images (see the roi_mask argument of `get_gamma_index`).
+    Only voxels with a gamma value are counted: voxels with a negative value (the default value) are skipped,
+    so the gamma image should be computed with a negative defvalue.
+    Returns a dictionary with a summary for each ROI, with "ncomputed", "npass", "nfail", "pass_rate", "gamma_mean"
+    and "gamma_max" (see `gamma_pass_rate`).
+    """
+    agamma = itk.array_view_from_image(gamma).swapaxes(0,2)
+    summaries = {}
+    for name,roi_mask in rois.items():
+        g = agamma[_target_mask(roi_mask,gamma) & (agamma>=0.)]
+        ncomputed, npass = len(g), np.sum(g<=1.)
+        summaries[name] = {"ncomputed":ncomputed,
+                           "npass":npass,
+                           "nfail":ncomputed-npass,
+                           "pass_rate":npass/ncomputed if ncomputed>0 else np.nan,
+                           "gamma_mean":np.mean(g,dtype=float) if ncomputed>0 else np.nan,
+                           "gamma_max":float(np.max(g,initial=0.))}
+    return summaries
+
+def _gamma_dd_planes(aref,atarget,dd,ddpercent,local):
+    """
+    Convenience function for the 2D functions below: the dose difference scale for `_gamma2_planes`, one value per
+    plane for global gamma (a percentage of the maximum of each reference plane if `ddpercent` is True), or one value
+    per voxel for local gamma (a percentage of the local reference dose, i.e. of the reference dose at the position
+    of the target voxel).
+    """
+    if local:
+        if not ddpercent:
+            raise ValueError("local gamma needs a relative dose difference (ddpercent=True)")
+        return 0.01*dd*aref
     if ddpercent:
-        dd *= 0.01*np.max(aref)
-    # test consistency: both must be 3D
-    # it would be cool to make this for 2D as well (and D>3), but not now
-    if len(aref.shape) != 3 or len(atarget.shape) != 3:
-        return None
-    #bbref  = bounding_box(imgref)
-    #bbtarget = bounding_box(imgtarget)
-    areforigin = np.array(imgref.GetOrigin())
-    arefspacing = np.array(imgref.GetSpacing())
-    atargetorigin = np.array(imgtarget.GetOrigin())
-    atargetspacing = np.array(imgtarget.GetSpacing())
-    nx,ny,nz = atarget.shape
-    mx,my,mz = aref.shape
-    ntot = nx*ny*nz
-    mtot = mx*my*mz
+        return 0.01*dd*np.max(aref,axis=(1,2),keepdims=True,initial=0.)
+    return dd
+
+def _gamma_mask_planes(aref,atarget,threshold,local):
+    """
+    Convenience function for the 2D functions below: the voxels for which gamma is computed, the target voxels above
+    the threshold, and for local gamma only those with a positive local reference dose (the dose difference scale).
+    """
+    mask = atarget>threshold
+    if local:
+        mask &= aref>0.
+    return mask
+
+def gamma_index_2d(ref,target,dd=3.,dta=3.,ddpercent=True,local=False,threshold=0.,defvalue=-1.,max_gamma=None):
+    """
+    Compare two 2D images with equal geometry (e.g. film or EPID dose planes) using the gamma index formalism.
+    The arguments dd, ddpercent, dta, threshold, defvalue and max_gamma have the same meaning as for `get_gamma_index`.
+    * local (default False): with local gamma, dd is a percentage of the local reference dose, i.e. of the dose in the
+      reference pixel at the position of the target pixel for which the gamma value is computed, instead of a percentage
+      of the maximum dose of the reference image. Target pixels where the reference dose is zero get the "defvalue".
+    The gamma index is computed with `_gamma2_planes`, which compares whole planes with shifted copies of the reference.
+    Returns an image with the same geometry as the target image.
+    For all target pixels that have d>threshold, a gamma index value is given. For all other pixels the "defvalue" is given.
+    If geometries of the input images are not equal, then a `ValueError` is raised.
+    """
+    aref = itk.array_view_from_image(ref).swapaxes(0,1)[np.newaxis]
+    atarget = itk.array_view_from_image(target).swapaxes(0,1)[np.newaxis]
+    if aref.shape != atarget.shape:
+        raise ValueError("input images have different geometries ({} vs {} pixels)".format(aref.shape[1:],atarget.shape[1:]))
+    if not np.allclose(ref.GetSpacing(),target.GetSpacing()):
+        raise ValueError("input images have different geometries ({} vs {} spacing)".format(ref.GetSpacing(),target.GetSpacing()))
+    if not np.allclose(ref.GetOrigin(),target.GetOrigin()):
+        raise ValueError("input images have different geometries ({} vs {} origin)".format(ref.GetOrigin(),target.GetOrigin()))
+    if max_gamma is not None and max_gamma <= 1.:
+        raise ValueError("max_gamma should be larger than 1, got {}".format(max_gamma))
+    mask = _gamma_mask_planes(aref,atarget,threshold,local)
+    g2 = _gamma2_planes(aref,atarget,mask,np.array(ref.GetSpacing(),dtype=float),_gamma_dd_planes(aref,atarget,dd,ddpercent,local),dta,max_gamma)
+    logger.debug("Computed {} gamma values for a 2D image with {} gamma".format(np.sum(mask),"local" if local else "global"))
+    return _gamma_image(g2[0],mask[0],defvalue,target)
+
+def gamma_pass_rates_2d(ref,target,dd=3.,dta=3.,ddpercent=True,local=False,threshold=0.,max_gamma=None,spacing=None):
+    """
+    Compute the gamma pass rate for each plane of a stack of 2D dose planes, in a single call.
+    The `ref` and `target` stacks are 3D images (the planes are the z slices) or numpy arrays with shape (nplanes,ny,nx),
+    with equal geometry. Each target plane is compared with the reference plane with the same index only.
+    The pixel `spacing` (sx,sy) is taken from the images, or should be given for numpy arrays (default 1 by 1).
+    The arguments dd, ddpercent, dta, local, threshold and max_gamma have the same meaning as for `gamma_index_2d`;
+    for global gamma with ddpercent, dd is a percentage of the maximum of each reference plane.
+    All planes are computed together with `_gamma2_planes`, which is much faster than computing them one by one.
+    Returns a dictionary with arrays with one value per plane: "ncomputed", "npass", "nfail", "pass_rate", "gamma_mean"
+    and "gamma_max" (see `gamma_pass_rate`).
+    """
+    if isinstance(ref,np.ndarray):
+        aref, atarget = ref.swapaxes(1,2), np.asarray(target).swapaxes(1,2)
+        spacing = (1.,1.) if spacing is None else spacing
+    else:
+        aref = itk.array_view_from_image(ref).swapaxes(1,2)
+        atarget = itk.array_view_from_image(target).swapaxes(1,2)
+        if spacing is None:
+            spacing = tuple(ref.GetSpacing())[:2]
+    if aref.shape != atarget.shape:
+        raise ValueError("input planes have different geometries ({} vs {} pixels)".format(aref.shape,atarget.shape))
+    if max_gamma is not None and max_gamma <= 1.:
+        raise ValueError("max_gamma should be larger than 1, got {}".format(max_gamma))
+    mask = _gamma_mask_planes(aref,atarget,threshold,local)
+    g2 = _gamma2_planes(aref,atarget,mask,np.array(spacing,dtype=float),_gamma_dd_planes(aref,atarget,dd,ddpercent,local),dta,max_gamma)
+    g = np.sqrt(g2)
+    ncomputed = np.sum(mask,axis=(1,2))
+    npass = np.sum(mask&(g<=1.),axis=(1,2))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return {"ncomputed":ncomputed,
+                "npass":npass,
+                "nfail":ncomputed-npass,
+                "pass_rate":np.where(ncomputed>0,npass/ncomputed,np.nan),
+                "gamma_mean":np.where(ncomputed>0,np.sum(g,axis=(1,2))/ncomputed,np.nan),
+                "gamma_max":np.max(g,axis=(1,2),initial=0.)}
+
+class GammaEvaluator:
+    """
+    Gamma index evaluation of target images w.r.t. a fixed reference image.
+    Everything that only depends on the reference image is done once, when the evaluator is created or
+    when it is first needed: the validation of the arguments, the dose difference scale in absolute units,
+    the reference geometry, the block minimum and maximum of the reference for pruning and the spatial index
+    on the reference voxels (for the "spatial_index" method). Comparing many targets with the same reference
+    (e.g. a series of simulations) is then cheaper than calling `get_gamma_index` for each target.
+    The arguments have the same meaning as for `get_gamma_index`. The `dose_floor` argument can only be used
+    with the "spatial_index" method (see `gamma_index_3d_spatial_index`).
+    Example:
+        evaluator = GammaEvaluator(ref,dd=2.,dta=2.,threshold=0.1)
+        for filename,summary in evaluator.pass_rates(filenames):
+            print(filename,summary["pass_rate"])
+    """
+    methods = ("auto","equal_geometry","unequal_geometry","spatial_index")
+
+    def __init__(self,ref,dd=3.,dta=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,max_gamma=None,n_workers=1,criteria=None,
+                 interp_factor=1,prune_levels=None,prune_margin=0.1,method="auto",dose_floor=None):
+        if method not in self.methods:
+            raise ValueError("unknown gamma index method '{}', should be one of 'auto', 'equal_geometry', 'unequal_geometry' or 'spatial_index'".format(method))
+        if max_gamma is not None and max_gamma <= 1.:
+            raise ValueError("max_gamma should be larger than 1, got {}".format(max_gamma))
+        if interp_factor < 1 or int(interp_factor) != interp_factor:
+            raise ValueError("interp_factor should be a positive integer, got {}".format(interp_factor))
+        if method == "spatial_index" and interp_factor != 1:
+            raise ValueError("interp_factor is not supported by the spatial_index method")
+        if prune_levels is not None and interp_factor != 1:
+            raise ValueError("prune_levels cannot be combined with interp_factor")
+        if dose_floor is not None and method != "spatial_index":
+            raise ValueError("dose_floor is only supported by the spatial_index method")
+        self.ref = ref
+        self.aref = itk.array_view_from_image(ref).swapaxes(0,2)
+        dd, dta = _gamma_criteria(dd,dta,criteria)
+        if ddpercent:
+            dd = dd*(0.01*np.max(self.aref))
+        self.dd, self.dta, self.criteria = dd, dta, criteria
+        self.threshold, self.defvalue, self.verbose = threshold, defvalue, verbose
+        self.max_gamma, self.n_workers, self.interp_factor = max_gamma, n_workers, interp_factor
+        self.prune_levels, self.prune_margin = prune_levels, prune_margin
+        self.method, self.dose_floor = method, dose_floor
+        self.refgeometry = (np.array(ref.GetOrigin(),dtype=float),np.array(ref.GetSpacing(),dtype=float))
+        # caches, filled when needed
+        self._minmax = {}
+        self._index = None
+
+    def _target_method(self,target):
+        """
+        The method that is used for `target`: "auto" is resolved with the geometry of the target.
+        """
+        if self.method != "auto":
+            return self.method
+        return "equal_geometry" if _have_equal_geometry(self.ref,target) else "unequal_geometry"
+
+    def _engine(self,method,targetgeometry,serial=True):
+        """
+        Returns the engine function for `method` and the keyword arguments for it (except verbose and zrange).
+        The spatial index is only shared with serial computations (for parallel computations each worker indexes the reference itself).
+        """
+        kwargs = dict(dd=self.dd,dta=self.dta,max_gamma=self.max_gamma)
+        if method == "equal_geometry":
+            return _gamma2_equal_geometry, dict(spacing=self.refgeometry[1],interp_factor=self.interp_factor,**kwargs)
+        kwargs.update(refgeometry=self.refgeometry,targetgeometry=targetgeometry)
+        if method == "unequal_geometry":
+            return _gamma2_unequal_geometry, dict(interp_factor=self.interp_factor,**kwargs)
+        if serial:
+            if self._index is None:
+                logger.debug("indexing the reference voxels")
+                if np.ndim(self.dd) > 0:
+                    self._index = [_reference_index(self.aref,self.refgeometry,ddc,dtac,self.dose_floor) for ddc,dtac in zip(self.dd,self.dta)]
+                else:
+                    self._index = _reference_index(self.aref,self.refgeometry,self.dd,self.dta,self.dose_floor)
+            kwargs.update(index=self._index)
+        return _gamma2_spatial_index, dict(dose_floor=self.dose_floor,**kwargs)
+
+    def _gamma2(self,method,atarget,targetgeometry,mask):
+        """
+        Compute the squared gamma index for the target voxels in `mask` (with pruning and/or in parallel, if requested).
+        """
+        def compute(mask):
+            if self.n_workers > 1 and not _parallel_available():
+                logger.warning("the parallel gamma computation requires python 3.8 or newer, using a single process")
+                self.n_workers = 1
+            if self.n_workers > 1:
+                engine, kwargs = self._engine(method,targetgeometry,serial=False)
+                return _gamma2_parallel(engine,self.aref,atarget,mask,self.n_workers,self.verbose,**kwargs)
+            engine, kwargs = self._engine(method,targetgeometry)
+            return engine(self.aref,atarget,mask,verbose=self.verbose,**kwargs)
+        if self.prune_levels is None:
+            return compute(mask)
+        g2, report = _gamma2_pruned(compute,self.aref,atarget,mask,self.refgeometry,targetgeometry,self.dd,self.dta,
+                                    self.prune_levels,self.prune_margin,self.max_gamma,self._minmax)
+        return g2
+
+    def _dummy(self,target):
+        """
+        Gamma image(s) with only the default value, for targets without any voxel to compute.
+        """
+        atarget = itk.array_view_from_image(target).swapaxes(0,2)
+        dummy = _gamma_image(np.ones(atarget.shape),np.zeros(atarget.shape,dtype=bool),self.defvalue,target)
+        return dummy if self.criteria is None else [dummy]+[itk.image_duplicator(dummy) for c in self.dd[1:]]
+
+    def evaluate(self,target,roi_mask=None):
+        """
+        Compute the gamma index of the `target` image w.r.t. the reference image.
+        If `roi_mask` is given, then only the target voxels inside the mask are computed (see `get_gamma_index`).
+        Returns an image with the same geometry as the target image (a list with one image per criterion if criteria is given).
+        For all target voxels in the overlap with the reference image that have a dose larger than the threshold,
+        a gamma index value is given. For all other voxels the "defvalue" is given.
+        With the "equal_geometry" method, a `ValueError` is raised if the geometries of the images are not equal.
+        """
+        method = self._target_method(target)
+        aref = self.aref
+        atarget = itk.array_view_from_image(target).swapaxes(0,2)
+        if method == "equal_geometry":
+            logger.debug("Images with equal geometry, using the faster implementation.")
+            if aref.shape != atarget.shape:
+                raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
+            if not np.allclose(self.ref.GetSpacing(),target.GetSpacing()):
+                raise ValueError("input images have different geometries ({} vs {} spacing)".format(self.ref.GetSpacing(),target.GetSpacing()))
+            if not np.allclose(self.ref.GetOrigin(),target.GetOrigin()):
+                raise ValueError("input images have different geometries ({} vs {} origin)".format(self.ref.GetOrigin(),target.GetOrigin()))
+            targetgeometry = self.refgeometry
+            mask = atarget>self.threshold
+            if roi_mask is not None:
+                mask &= _target_mask(roi_mask,target)
+            nx,ny,nz = atarget.shape
+            nmask = np.sum(mask)
+            logger.debug("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,nx*ny*nz))
+            logger.debug("{} target voxels have a dose > {}.".format(nmask,self.threshold))
+        else:
+            logger.debug("Using the {} method.".format(method))
+            # test consistency: both must be 3D
+            # it would be cool to make this for 2D as well (and D>3), but not now
+            if len(aref.shape) != 3 or len(atarget.shape) != 3:
+                return None
+            targetgeometry = (np.array(target.GetOrigin(),dtype=float),np.array(target.GetSpacing(),dtype=float))
+            mask = atarget>self.threshold
+            if roi_mask is not None:
+                mask &= _target_mask(roi_mask,target)
+            if np.sum(mask) == 0:
+                logger.error("target has no dose over threshold{}.".format("" if roi_mask is None else " in the ROI"))
+                return self._dummy(target)
+            # keep within range
+            iref, inside = _nearest_indices(self.refgeometry,targetgeometry,aref.shape,atarget.shape)
+            overlap = inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,:]
+            mask *= overlap
+            nmask = np.sum(mask)
+            if nmask == 0:
+                logger.error("images do not seem to overlap.")
+                return self._dummy(target)
+            nx,ny,nz = atarget.shape
+            mx,my,mz = aref.shape
+            logger.debug("Reference image has {} x {} x {} = {} voxels.".format(mx,my,mz,mx*my*mz))
+            logger.debug("Target image has {} x {} x {} = {} voxels.".format(nx,ny,nz,nx*ny*nz))
+            logger.debug("{} target voxels are in the intersection of target and reference image.".format(np.sum(overlap)))
+            logger.debug("{} of these have dose > {}.".format(nmask,self.threshold))
+        g2 = self._gamma2(method,atarget,targetgeometry,mask)
+        logger.debug("Computed {} gamma values with the {} method".format(nmask,method))
+        if self.criteria is None:
+            return _gamma_image(g2,mask,self.defvalue,target)
+        return [_gamma_image(g2c,mask,self.defvalue,target) for g2c in g2]
+
+    def pass_rate(self,target,nbins=50,chunk_size=2**22,rois=None):
+        """
+        Compute the gamma index pass rate of the `target` image w.r.t. the reference image, without creating gamma images.
+        The target image is processed in slabs along z of at most `chunk_size` voxels, in a single process.
+        See `gamma_pass_rate` for the histogram and the returned summary (a list of summaries if criteria is given),
+        and for the pass rates in regions of interest with `rois`.
+        Pruning is not supported here, a `ValueError` is raised if the evaluator was created with prune_levels.
+        """
+        if self.prune_levels is not None:
+            raise ValueError("prune_levels is not supported for the gamma pass rate")
+        method = self._target_method(target)
+        aref = self.aref
+        atarget = itk.array_view_from_image(target).swapaxes(0,2)
+        ncrit = 1 if self.criteria is None else len(self.dd)
+        if method == "equal_geometry":
+            targetgeometry = self.refgeometry
+        else:
+            targetgeometry = (np.array(target.GetOrigin(),dtype=float),np.array(target.GetSpacing(),dtype=float))
+            iref, inside = _nearest_indices(self.refgeometry,targetgeometry,aref.shape,atarget.shape)
+        # regions for which the pass rate is computed: all voxels, or each of the ROIs (the voxels in their union are computed)
+        regions = [None] if rois is None else [_target_mask(roi_mask,target) for roi_mask in rois.values()]
+        union = None if rois is None else np.logical_or.reduce(regions+[np.zeros(atarget.shape,dtype=bool)])
+        nreg = len(regions)
+        engine, kwargs = self._engine(method,targetgeometry)
+        nx,ny,nz = atarget.shape
+        nslices = max(1,chunk_size//(nx*ny))
+        hmax = 2. if self.max_gamma is None else self.max_gamma
+        bin_edges = np.linspace(0.,hmax,nbins+1)
+        ncomputed = np.zeros(nreg,dtype=int)
+        histogram = np.zeros((nreg,ncrit,nbins),dtype=int)
+        npass, gsum, gmax = np.zeros((nreg,ncrit),dtype=int), np.zeros((nreg,ncrit)), np.zeros((nreg,ncrit))
+        failing = [[[np.zeros((0,3),dtype=int)] for c in range(ncrit)] for r in range(nreg)]
+        failing_gamma = [[[np.zeros(0,dtype=np.float32)] for c in range(ncrit)] for r in range(nreg)]
+        logger.debug("computing gamma pass rate in slabs of {} slices with the {} method".format(nslices,method))
+        if self.verbose:
+            pbar = tqdm(total=nz, leave=False)
+        for z0 in range(0,nz,nslices):
+            z1 = min(z0+nslices,nz)
+            mask = atarget[:,:,z0:z1]>self.threshold
+            if method != "equal_geometry":
+                mask *= inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,z0:z1]
+            if union is not None:
+                mask &= union[:,:,z0:z1]
+            g2 = engine(aref,atarget,mask,zrange=(z0,z1),**kwargs).reshape((ncrit,)+mask.shape)
+            # the computed voxels, in the order of the ITK voxel index
+            mask_itk = mask.swapaxes(0,2)
+            ijk = np.argwhere(mask_itk)[:,::-1]+(0,0,z0)
+            for r,region in enumerate(regions):
+                inregion = slice(None) if region is None else region[:,:,z0:z1].swapaxes(0,2)[mask_itk]
+                ncomputed[r] += len(ijk[inregion])
+                for c in range(ncrit):
+                    # same precision as the gamma images
+                    g = np.sqrt(g2[c].swapaxes(0,2)[mask_itk][inregion]).astype(np.float32)
+                    fail = g>1.
+                    npass[r,c] += len(g)-np.sum(fail)
+                    gsum[r,c] += np.sum(g,dtype=float)
+                    gmax[r,c] = max(gmax[r,c],float(np.max(g,initial=0.)))
+                    histogram[r,c] += np.histogram(np.minimum(g,hmax),bins=bin_edges)[0]
+                    failing[r][c].append(ijk[inregion][fail])
+                    failing_gamma[r][c].append(g[fail])
+            if self.verbose:
+                pbar.update(z1-z0)
+        if self.verbose:
+            pbar.close()
+        logger.debug("{} out of {} voxels pass".format(npass,ncomputed))
+        summaries = [[{"ncomputed":ncomputed[r],
+                       "npass":npass[r,c],
+                       "nfail":ncomputed[r]-npass[r,c],
+                       "pass_rate":npass[r,c]/ncomputed[r] if ncomputed[r]>0 else np.nan,
+                       "gamma_mean":gsum[r,c]/ncomputed[r] if ncomputed[r]>0 else np.nan,
+                       "gamma_max":gmax[r,c],
+                       "histogram":histogram[r,c],
+                       "bin_edges":bin_edges,
+                       "failing":np.concatenate(failing[r][c]),
+                       "failing_gamma":np.concatenate(failing_gamma[r][c])} for c in range(ncrit)] for r in range(nreg)]
+        if self.criteria is None:
+            summaries = [sr[0] for sr in summaries]
+        return summaries[0] if rois is None else dict(zip(rois,summaries))
+
+    def pass_rates(self,targets,nbins=50,chunk_size=2**22,prefetch=1,rois=None):
+        """
+        Compute the gamma pass rate (see `pass_rate`, also for `rois`) for each of the `targets`, which can be images or file names.
+        File names are read with `itk.imread` in a background thread, `prefetch` images ahead, so that reading
+        the next targets overlaps with the computation for the current one.
+        Yields a (target,summary) tuple for each target, in the order of `targets`.
+        """
+        targets = list(targets)
+        def read(target):
+            return itk.imread(target) if isinstance(target,str) else target
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+            pending = collections.deque(reader.submit(read,t) for t in targets[:max(1,prefetch)])
+            for i,target in enumerate(targets):
+                img = pending.popleft().result()
+                if i+len(pending)+1 < len(targets):
+                    pending.append(reader.submit(read,targets[i+len(pending)+1]))
+                logger.debug("gamma pass rate for target {}".format(target))
+                yield target, self.pass_rate(img,nbins=nbins,chunk_size=chunk_size,rois=rois)
+                del img
+
+def _nearest_indices(refgeometry,targetgeometry,refshape,targetshape):
+    """
+    For each axis, compute the indices of the reference voxel centers that are closest to the target voxel centers.
+    The geometries are given as (origin,spacing) tuples.
+    Since the meshes are not rotated w.r.t. each other, this can be done separately for each axis.
+    Returns a list with an integer array per axis and a list with a boolean array per axis,
+    the latter indicating whether the index is within the range of the reference image.
+    """
+    iref, inside = [], []
+    for oref,sref,nref,otarget,starget,ntarget in zip(*refgeometry,refshape,*targetgeometry,targetshape):
+        i = np.round((otarget+np.arange(ntarget)*starget-oref)/sref).astype(int)
+        iref.append(i)
+        inside.append((i>=0)*(i<nref))
+    return iref, inside
+
+def _gamma2_unequal_geometry(aref,atarget,mask,refgeometry,targetgeometry,dd,dta,verbose=False,max_gamma=None,zrange=None,interp_factor=1):
+    """
+    Compute the squared gamma index for all voxels in `mask`, for reference and target arrays with different geometry.
+    The geometries are given as (origin,spacing) tuples and `mask` should only contain voxels in the overlap.
+    If `dd` and `dta` are sequences of equal length, then the squared gamma index is computed for each (dd,dta)
+    criterion. The mapping to the reference mesh and the reference neighbourhood of each voxel are then shared by all criteria.
+    If `zrange=(z0,z1)` is given, then only the target slab `atarget[:,:,z0:z1]` is computed and `mask`
+    should have the shape of that slab.
+    If `interp_factor` is larger than 1, then the search box of each voxel is taken on a virtual reference grid
+    that is `interp_factor` times finer, which is interpolated trilinearly from the reference voxels in the box.
+    Returns an array with the shape of `mask` (with shape `(n,)+mask.shape` for n criteria), zero for voxels outside of the mask.
+    The array has the memory layout of ITK images (see `_native_zeros`), and is float32 unless the inputs have a higher precision.
+    """
+    multi = np.ndim(dd) > 0
+    dd = np.atleast_1d(np.asarray(dd,dtype=float))
+    dta = np.atleast_1d(np.asarray(dta,dtype=float))
+    ncrit = len(dd)
+    z0, z1 = (0,atarget.shape[2]) if zrange is None else zrange
+    areforigin, arefspacing = refgeometry
+    atargetorigin, atargetspacing = targetgeometry
+    # virtual fine grid (the same as the reference grid if interp_factor is 1)
+    finespacing = arefspacing/interp_factor
+    fineshape = [(n-1)*interp_factor+1 for n in aref.shape]
     dta2  = dta**2
-    mask  = atarget>threshold
-    nmask=np.sum(mask)
-    if nmask==0:
-        logger.error("target has no dose over threshold.")
-        dummy = itk.image_from_array((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
-        dummy.CopyInformation(imgtarget)
-        return dummy
-    # now define the indices of the target image voxel centers
-    ixtarget, iytarget, iztarget = np.meshgrid(np.arange(nx),np.arange(ny),np.arange(nz),indexing='ij')
-    xtarget = atargetorigin[0]+ixtarget*atargetspacing[0]
-    ytarget = atargetorigin[1]+iytarget*atargetspacing[1]
-    ztarget = atargetorigin[2]+iztarget*atargetspacing[2]
-    # indices ref image voxel centers that are closest to the target image voxel centers
-    ixref = np.round((xtarget-areforigin[0])/arefspacing[0]).astype(int)
-    iyref = np.round((ytarget-areforigin[1])/arefspacing[1]).astype(int)
-    izref = np.round((ztarget-areforigin[2])/arefspacing[2]).astype(int)
-    # keep within range
-    overlap = (ixref>=0)*(iyref>=0)*(izref>=0)*(ixref<mx)*(iyref<my)*(izref<mz)
-    mask *= overlap
-    noverlap = np.sum(overlap)
-    nmask=np.sum(mask)
-    if nmask==0:
-        logger.error("images do not seem to overlap.")
-        dummy = itk.image_from_array((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
-        dummy.CopyInformation(imgtarget)
-        return dummy
-    logger.debug("Reference image has {} x {} x {} = {} voxels.".format(mx,my,mz,mtot))
-    logger.debug("Target image has {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
-    logger.debug("{} target voxels are in the intersection of target and reference image.".format(noverlap))
-    logger.debug("{} of these have dose > {}.".format(nmask,threshold))
+    iref, inside = _nearest_indices(refgeometry,targetgeometry,aref.shape,atarget.shape)
+    g2 = _native_zeros((ncrit,)+mask.shape,_float_type(aref,atarget))
     if verbose:
-        pbar = tqdm(total=nmask, leave=False)
-    # grid of "close points" in reference image
-    xref = areforigin[0]+ixref*arefspacing[0]
-    yref = areforigin[1]+iyref*arefspacing[1]
-    zref = areforigin[2]+izref*arefspacing[2]
-    # get a gamma value on this closest point
-    gclose2 = np.zeros([nx,ny,nz],dtype=float)
-    gclose2[mask] = _reldiff2(aref[ixref[mask],iyref[mask],izref[mask]],atarget[mask],dd) + \
-                                              ((xtarget[mask]-xref[mask])**2 + \
-                                               (ytarget[mask]-yref[mask])**2 + \
-                                               (ztarget[mask]-zref[mask])**2)/dta2
-    gclose = np.array(np.sqrt(gclose2))
-    #igclose = np.array(np.ceil(np.sqrt(gclose2)),dtype=int)
-    g2=np.zeros([nx,ny,nz],dtype=float)
-    #print("going to loop over {} voxels with large enough dose in reference image".format(np.sum(mask)))
-    for mixref,miyref,mizref,mixtarget,miytarget,miztarget,mgclose in zip(ixref[mask], iyref[mask], izref[mask],
-                                                                    ixtarget[mask],iytarget[mask],iztarget[mask],gclose[mask]):
-        #dtarget = atarget[mixtarget,miytarget,miztarget]
-        #dref = aref[mixref,miyref,mizref]
-        ixyztarget = np.array((mixtarget,miytarget,miztarget))
-        ixyzref = np.array((mixref,miyref,mizref))
-        targetpos = atargetorigin + ixyztarget*atargetspacing
-        refpos = areforigin  + ixyzref*arefspacing
-        dixyz = np.floor(mgclose*dta/arefspacing).astype(int) # or round, or ceil?
-        imax = np.minimum(ixyzref+dixyz+1,(mx,my,mz))
-        imin = np.maximum(ixyzref-dixyz  ,( 0, 0, 0))
-        mixnear,miynear,miznear = np.meshgrid(np.arange(imin[0],imax[0]),
-                                              np.arange(imin[1],imax[1]),
-                                              np.arange(imin[2],imax[2]),
-                                              indexing='ij')
-        g2near  = _reldiff2(aref[mixnear,miynear,miznear],atarget[mixtarget,miytarget,miztarget],dd)
-        g2near += (areforigin[0]+mixnear*arefspacing[0]-targetpos[0])**2/dta2
-        g2near += (areforigin[1]+miynear*arefspacing[1]-targetpos[1])**2/dta2
-        g2near += (areforigin[2]+miznear*arefspacing[2]-targetpos[2])**2/dta2
-        g2[mixtarget,miytarget,miztarget] = np.min(g2near)
+        pbar = tqdm(total=np.sum(mask), leave=False)
+    # the target voxels are processed in slabs along z, to limit the size of the per-voxel arrays
+    nslices = max(1,2**20//(mask.shape[0]*mask.shape[1]))
+    for s0 in range(0,mask.shape[2],nslices):
+        s1 = min(s0+nslices,mask.shape[2])
+        # indices of the target voxels to compute, and of the ref image voxel centers that are closest to them
+        ixtarget, iytarget, iztarget = np.nonzero(mask[:,:,s0:s1])
+        iztarget += z0+s0
+        ixref, iyref, izref = iref[0][ixtarget], iref[1][iytarget], iref[2][iztarget]
+        xtarget = atargetorigin[0]+ixtarget*atargetspacing[0]
+        ytarget = atargetorigin[1]+iytarget*atargetspacing[1]
+        ztarget = atargetorigin[2]+iztarget*atargetspacing[2]
+        xref = areforigin[0]+ixref*arefspacing[0]
+        yref = areforigin[1]+iyref*arefspacing[1]
+        zref = areforigin[2]+izref*arefspacing[2]
+        dtarget = atarget[ixtarget,iytarget,iztarget]
+        # get a gamma value on this closest point
+        dclose = aref[ixref,iyref,izref]
+        rclose2 = (xtarget-xref)**2 + (ytarget-yref)**2 + (ztarget-zref)**2
+        gclose2 = np.array([_reldiff2(dclose,dtarget,dd[c]) + rclose2/dta2[c] for c in range(ncrit)]).reshape(ncrit,-1)
+        gclose = np.sqrt(gclose2)
+        g2mask = np.copy(gclose2)
+        if max_gamma is None:
+            search = np.ones(gclose2.shape,dtype=bool)
+        else:
+            # voxels that already pass on the closest point are done, the others get a limited search radius
+            search = gclose2>1.
+            np.minimum(gclose,max_gamma,out=gclose)
+            logger.debug("{} voxels need a search with radius up to {}*dta.".format(np.sum(np.any(search,axis=0)),max_gamma))
+        isearch = np.nonzero(np.any(search,axis=0))[0]
         if verbose:
-            pbar.update(1)
-    g=np.sqrt(g2)
-    g[np.logical_not(mask)]=defvalue
-    # ITK does not support double precision images by default => cast down to float32.
-    # Also: only the first few digits of gamma index values are interesting.
-    gimg=itk.image_from_array(g.swapaxes(0,2).astype(np.float32).copy())
-    gimg.CopyInformation(imgtarget)
-    logger.debug(f"Computed {nmask} gamma values assuming UNEQUAL geometry in target and reference")
-    return gimg
+            pbar.update(len(ixtarget)-len(isearch))
+        for i in isearch:
+            ixyztarget = np.array((ixtarget[i],iytarget[i],iztarget[i]))
+            ixyzref = np.array((ixref[i],iyref[i],izref[i]))
+            targetpos = atargetorigin + ixyztarget*atargetspacing
+            # search box for each criterion, the reference neighbourhood is read once for the largest box
+            crits = np.nonzero(search[:,i])[0]
+            ifine = ixyzref*interp_factor
+            dixyz = [np.floor(gclose[c,i]*dta[c]/finespacing).astype(int) for c in crits] # or round, or ceil?
+            imax = [np.minimum(ifine+d+1,fineshape) for d in dixyz]
+            imin = [np.maximum(ifine-d  ,(0,0,0)) for d in dixyz]
+            imaxall, iminall = np.max(imax,axis=0), np.min(imin,axis=0)
+            mixnear,miynear,miznear = np.meshgrid(np.arange(iminall[0],imaxall[0]),
+                                                  np.arange(iminall[1],imaxall[1]),
+                                                  np.arange(iminall[2],imaxall[2]),
+                                                  indexing='ij')
+            dnear = _interpolate_box(aref,iminall,imaxall,interp_factor)
+            dx2 = (areforigin[0]+mixnear*finespacing[0]-targetpos[0])**2
+            dy2 = (areforigin[1]+miynear*finespacing[1]-targetpos[1])**2
+            dz2 = (areforigin[2]+miznear*finespacing[2]-targetpos[2])**2
+            for c,i0,i1 in zip(crits,imin,imax):
+                near = tuple(slice(j0,j1) for j0,j1 in zip(i0-iminall,i1-iminall))
+                g2near  = _reldiff2(dnear[near],dtarget[i],dd[c])
+                g2near += dx2[near]/dta2[c]
+                g2near += dy2[near]/dta2[c]
+                g2near += dz2[near]/dta2[c]
+                g2mask[c,i] = np.min(g2near)
+            if verbose:
+                pbar.update(1)
+        if max_gamma is not None:
+            np.minimum(g2mask,max_gamma**2,out=g2mask)
+        for c in range(ncrit):
+            g2[c][:,:,s0:s1][mask[:,:,s0:s1]] = g2mask[c]
+    if verbose:
+        pbar.close()
+    return g2 if multi else g2[0]
+
+def _chebyshev_ring(s,ndim):
+    """
+    Returns the integer offsets in `ndim` dimensions with a maximum norm equal to `s`, as an (n,ndim) array.
+    """
+    o = np.stack(np.meshgrid(*[np.arange(-s,s+1)]*ndim,indexing='ij'),axis=-1).reshape(-1,ndim)
+    return o[np.max(np.abs(o),axis=1)==s]
+
+def _cell_index(points):
+    """
+    Index the `points` (given as an (n,ndim) array) in a grid of cells of size 1, for `_nearest_distance2`.
+    Returns a tuple with the points sorted by cell, the lower corner and the number of cells of the grid,
+    and the sorted keys of the non-empty cells with the start and the number of their points.
+    """
+    if len(points) == 0:
+        return points, None, None, None, None, None
+    cmin = np.floor(np.min(points,axis=0)).astype(np.int64)
+    ncells = np.floor(np.max(points,axis=0)).astype(np.int64)-cmin+1
+    # cell coordinates one axis at a time, to avoid (n,ndim) integer temporaries
+    keys = np.ravel_multi_index(tuple(np.floor(points[:,d]).astype(np.int64)-cmin[d] for d in range(points.shape[1])),ncells)
+    order = np.argsort(keys,kind='stable')
+    ukeys, starts, counts = np.unique(keys[order],return_index=True,return_counts=True)
+    return points[order], cmin, ncells, ukeys, starts, counts
+
+def _nearest_distance2(index,queries,dmax=None,dpass=0.,verbose=False):
+    """
+    Squared distance from each of the `queries` (given as an (n,ndim) array) to the nearest of the points in `index`
+    (see `_cell_index`). All queries are answered together, visiting the cells in rings of increasing distance around the
+    cell of the query. The search for a query stops when the nearest point found so far is closer than the
+    rings that were not visited yet, when it is closer than `dpass`, or when the rings are further than `dmax`.
+    Returns an array with the squared distances, infinite if no point was found.
+    """
+    points, cmin, ncells, ukeys, starts, counts = index
+    ndim = points.shape[1]
+    best2 = np.full(len(queries),np.inf)
+    if len(points) == 0:
+        return best2
+    cqueries = np.floor(queries).astype(np.int64)-cmin
+    # beyond this ring there are no more cells with points
+    smax = np.max(np.maximum(cqueries,ncells-1-cqueries),axis=1)
+    todo = np.arange(len(queries))
+    if verbose:
+        pbar = tqdm(total=len(queries), leave=False)
+    s = 0
+    while len(todo) > 0:
+        ring = _chebyshev_ring(s,ndim)
+        nchunk = max(1,2**20//len(ring))
+        for i0 in range(0,len(todo),nchunk):
+            t = todo[i0:i0+nchunk]
+            cells = cqueries[t][:,np.newaxis,:]+ring[np.newaxis,:,:]
+            it, ir = np.nonzero(np.all((cells>=0)&(cells<ncells),axis=2))
+            ckeys = np.ravel_multi_index(tuple(cells[it,ir].T),ncells)
+            pos = np.minimum(np.searchsorted(ukeys,ckeys),len(ukeys)-1)
+            found = ukeys[pos]==ckeys
+            it, pos = it[found], pos[found]
+            # all points in the found cells, with the query they are compared with, in batches of at most 2**22 pairs
+            ncum = np.cumsum(counts[pos])
+            bounds = np.concatenate(([0],np.searchsorted(ncum,np.arange(2**22,ncum[-1] if len(ncum)>0 else 0,2**22),side='right'),[len(pos)]))
+            for b0,b1 in zip(bounds[:-1],bounds[1:]):
+                if b1 <= b0:
+                    continue
+                n = counts[pos[b0:b1]]
+                iq = np.repeat(t[it[b0:b1]],n)
+                ip = np.arange(np.sum(n)) + np.repeat(starts[pos[b0:b1]]-np.cumsum(n)+n,n)
+                d2 = np.sum((queries[iq]-points[ip])**2,axis=1)
+                np.minimum.at(best2,iq,d2)
+        # the points that were not visited yet have a distance of at least s
+        s += 1
+        done = (best2[todo]<=max(s-1,dpass)**2) | (s>smax[todo])
+        if dmax is not None:
+            done |= s-1 >= dmax
+        todo = todo[np.logical_not(done)]
+        if verbose:
+            pbar.update(np.sum(done))
+    if verbose:
+        pbar.close()
+    return best2
+
+def _reference_index(aref,refgeometry,dd,dta,dose_floor=None):
+    """
+    Spatial index for `_gamma2_spatial_index`: the reference voxels (with a dose larger than `dose_floor`, if given)
+    as points with scaled coordinates (x/dta,y/dta,z/dta,dose/dd), indexed with `_cell_index`.
+    """
+    areforigin, arefspacing = refgeometry
+    iref = np.nonzero(np.ones(aref.shape,dtype=bool) if dose_floor is None else aref>dose_floor)
+    points = np.stack([(o+i*s)/dta for o,i,s in zip(areforigin,iref,arefspacing)]+[aref[iref]/dd],axis=1)
+    return _cell_index(points)
+
+def _gamma2_spatial_index(aref,atarget,mask,refgeometry,targetgeometry,dd,dta,verbose=False,max_gamma=None,zrange=None,dose_floor=None,index=None):
+    """
+    Compute the squared gamma index for all voxels in `mask`, using a spatial index on the reference voxels.
+    The reference voxels (with a dose larger than `dose_floor`, if given) and the target voxels are represented
+    as points with scaled coordinates (x/dta,y/dta,z/dta,dose/dd), so that the squared gamma index of a target
+    voxel is the squared distance to the nearest reference point (see `_nearest_distance2`).
+    The geometries are given as (origin,spacing) tuples and `mask` should only contain voxels in the overlap.
+    If `dd` and `dta` are sequences of equal length, then the squared gamma index is computed for each (dd,dta)
+    criterion, with a separate index for each criterion (the scaled coordinates depend on the criterion).
+    If `max_gamma` is given, then the search stops at a distance of `max_gamma` or as soon as the voxel passes,
+    and gamma values larger than `max_gamma` are set to `max_gamma`.
+    If `zrange=(z0,z1)` is given, then only the target slab `atarget[:,:,z0:z1]` is computed and `mask`
+    should have the shape of that slab.
+    The `index` (see `_reference_index`, a list with one index per criterion for several criteria) only depends on
+    the reference, and can be given to reuse it for several targets. By default it is computed here.
+    Returns an array with the shape of `mask` (with shape `(n,)+mask.shape` for n criteria), zero for voxels outside of the mask.
+    The array has the memory layout of ITK images (see `_native_zeros`), and is float32 unless the inputs have a higher precision.
+    """
+    if np.ndim(dd) > 0:
+        indices = [None]*len(dd) if index is None else index
+        g2 = _native_zeros((len(dd),)+mask.shape,_float_type(aref,atarget))
+        for g2c,ddc,dtac,indexc in zip(g2,dd,dta,indices):
+            g2c[...] = _gamma2_spatial_index(aref,atarget,mask,refgeometry,targetgeometry,ddc,dtac,verbose,max_gamma,zrange,dose_floor,indexc)
+        return g2
+    z0, z1 = (0,atarget.shape[2]) if zrange is None else zrange
+    atargetorigin, atargetspacing = targetgeometry
+    if index is None:
+        index = _reference_index(aref,refgeometry,dd,dta,dose_floor)
+    logger.debug("spatial index with {} reference points for {} target voxels".format(len(index[0]),np.sum(mask)))
+    g2 = _native_zeros(mask.shape,_float_type(aref,atarget))
+    # the queries are made in slabs along z, to limit the size of the per-voxel arrays
+    nslices = max(1,2**20//(mask.shape[0]*mask.shape[1]))
+    for s0 in range(0,mask.shape[2],nslices):
+        s1 = min(s0+nslices,mask.shape[2])
+        itarget = np.nonzero(mask[:,:,s0:s1])
+        itarget = (itarget[0],itarget[1],itarget[2]+z0+s0)
+        queries = np.stack([(o+i*s)/dta for o,i,s in zip(atargetorigin,itarget,atargetspacing)]+[atarget[itarget]/dd],axis=1)
+        g2mask = _nearest_distance2(index,queries,dmax=max_gamma,dpass=0. if max_gamma is None else 1.,verbose=verbose)
+        if max_gamma is not None:
+            np.minimum(g2mask,max_gamma**2,out=g2mask)
+        g2[:,:,s0:s1][mask[:,:,s0:s1]] = g2mask
+    return g2
+
+def _parallel_available():
+    """
+    Helper function: `_gamma2_parallel` needs multiprocessing.shared_memory (python 3.8 or newer).
+    """
+    return sys.version_info >= (3, 8)
+
+def _gamma2_slab(task):
+    """
+    Worker function for `_gamma2_parallel`: compute the squared gamma index for one slab.
+    """
+    from multiprocessing import shared_memory # python >= 3.8
+    engine,shared,z0,z1,kwargs = task
+    shms = [shared_memory.SharedMemory(name=name) for name,shape,dtype in shared]
+    try:
+        aref,atarget,mask,g2 = [np.ndarray(shape,dtype=dtype,buffer=shm.buf).swapaxes(-3,-1)
+                                for shm,(name,shape,dtype) in zip(shms,shared)]
+        g2[...,z0:z1] = engine(aref,atarget,mask[:,:,z0:z1],zrange=(z0,z1),**kwargs)
+        del aref,atarget,mask,g2
+    finally:
+        for shm in shms:
+            shm.close()
+    return z1-z0
+
+def _gamma2_parallel(engine,aref,atarget,mask,n_workers,verbose=False,**kwargs):
+    """
+    Compute the squared gamma index with `n_workers` processes, by splitting the target in slabs along z.
+    The `engine` is `_gamma2_equal_geometry` or `_gamma2_unequal_geometry`, the keyword arguments are passed on.
+    The workers compute the target voxels in their slab, and read the reference voxels in a halo around
+    the slab (as wide as the search radius) directly from the shared reference array.
+    The input arrays are shared with the worker processes through shared memory (instead of pickled copies),
+    and each worker writes its slab of the result directly into a shared output array.
+    The result is identical to the result of the serial computation (also for several criteria).
+    """
+    from multiprocessing import shared_memory # python >= 3.8
+    nz = atarget.shape[2]
+    nslabs = min(nz,4*n_workers)
+    zbounds = np.linspace(0,nz,nslabs+1).astype(int)
+    # shared memory: use the native ITK (z,y,x) layout, so that z-slabs are contiguous
+    g2 = _native_zeros(np.shape(kwargs["dd"])+atarget.shape,_float_type(aref,atarget))
+    arrays = [a.swapaxes(-3,-1) for a in (aref,atarget,mask,g2)]
+    shms, shared = [], []
+    try:
+        for a in arrays:
+            shm = shared_memory.SharedMemory(create=True,size=max(a.nbytes,1))
+            shms.append(shm)
+            np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf)[...] = a
+            shared.append((shm.name,a.shape,a.dtype))
+        tasks = [(engine,shared,z0,z1,kwargs) for z0,z1 in zip(zbounds[:-1],zbounds[1:]) if z1>z0]
+        logger.debug("computing gamma in {} slabs with {} processes".format(len(tasks),n_workers))
+        if verbose:
+            pbar = tqdm(total=nz, leave=False)
+        with multiprocessing.Pool(n_workers) as pool:
+            for nslices in pool.imap_unordered(_gamma2_slab,tasks):
+                if verbose:
+                    pbar.update(nslices)
+        if verbose:
+            pbar.close()
+        g2[...] = np.ndarray(arrays[3].shape,dtype=g2.dtype,buffer=shms[3].buf).swapaxes(-3,-1)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return g2
 
 #####################################################################################
 # TODO: include the unit test in implementation (like here), or have it in a separate test directory?
 #####################################################################################
 import unittest
 import os,sys
+import tempfile
+import tracemalloc
 from datetime import datetime
 from .logging_conf import LoggedTestCase
 
@@ -283,11 +1390,31 @@ class Test_GammaIndex3dIdenticalMesh(LoggedTestCase):
         self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma_odd_even),itk.array_view_from_image(img_gamma_even_odd)))
         self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma_odd_even),0.5))
         logger.debug("DONE test checkerboards")
+    def test_brute_force(self):
+        # compare with the minimum over *all* reference voxels, computed by brute force
+        logger.debug('Test_GammaIndex3dIdenticalMesh test_brute_force')
+        np.random.seed(1234570)
+        nx,ny,nz=6,7,8
+        sxyz=np.random.uniform(0.5,2.5,3)
+        a_ref = np.random.uniform(0.,10.,(nx,ny,nz))
+        a_target = a_ref*np.random.normal(1.,0.2,(nx,ny,nz))
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_ref.SetSpacing(sxyz)
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        img_target.SetSpacing(sxyz)
+        ddp,dta=3.,2.
+        img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=ddp,dta=dta)
+        agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
+        ix,iy,iz = np.meshgrid(np.arange(nx),np.arange(ny),np.arange(nz),indexing='ij')
+        pos = np.stack((ix.ravel(),iy.ravel(),iz.ravel()),axis=1)*sxyz
+        dr2 = np.sum((pos[:,np.newaxis,:]-pos[np.newaxis,:,:])**2,axis=2)/dta**2
+        dd2 = (a_target.ravel()[:,np.newaxis]-a_ref.ravel()[np.newaxis,:])**2/(0.01*ddp*np.max(a_ref))**2
+        gamma_expected = np.sqrt(np.min(dr2+dd2,axis=1)).reshape(nx,ny,nz)
+        self.assertTrue(np.allclose(agamma,gamma_expected))
     def test_large_image(self):
         logger.debug('Test_GammaIndex3dIdenticalMesh test_large_image')
+        # for the timing of larger images, see run_gamma_benchmark (gt_gamma_benchmark)
         for N in [1,2,5,10,20]:
-        #for N in [1,2,5,10,20,50]: # requires more patience
-        #for N in [1,2,5,10,20,50,100]: # requires even more patience
             tgen = datetime.now()
             img_ref = itk.image_from_array(np.ones((N,N,N),dtype=float))
             img_target = itk.image_from_array(np.random.normal(1.,0.02,(N,N,N)))
@@ -434,4 +1561,523 @@ class Test_GammaIndex3dUnequalMesh(LoggedTestCase):
                     logger.debug("ok ddp={} dta={} refGRAD={} targetGRAD={}".format(ddp,dta,refGRAD,targetGRAD))
             logger.debug("{}th gradient test finished".format(i))
 
+class Test_GammaIndexMaxGamma(LoggedTestCase):
+    def _check_max_gamma(self,img_ref,img_target,gamma_function,max_gamma):
+        aexact = itk.array_from_image(gamma_function(img_ref,img_target,dd=3.,dta=2.,threshold=0.5))
+        acapped = itk.array_from_image(gamma_function(img_ref,img_target,dd=3.,dta=2.,threshold=0.5,max_gamma=max_gamma))
+        computed = aexact>=0
+        # same pass/fail decision for all voxels
+        self.assertTrue( ((aexact<=1.)==(acapped<=1.)).all() )
+        self.assertTrue( (acapped[np.logical_not(computed)]==-1.).all() )
+        # failing voxels: exact value up to the cap
+        fail = computed*(aexact>1.)
+        self.assertTrue( np.allclose(acapped[fail],np.minimum(aexact[fail],max_gamma)) )
+        self.assertTrue( (acapped<=max_gamma).all() )
+    def test_equal_geometry(self):
+        logger.debug('Test_GammaIndexMaxGamma test_equal_geometry')
+        np.random.seed(1234571)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.3,a_ref.shape))
+        for max_gamma in [1.5,2.,3.]:
+            self._check_max_gamma(img_ref,img_target,gamma_index_3d_equal_geometry,max_gamma)
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaIndexMaxGamma test_unequal_geometry')
+        np.random.seed(1234572)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(6,7,8)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        for max_gamma in [1.5,2.,3.]:
+            self._check_max_gamma(img_ref,img_target,gamma_index_3d_unequal_geometry,max_gamma)
+
+@unittest.skipIf(sys.version_info < (3,8), "the parallel gamma computation requires python 3.8")
+class Test_GammaIndexParallel(LoggedTestCase):
+    def test_equal_geometry(self):
+        # the slab-parallel computation should give exactly the same result as the serial computation
+        logger.debug('Test_GammaIndexParallel test_equal_geometry')
+        np.random.seed(1234573)
+        a_ref = np.random.uniform(0.,10.,(23,14,15))
+        img_ref = itk.image_from_array(a_ref)
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.2,a_ref.shape))
+        for max_gamma in [None,2.]:
+            aserial = itk.array_from_image(gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=max_gamma))
+            aparallel = itk.array_from_image(gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=max_gamma,n_workers=3))
+            self.assertTrue( np.array_equal(aserial,aparallel) )
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaIndexParallel test_unequal_geometry')
+        np.random.seed(1234574)
+        img_ref = itk.image_from_array(np.random.uniform(0.,10.,(15,13,12)))
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(8,7,6)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        for max_gamma in [None,2.]:
+            aserial = itk.array_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=3.,dta=2.,max_gamma=max_gamma))
+            aparallel = itk.array_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=3.,dta=2.,max_gamma=max_gamma,n_workers=3))
+            self.assertTrue( np.array_equal(aserial,aparallel) )
+
+class Test_GammaPassRate(LoggedTestCase):
+    def _check_pass_rate(self,img_ref,img_target,**kwargs):
+        agamma = itk.array_from_image(get_gamma_index(img_ref,img_target,**kwargs))
+        computed = agamma>=0
+        summary = gamma_pass_rate(img_ref,img_target,chunk_size=200,**kwargs)
+        self.assertEqual(summary["ncomputed"],np.sum(computed))
+        self.assertEqual(summary["npass"],np.sum(computed*(agamma<=1.)))
+        self.assertEqual(summary["nfail"],np.sum(agamma>1.))
+        self.assertTrue(np.isclose(summary["pass_rate"],np.sum(computed*(agamma<=1.))/np.sum(computed)))
+        self.assertTrue(np.isclose(summary["gamma_mean"],np.mean(agamma[computed])))
+        self.assertTrue(np.isclose(summary["gamma_max"],np.max(agamma)))
+        self.assertEqual(np.sum(summary["histogram"]),summary["ncomputed"])
+        self.assertTrue((summary["failing"]==np.argwhere(agamma>1.)[:,::-1]).all())
+        self.assertTrue((summary["failing_gamma"]==agamma[agamma>1.]).all())
+    def test_equal_geometry(self):
+        logger.debug('Test_GammaPassRate test_equal_geometry')
+        np.random.seed(1234575)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.2,a_ref.shape))
+        self._check_pass_rate(img_ref,img_target,dd=3.,dta=2.,threshold=1.)
+        self._check_pass_rate(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=2.)
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaPassRate test_unequal_geometry')
+        np.random.seed(1234576)
+        img_ref = itk.image_from_array(np.random.uniform(0.,10.,(15,13,12)))
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(8,7,9)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        self._check_pass_rate(img_ref,img_target,dd=3.,dta=2.)
+        self._check_pass_rate(img_ref,img_target,dd=3.,dta=2.,max_gamma=2.)
+
+class Test_GammaIndexMultiCriteria(LoggedTestCase):
+    def _check_criteria(self,img_ref,img_target,criteria,**kwargs):
+        # each gamma image should be equal (to float32 precision) to the gamma image computed with only that criterion
+        imgs = get_gamma_index(img_ref,img_target,criteria=criteria,**kwargs)
+        self.assertEqual(len(imgs),len(criteria))
+        for (dd,dta),img in zip(criteria,imgs):
+            asingle = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=dd,dta=dta,**kwargs))
+            self.assertTrue( np.allclose(itk.array_from_image(img),asingle) )
+        summaries = gamma_pass_rate(img_ref,img_target,criteria=criteria,**kwargs)
+        for (dd,dta),summary in zip(criteria,summaries):
+            self.assertEqual(summary["npass"],gamma_pass_rate(img_ref,img_target,dd=dd,dta=dta,**kwargs)["npass"])
+    def test_equal_geometry(self):
+        logger.debug('Test_GammaIndexMultiCriteria test_equal_geometry')
+        np.random.seed(1234577)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.2,a_ref.shape))
+        img_target.SetSpacing((0.8,0.9,1.1))
+        criteria = [(1.,1.),(2.,2.),(3.,3.),(2.,3.5)]
+        self._check_criteria(img_ref,img_target,criteria,threshold=1.)
+        self._check_criteria(img_ref,img_target,criteria,threshold=1.,max_gamma=2.)
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaIndexMultiCriteria test_unequal_geometry')
+        np.random.seed(1234578)
+        img_ref = itk.image_from_array(np.random.uniform(0.,10.,(15,13,12)))
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(8,7,6)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        criteria = [(1.,1.),(2.,2.),(3.,3.),(2.,3.5)]
+        self._check_criteria(img_ref,img_target,criteria)
+        self._check_criteria(img_ref,img_target,criteria,max_gamma=2.)
+    def test_invalid_criteria(self):
+        logger.debug('Test_GammaIndexMultiCriteria test_invalid_criteria')
+        img = itk.image_from_array(np.ones((4,5,6)))
+        with self.assertRaises(ValueError):
+            get_gamma_index(img,img,criteria=[])
+        with self.assertRaises(ValueError):
+            get_gamma_index(img,img,criteria=[(1.,2.,3.)])
+
+class Test_GammaIndexSpatialIndex(LoggedTestCase):
+    def test_brute_force(self):
+        # compare with the minimum over *all* reference voxels, computed by brute force
+        logger.debug('Test_GammaIndexSpatialIndex test_brute_force')
+        np.random.seed(1234579)
+        a_ref = np.random.uniform(0.,10.,(9,8,7))
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        a_target = np.random.uniform(0.,10.,(5,4,6))
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        ddp,dta=3.,2.
+        img_gamma = get_gamma_index(img_ref,img_target,dd=ddp,dta=dta,method="spatial_index")
+        agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
+        def positions(a,img):
+            ixyz = np.meshgrid(*[np.arange(n) for n in a.shape],indexing='ij')
+            return np.stack([o+i.ravel()*s for o,i,s in zip(img.GetOrigin(),ixyz,img.GetSpacing())],axis=1)
+        dr2 = np.sum((positions(a_target,img_target)[:,np.newaxis,:]-positions(a_ref,img_ref)[np.newaxis,:,:])**2,axis=2)/dta**2
+        dd2 = (a_target.ravel()[:,np.newaxis]-a_ref.ravel()[np.newaxis,:])**2/(0.01*ddp*np.max(a_ref))**2
+        gamma_expected = np.sqrt(np.min(dr2+dd2,axis=1)).reshape(a_target.shape)
+        # target voxels outside of the reference image are not computed
+        computed = agamma>=0
+        self.assertTrue(np.sum(computed)>0)
+        self.assertTrue(np.allclose(agamma[computed],gamma_expected[computed]))
+    def test_equal_geometry(self):
+        # for images with equal geometry, the spatial index should give the same results as the "equal geometry" implementation
+        logger.debug('Test_GammaIndexSpatialIndex test_equal_geometry')
+        np.random.seed(1234580)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.2,a_ref.shape))
+        img_target.SetSpacing((0.8,0.9,1.1))
+        for max_gamma in [None,2.]:
+            aequal = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=max_gamma))
+            aindex = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=max_gamma,method="spatial_index"))
+            # passing voxels may stop at a different gamma value <= 1 if max_gamma is given
+            fail = aequal>1.
+            self.assertTrue( ((aequal<=1.)==(aindex<=1.)).all() )
+            self.assertTrue( np.allclose(aequal[fail],aindex[fail]) )
+            if max_gamma is None:
+                self.assertTrue( np.allclose(aequal,aindex) )
+    @unittest.skipIf(sys.version_info < (3,8), "the parallel gamma computation requires python 3.8")
+    def test_parallel(self):
+        logger.debug('Test_GammaIndexSpatialIndex test_parallel')
+        np.random.seed(1234581)
+        img_ref = itk.image_from_array(np.random.uniform(0.,10.,(15,13,12)))
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(8,7,6)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        aserial = itk.array_from_image(gamma_index_3d_spatial_index(img_ref,img_target,dd=3.,dta=2.))
+        aparallel = itk.array_from_image(gamma_index_3d_spatial_index(img_ref,img_target,dd=3.,dta=2.,n_workers=3))
+        self.assertTrue( np.array_equal(aserial,aparallel) )
+    def test_unknown_method(self):
+        img = itk.image_from_array(np.ones((4,5,6)))
+        with self.assertRaises(ValueError):
+            get_gamma_index(img,img,method="kd-forest")
+
+class Test_GammaIndexInterpolation(LoggedTestCase):
+    def _brute_force(self,a_ref,img_ref,a_target,img_target,dd,dta,k):
+        # minimum over all points of the k times finer reference grid, which is interpolated explicitly
+        a_fine = a_ref
+        for axis in range(3):
+            f = np.arange((a_fine.shape[axis]-1)*k+1)
+            wshape = [1,1,1]
+            wshape[axis] = len(f)
+            wfine = ((f%k)/k).reshape(wshape)
+            a_fine = np.take(a_fine,f//k,axis=axis)*(1-wfine) + np.take(a_fine,np.minimum(f//k+1,a_fine.shape[axis]-1),axis=axis)*wfine
+        def positions(shape,origin,spacing):
+            ixyz = np.meshgrid(*[np.arange(n) for n in shape],indexing='ij')
+            return np.stack([o+i.ravel()*s for o,i,s in zip(origin,ixyz,spacing)],axis=1)
+        pref = positions(a_fine.shape,img_ref.GetOrigin(),np.array(img_ref.GetSpacing())/k)
+        ptarget = positions(a_target.shape,img_target.GetOrigin(),img_target.GetSpacing())
+        dr2 = np.sum((ptarget[:,np.newaxis,:]-pref[np.newaxis,:,:])**2,axis=2)/dta**2
+        dd2 = (a_target.ravel()[:,np.newaxis]-a_fine.ravel()[np.newaxis,:])**2/(0.01*dd*np.max(a_ref))**2
+        return np.sqrt(np.min(dr2+dd2,axis=1)).reshape(a_target.shape)
+    def test_equal_geometry(self):
+        logger.debug('Test_GammaIndexInterpolation test_equal_geometry')
+        np.random.seed(1234582)
+        a_ref = np.random.uniform(0.,10.,(6,7,5))
+        a_target = a_ref*np.random.normal(1.,0.2,a_ref.shape)
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        img_target.SetSpacing((0.8,0.9,1.1))
+        for k in [2,3]:
+            gamma_expected = self._brute_force(a_ref,img_ref,a_target,img_target,3.,2.,k)
+            for n_workers in [1,2]:
+                img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.,interp_factor=k,n_workers=n_workers)
+                self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma).swapaxes(0,2),gamma_expected))
+            img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=3.,dta=2.,interp_factor=k)
+            self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma).swapaxes(0,2),gamma_expected))
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaIndexInterpolation test_unequal_geometry')
+        np.random.seed(1234583)
+        a_ref = np.random.uniform(0.,10.,(6,7,5))
+        a_target = np.random.uniform(0.,10.,(3,4,3))
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,0.1))
+        for k in [2,3]:
+            gamma_expected = self._brute_force(a_ref,img_ref,a_target,img_target,3.,2.,k)
+            agamma = itk.array_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=3.,dta=2.,interp_factor=k)).swapaxes(0,2)
+            computed = agamma>=0
+            self.assertTrue(np.allclose(agamma[computed],gamma_expected[computed]))
+    def test_not_pessimistic(self):
+        # the finer grid contains the reference voxel centers, so gamma can only decrease
+        logger.debug('Test_GammaIndexInterpolation test_not_pessimistic')
+        np.random.seed(1234584)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.1,a_ref.shape))
+        acoarse = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.))
+        afine = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,interp_factor=2))
+        self.assertTrue((afine<=acoarse).all())
+        self.assertTrue((afine<acoarse).any())
+        with self.assertRaises(ValueError):
+            get_gamma_index(img_ref,img_target,interp_factor=0)
+
+class Test_GammaIndexPruning(LoggedTestCase):
+    def _check_pruning(self,img_ref,img_target,**kwargs):
+        aexact = itk.array_from_image(get_gamma_index(img_ref,img_target,**kwargs))
+        apruned = itk.array_from_image(get_gamma_index(img_ref,img_target,prune_levels=[8,4,2],**kwargs))
+        computed = aexact>=0
+        # same pass/fail decision for all voxels, and the pruned values are bounds
+        self.assertTrue( ((aexact<=1.)==(apruned<=1.)).all() )
+        self.assertTrue( (apruned[np.logical_not(computed)]==-1.).all() )
+        fail = computed*(aexact>1.)
+        self.assertTrue( (apruned[fail]<=aexact[fail]+1e-6).all() )
+        self.assertTrue( (apruned[computed*(aexact<=1.)]>=aexact[computed*(aexact<=1.)]-1e-6).all() )
+    def test_equal_geometry(self):
+        logger.debug('Test_GammaIndexPruning test_equal_geometry')
+        np.random.seed(1234585)
+        a_ref = np.random.uniform(0.,10.,(16,17,18))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.2,a_ref.shape))
+        img_target.SetSpacing((0.8,0.9,1.1))
+        for max_gamma in [None,2.]:
+            self._check_pruning(img_ref,img_target,dd=3.,dta=2.,threshold=1.,max_gamma=max_gamma)
+    def test_unequal_geometry(self):
+        logger.debug('Test_GammaIndexPruning test_unequal_geometry')
+        np.random.seed(1234586)
+        img_ref = itk.image_from_array(np.random.uniform(0.,10.,(15,13,12)))
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(8,7,6)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        for method in ["unequal_geometry","spatial_index"]:
+            self._check_pruning(img_ref,img_target,dd=3.,dta=2.,method=method)
+    def test_report(self):
+        # a smooth dose distribution with a hot spot: most voxels are pruned, and the report counts them
+        logger.debug('Test_GammaIndexPruning test_report')
+        np.random.seed(1234587)
+        ix,iy,iz = np.meshgrid(np.arange(30),np.arange(31),np.arange(32),indexing='ij')
+        a_ref = np.exp(-((ix-15.)**2+(iy-15.)**2+(iz-16.)**2)/100.)
+        a_target = a_ref*np.random.normal(1.,0.003,a_ref.shape)
+        a_target[10:15,10:15,10:15] *= 1.3
+        mask = a_target>0.1
+        geometry = (np.zeros(3),np.ones(3))
+        g2, pruned, report = _gamma2_bounds(a_ref,a_target,mask,geometry,geometry,0.03,3.,[8,4,2],0.1)
+        self.assertEqual([level for level,npass,nfail in report],["closest",8,4,2])
+        self.assertEqual(sum(npass+nfail for level,npass,nfail in report),np.sum(pruned))
+        self.assertTrue( np.sum(pruned)>0.9*np.sum(mask) )
+        self.assertTrue( (pruned<=mask).all() )
+        g2exact = _gamma2_equal_geometry(a_ref,a_target,mask,np.ones(3),0.03,3.)
+        self.assertTrue( ((g2exact[pruned]<=1.)==(g2[pruned]<=1.)).all() )
+        with self.assertRaises(ValueError):
+            get_gamma_index(itk.image_from_array(a_ref),itk.image_from_array(a_target),prune_levels=[4],interp_factor=2)
+
+class Test_GammaEvaluator(LoggedTestCase):
+    def _images(self,seed):
+        np.random.seed(seed)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        targets = []
+        for sigma in [0.05,0.1,0.2]:
+            img_target = itk.image_from_array(a_ref*np.random.normal(1.,sigma,a_ref.shape))
+            img_target.SetSpacing((0.8,0.9,1.1))
+            targets.append(img_target)
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(7,8,6)))
+        img_target.SetSpacing((1.5,1.6,1.7))
+        img_target.SetOrigin((0.3,0.2,-0.1))
+        targets.append(img_target)
+        return img_ref, targets
+    def test_evaluate(self):
+        logger.debug('Test_GammaEvaluator test_evaluate')
+        img_ref, targets = self._images(1234588)
+        for kwargs in [dict(dd=3.,dta=2.,threshold=1.),dict(criteria=[(2.,2.),(3.,3.)],max_gamma=2.),
+                       dict(dd=3.,dta=2.,prune_levels=[4,2]),dict(dd=3.,dta=2.,method="spatial_index")]:
+            evaluator = GammaEvaluator(img_ref,**kwargs)
+            for img_target in targets:
+                expected = get_gamma_index(img_ref,img_target,**kwargs)
+                result = evaluator.evaluate(img_target)
+                if "criteria" not in kwargs:
+                    expected, result = [expected], [result]
+                for e,r in zip(expected,result):
+                    self.assertTrue( (itk.array_from_image(e)==itk.array_from_image(r)).all() )
+    def test_cache(self):
+        logger.debug('Test_GammaEvaluator test_cache')
+        img_ref, targets = self._images(1234589)
+        evaluator = GammaEvaluator(img_ref,dd=3.,dta=2.,method="spatial_index",prune_levels=[4,2])
+        evaluator.evaluate(targets[0])
+        index, minmax = evaluator._index, dict(evaluator._minmax)
+        self.assertEqual(sorted(minmax),[2,4])
+        evaluator.evaluate(targets[1])
+        self.assertIs(evaluator._index,index)
+        self.assertTrue( all(evaluator._minmax[b] is minmax[b] for b in minmax) )
+    def test_pass_rates(self):
+        logger.debug('Test_GammaEvaluator test_pass_rates')
+        img_ref, targets = self._images(1234590)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = [os.path.join(tmpdir,"target{}.mhd".format(i)) for i in range(len(targets))]
+            for img_target,filename in zip(targets,filenames):
+                itk.imwrite(img_target,filename)
+            evaluator = GammaEvaluator(img_ref,dd=3.,dta=2.,threshold=1.)
+            for prefetch in [1,2]:
+                results = list(evaluator.pass_rates(filenames,prefetch=prefetch))
+                self.assertEqual([filename for filename,s in results],filenames)
+                for (filename,s),img_target in zip(results,targets):
+                    expected = gamma_pass_rate(img_ref,itk.imread(filename),dd=3.,dta=2.,threshold=1.)
+                    self.assertEqual(s["npass"],expected["npass"])
+                    self.assertEqual(s["ncomputed"],expected["ncomputed"])
+                    self.assertTrue( (s["failing_gamma"]==expected["failing_gamma"]).all() )
+        with self.assertRaises(ValueError):
+            GammaEvaluator(img_ref,prune_levels=[4]).pass_rate(targets[0])
+        with self.assertRaises(ValueError):
+            GammaEvaluator(img_ref,dose_floor=1.)
+
+class Test_GammaIndexROI(LoggedTestCase):
+    def _images(self,seed):
+        np.random.seed(seed)
+        a_ref = np.random.uniform(0.,10.,(12,13,14))
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,0.9,1.1))
+        img_target = itk.image_from_array(a_ref*np.random.normal(1.,0.1,a_ref.shape))
+        img_target.SetSpacing((0.8,0.9,1.1))
+        a_ptv = np.zeros(a_ref.shape,dtype=np.uint8)
+        a_ptv[3:8,4:9,5:10] = 1
+        img_ptv = itk.image_from_array(a_ptv)
+        img_ptv.CopyInformation(img_ref)
+        a_body = np.zeros(a_ref.shape,dtype=np.uint8)
+        a_body[1:11,2:12,3:13] = 1
+        img_body = itk.image_from_array(a_body)
+        img_body.CopyInformation(img_ref)
+        return img_ref, img_target, {"ptv":img_ptv,"body":img_body}
+    def test_roi_mask(self):
+        logger.debug('Test_GammaIndexROI test_roi_mask')
+        img_ref, img_target, rois = self._images(1234591)
+        afull = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.))
+        for method in ["equal_geometry","unequal_geometry","spatial_index"]:
+            aroi = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,method=method,roi_mask=rois["ptv"]))
+            inside = itk.array_from_image(rois["ptv"])>0
+            self.assertTrue( (aroi[np.logical_not(inside)]==-1.).all() )
+            self.assertTrue( np.allclose(aroi[inside],afull[inside]) )
+        # a mask with a coarser grid is sampled at the target voxel centers
+        a_coarse = np.zeros((6,7,7),dtype=np.uint8)
+        a_coarse[1:4,2:5,2:5] = 1
+        img_coarse = itk.image_from_array(a_coarse)
+        img_coarse.SetSpacing((1.6,1.8,2.2))
+        img_coarse.SetOrigin((0.4,0.45,0.55))
+        inside = itk.array_from_image(img_target)>0
+        inside.swapaxes(0,2)[...] &= _target_mask(img_coarse,img_target)
+        self.assertTrue( 0 < np.sum(inside) < inside.size )
+        aroi = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,roi_mask=[img_coarse]))
+        self.assertTrue( ((aroi>=0.)==inside).all() )
+    def test_pass_rates(self):
+        logger.debug('Test_GammaIndexROI test_pass_rates')
+        img_ref, img_target, rois = self._images(1234592)
+        gamma = get_gamma_index(img_ref,img_target,dd=3.,dta=2.,threshold=1.)
+        expected = gamma_roi_pass_rates(gamma,rois)
+        result = gamma_pass_rate(img_ref,img_target,dd=3.,dta=2.,threshold=1.,rois=rois,chunk_size=500)
+        self.assertEqual(sorted(result),["body","ptv"])
+        agamma = itk.array_from_image(gamma)
+        for name in rois:
+            inside = (itk.array_from_image(rois[name])>0)*(agamma>=0.)
+            self.assertEqual(expected[name]["ncomputed"],np.sum(inside))
+            self.assertEqual(expected[name]["npass"],np.sum(agamma[inside]<=1.))
+            for key in ["ncomputed","npass","nfail"]:
+                self.assertEqual(result[name][key],expected[name][key])
+            self.assertAlmostEqual(result[name]["gamma_mean"],expected[name]["gamma_mean"],places=5)
+            self.assertEqual(len(result[name]["failing"]),result[name]["nfail"])
+
+class Test_GammaIndex2D(LoggedTestCase):
+    def _brute_force(self,a_ref,a_target,spacing,dd,dta,threshold):
+        # a_ref and a_target in ITK array order (y,x), dd is a number or an array with the shape of a_target
+        iy,ix = np.meshgrid(np.arange(a_ref.shape[0]),np.arange(a_ref.shape[1]),indexing='ij')
+        dd = np.broadcast_to(dd,a_target.shape)
+        g = np.full(a_target.shape,-1.)
+        for jy,jx in zip(*np.nonzero(a_target>threshold)):
+            r2 = (((ix-jx)*spacing[0])**2+((iy-jy)*spacing[1])**2)/dta**2
+            g[jy,jx] = np.sqrt(np.min((a_ref-a_target[jy,jx])**2/dd[jy,jx]**2+r2))
+        return g
+    def test_brute_force(self):
+        logger.debug('Test_GammaIndex2D test_brute_force')
+        np.random.seed(1234593)
+        a_ref = np.random.uniform(0.,10.,(17,23))
+        a_target = a_ref*np.random.normal(1.,0.2,a_ref.shape)
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,1.1))
+        img_target = itk.image_from_array(a_target)
+        img_target.SetSpacing((0.8,1.1))
+        for local in [False,True]:
+            dd = 0.03*(a_ref if local else np.max(a_ref))
+            with np.errstate(divide='ignore'):
+                expected = self._brute_force(a_ref,a_target,(0.8,1.1),dd,2.,1.)
+            result = itk.array_from_image(get_gamma_index(img_ref,img_target,dd=3.,dta=2.,threshold=1.,local=local))
+            self.assertTrue( np.allclose(result,expected) )
+            capped = itk.array_from_image(gamma_index_2d(img_ref,img_target,dd=3.,dta=2.,threshold=1.,local=local,max_gamma=2.))
+            self.assertTrue( ((capped<=1.)==(expected<=1.)).all() )
+            self.assertTrue( np.allclose(capped[expected>1.],np.minimum(expected[expected>1.],2.)) )
+        with self.assertRaises(ValueError):
+            gamma_index_2d(img_ref,img_target,local=True,ddpercent=False)
+        # local gamma is not defined where the reference dose is zero
+        a_ref[3,4] = 0.
+        a_target[3,4] = 5.
+        result = itk.array_from_image(gamma_index_2d(itk.image_from_array(a_ref),itk.image_from_array(a_target),dd=3.,dta=2.,threshold=1.,local=True))
+        self.assertEqual(result[3,4],-1.)
+        self.assertTrue( (result[a_target>1.]>=0.).sum() == np.sum((a_target>1.)&(a_ref>0.)) )
+    def test_batch(self):
+        logger.debug('Test_GammaIndex2D test_batch')
+        np.random.seed(1234594)
+        a_ref = np.random.uniform(0.,10.,(5,11,13))*np.arange(1,6)[:,np.newaxis,np.newaxis]
+        a_target = a_ref*np.random.normal(1.,0.1,a_ref.shape)
+        img_ref = itk.image_from_array(a_ref)
+        img_ref.SetSpacing((0.8,1.1,5.))
+        img_target = itk.image_from_array(a_target)
+        img_target.SetSpacing((0.8,1.1,5.))
+        for local in [False,True]:
+            result = gamma_pass_rates_2d(img_ref,img_target,dd=2.,dta=1.5,threshold=1.,local=local)
+            self.assertEqual(len(result["pass_rate"]),5)
+            self.assertTrue( (np.array(result["pass_rate"])<1.).any() )
+            for p in range(5):
+                plane_ref = itk.image_from_array(a_ref[p].copy())
+                plane_ref.SetSpacing((0.8,1.1))
+                plane_target = itk.image_from_array(a_target[p].copy())
+                plane_target.SetSpacing((0.8,1.1))
+                g = itk.array_from_image(gamma_index_2d(plane_ref,plane_target,dd=2.,dta=1.5,threshold=1.,local=local))
+                self.assertEqual(result["ncomputed"][p],np.sum(g>=0.))
+                self.assertEqual(result["npass"][p],np.sum((g>=0.)*(g<=1.)))
+                self.assertAlmostEqual(result["gamma_max"][p],np.max(g),places=5)
+            arrays = gamma_pass_rates_2d(a_ref,a_target,dd=2.,dta=1.5,threshold=1.,local=local,spacing=(0.8,1.1))
+            self.assertTrue( (arrays["npass"]==result["npass"]).all() )
+
+class Test_GammaIndexMemory(LoggedTestCase):
+    def test_layout(self):
+        # float32 inputs give float32 results in the memory layout of ITK images, for all engines
+        logger.debug('Test_GammaIndexMemory test_layout')
+        np.random.seed(1234595)
+        a_ref = np.random.uniform(1.,10.,(9,10,11)).astype(np.float32)
+        a_target = (a_ref*np.random.normal(1.,0.1,a_ref.shape)).astype(np.float32)
+        aref, atarget = a_ref.swapaxes(0,2), a_target.swapaxes(0,2)
+        mask = atarget>2.
+        geometry = (np.zeros(3),np.ones(3))
+        for g2 in [_gamma2_equal_geometry(aref,atarget,mask,np.ones(3),0.3,2.),
+                   _gamma2_equal_geometry(aref,atarget,mask,np.ones(3),[0.3,0.2],[2.,1.]),
+                   _gamma2_unequal_geometry(aref,atarget,mask,geometry,geometry,[0.3,0.2],[2.,1.]),
+                   _gamma2_spatial_index(aref,atarget,mask,geometry,geometry,[0.3,0.2],[2.,1.])]:
+            self.assertEqual(g2.dtype,np.float32)
+            self.assertTrue( g2.swapaxes(-3,-1).flags.c_contiguous )
+        g2 = _gamma2_equal_geometry(aref.astype(float),atarget.astype(float),mask,np.ones(3),0.3,2.)
+        self.assertEqual(g2.dtype,np.float64)
+    def test_output(self):
+        # the gamma image is written directly into the output buffer, without temporary copies of the image size
+        logger.debug('Test_GammaIndexMemory test_output')
+        np.random.seed(1234596)
+        img_target = itk.image_from_array(np.random.uniform(0.,10.,(40,50,60)).astype(np.float32))
+        img_target.SetSpacing((0.8,0.9,1.1))
+        atarget = itk.array_view_from_image(img_target).swapaxes(0,2)
+        mask = atarget>2.
+        g2 = _native_zeros(mask.shape,np.float32)
+        g2[mask] = 4.
+        tracemalloc.start()
+        gimg = _gamma_image(g2,mask,-1.,img_target)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertTrue( peak < atarget.nbytes/10 )
+        agamma = itk.array_from_image(gimg)
+        self.assertTrue( (agamma[mask.swapaxes(0,2)]==2.).all() )
+        self.assertTrue( (agamma[np.logical_not(mask.swapaxes(0,2))]==-1.).all() )
+        self.assertTrue( np.allclose(gimg.GetSpacing(),(0.8,0.9,1.1)) )
+
 # vim: set et ts=4 ai sw=4:
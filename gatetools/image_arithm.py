@@ -32,6 +32,8 @@ This module provides basic arithmatic image operations for ITK images, e.g. dose
     11. img / scalar
     12. normalize(img) (divide by max)
     13. -ln(img/I0)
+    Voxel-wise expressions with named images and scalars, e.g. "(a+b)/c*0.5", see `image_expression`.
+    Out-of-core sum, mean, product, min and max of memory mapped MetaImage files, see `image_chunked_operation`.
     Some of these operations are quite directly possible with SimpleITK, for
     instance the image objects in SimpleITK have a 'plus' operator defined, so
     that you can literally write imgsum = img1+img1, which will do what you
@@ -49,10 +51,15 @@ This module provides basic arithmatic image operations for ITK images, e.g. dose
 
 
 import os
+import sys
+import ast
 import itk
 import numpy as np
-from functools import reduce
-import operator
+import itertools
+import functools
+import collections
+import multiprocessing
+import concurrent.futures
 import ctypes # needed for definition of "unsigned long", as np.uint32 is not recognized as such
 import logging
 logger=logging.getLogger(__name__)
@@ -65,7 +72,44 @@ def _image_size(img):
     # TODO: the numpy array shape is a tuple. Would it be useful to convert that tuple to a numpy array?
     return img.GetLargestPossibleRegion().GetSize()
 
-def _image_list(input_list):
+def read_images(input_list,jobs=1):
+    """
+    Generator that yields the items of `input_list` (filenames, image objects and/or scalars) one at a time, with the
+    filenames of existing files replaced by the image objects read from them.
+    With `jobs` larger than 1, the files are read in a pool of `jobs` threads, up to `jobs` files ahead of the item
+    that is being used, so that disk latency and decompression of the next files overlap with the computation on the
+    current image. At most `jobs`+1 images are then in memory at the same time.
+    An `OSError` is raised for a file that ITK cannot read (e.g. a pixel type that is not wrapped).
+    """
+    def read(item):
+        if not (isinstance(item, str) and os.path.exists(item)):
+            return item
+        try:
+            return itk.imread(item)
+        except Exception as e:
+            raise OSError("cannot read the image file {}: {}".format(item, e)) from e
+    items = iter(input_list)
+    # the first item is always read in this thread (this also finishes the lazy loading of the ITK modules)
+    for item in itertools.islice(items,1):
+        yield read(item)
+    if jobs <= 1:
+        for item in items:
+            yield read(item)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as reader:
+        pending = collections.deque(reader.submit(read,item) for item in itertools.islice(items,jobs))
+        try:
+            while pending:
+                img = pending.popleft().result()
+                for item in itertools.islice(items,1):
+                    pending.append(reader.submit(read,item))
+                yield img
+                del img
+        finally:
+            for future in pending:
+                future.cancel()
+
+def _image_list(input_list,jobs=1):
     """
     Helper function to turn a list of  filenames and/or image objects into a list of image objects.
 
@@ -77,49 +121,137 @@ def _image_list(input_list):
     TODO: discuss policy in case of empty/erroneous input
     TODO: is a 'TypeError' the correct exception to raise in case of incompatible image types, or should it be InputError?
     """
-    input_images=list()
-    for img in input_list:
+    return list(_iter_image_list(input_list,jobs))
+
+# geometry and pixel type in the header of an image file, see `_image_file_info`
+_ImageFileInfo = collections.namedtuple("_ImageFileInfo", "size spacing origin direction component_type components")
+
+def _image_file_info(filename):
+    """
+    Helper function: the `_ImageFileInfo` of an image file, read from the header only (with the ITK ImageIO of
+    the file format, for all formats that ITK can read), or None if ITK cannot read the file.
+    The information is cached, as long as the file is not modified.
+    """
+    st = os.stat(filename)
+    return _read_image_file_info(os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=4096)
+def _read_image_file_info(filename, mtime, size):
+    """
+    Helper function for `_image_file_info` (the modification time and the size of the file are part of the cache key).
+    """
+    io = itk.ImageIOFactory.CreateImageIO(filename, itk.CommonEnums.IOFileMode_ReadMode)
+    if io is None:
+        return None
+    io.SetFileName(filename)
+    io.ReadImageInformation()
+    n = io.GetNumberOfDimensions()
+    return _ImageFileInfo(tuple(io.GetDimensions(i) for i in range(n)), tuple(io.GetSpacing(i) for i in range(n)),
+                          tuple(io.GetOrigin(i) for i in range(n)), tuple(tuple(io.GetDirection(i)) for i in range(n)),
+                          io.GetComponentTypeAsString(io.GetComponentType()), io.GetNumberOfComponents())
+
+def _check_geometry(size0,spacing0,origin0,size,spacing,origin,name=None):
+    """
+    Helper function: raise a `TypeError` if the geometry (size, spacing, origin) of an image differs from the
+    reference geometry. `name` is an optional description of the image for the message.
+    """
+    where = "" if name is None else " ({})".format(name)
+    if len(size) != len(size0) or not np.allclose(size, size0):
+        raise TypeError("images have incompatible size: {} versus {}{}".format(tuple(size0),tuple(size),where))
+    elif not np.allclose(origin,origin0):
+        raise TypeError("images have incompatible origins: {} versus {}{}".format(tuple(origin0),tuple(origin),where))
+    elif not np.allclose(spacing,spacing0):
+        raise TypeError("images have incompatible {} spacing: {} versus {}{}".format(
+            "pixel" if len(spacing0)==2 else "voxel",tuple(spacing0),tuple(spacing),where))
+
+def _check_image_files(input_list):
+    """
+    Helper function: fast check of the geometry of the image files in `input_list` against the first image, from
+    the headers only (see `_image_file_info`), before any pixel data are read, so that a list with an incompatible
+    file fails immediately. Image objects are checked with their own geometry, scalars and items that are not
+    readable image files are skipped (they are handled when the images are read).
+    """
+    geometry0 = None
+    for item in input_list:
+        if hasattr(item,"GetSpacing") and hasattr(item,"GetOrigin"):
+            geometry = (tuple(_image_size(item)), tuple(item.GetSpacing()), tuple(item.GetOrigin()))
+        elif isinstance(item, str) and os.path.isfile(item) and _image_file_info(item) is not None:
+            info = _image_file_info(item)
+            geometry = (info.size, info.spacing, info.origin)
+        else:
+            continue
+        if geometry0 is None:
+            geometry0 = geometry
+            continue
+        _check_geometry(*geometry0, *geometry, name=item if isinstance(item, str) else None)
+
+def _iter_image_list(input_list,jobs=1,broadcast=False):
+    """
+    Helper function like `_image_list`, but the image objects are yielded one at a time, and image files are only
+    read when they are needed (see `read_images`, also for `jobs`), so that reductions over many files need only
+    keep one input image in memory. The geometries of all image files are first checked from their headers (see
+    `_check_image_files`), and the geometry of each image is checked again before it is yielded.
+    With `broadcast`, scalars are yielded as float32 numbers (to be broadcast by numpy, see `_image_array`) instead
+    of images filled with the scalar.
+    """
+    input_list = list(input_list)
+    _check_image_files(input_list)
+    info = None
+    for img in read_images(input_list,jobs):
         if hasattr(img,"GetSpacing") and hasattr(img,"GetOrigin"):
             # semi-duck-typing
-            input_images.append(img)
-        elif isinstance(img, str) and os.path.exists(img):
-            input_images.append(itk.imread(img))
+            pass
         elif (not hasattr(img, 'len')) and (not isinstance(img, str)):
-            if not input_images:
+            if info is None:
               raise RuntimeError("Pass an image before a scalar to have a model")
-            duplicator = itk.ImageDuplicator.New(input_images[0])
-            duplicator.Update()
-            InputType = type(input_images[0])
-            input_dimension = input_images[0].GetImageDimension()
-            OutputType = itk.Image[itk.F, input_dimension]
-            castFilter = itk.CastImageFilter[InputType, OutputType].New()
-            castFilter.SetInput(duplicator.GetOutput())
-            castFilter.Update()
-            scalarImage = castFilter.GetOutput()
+            if broadcast:
+                yield np.float32(img)
+                continue
+            scalarImage = itk.Image[itk.F, info.GetImageDimension()].New()
+            scalarImage.SetRegions(info.GetLargestPossibleRegion())
+            scalarImage.CopyInformation(info)
+            scalarImage.Allocate()
             scalarImage.FillBuffer(img)
-            input_images += [scalarImage]
+            img = scalarImage
         else:
             raise TypeError("ERROR: {} is not an ITK image object nor a path to an existing image file".format(img))
-    if not input_images:
+        if info is None:
+            # the geometry of the first image (without the pixel buffer)
+            info = _image_info(img)
+            origin0 = info.GetOrigin()
+            spacing0 = info.GetSpacing()
+            size0 = _image_size(info)
+        # check that they have the same geometry
+        _check_geometry(size0,spacing0,origin0,_image_size(img),img.GetSpacing(),img.GetOrigin())
+        # TODO: maybe we should also check pixel types?
+        yield img
+    if info is None:
         raise RuntimeError("got no images")
-    # check that they have the same geometry
-    checked_images=list()
-    origin0 = input_images[0].GetOrigin()
-    spacing0 = input_images[0].GetSpacing()
-    size0 = _image_size(input_images[0])
-    for img in input_images:
-        img_size = _image_size(img)
-        if not np.allclose(img_size, size0):
-            raise TypeError("images have incompatible size: {} versus {}".format(size0,img_size))
-        elif not np.allclose(img.GetOrigin(),origin0):
-            raise TypeError("images have incompatible origins: {} versus {}".format(origin0,img.GetOrigin()))
-        elif not np.allclose(img.GetSpacing(),spacing0):
-            raise TypeError("images have incompatible {} spacing: {} versus {}".format(
-                "pixel" if len(spacing0)==2 else "voxel",spacing0,img.GetSpacing()))
-        else:
-            # TODO: maybe we should also check pixel types?
-            checked_images.append(img)
-    return checked_images
+
+def _image_array(img):
+    """
+    Helper function: numpy view of the pixels of an image, or the scalar itself (see `_iter_image_list` with `broadcast`).
+    """
+    return itk.array_view_from_image(img) if hasattr(img,"GetSpacing") else img
+
+def _image_info(img):
+    """
+    Helper function: an image object with the geometry of `img`, but without pixel buffer.
+    """
+    info = type(img).New()
+    info.CopyInformation(img)
+    return info
+
+def _geometry_image(size,spacing,origin,direction):
+    """
+    Helper function: an image object (without pixel buffer) with the given geometry, e.g. to be used as `info` in `_array_output`.
+    """
+    info = itk.Image[itk.F, len(size)].New()
+    info.SetRegions([int(n) for n in size])
+    info.SetSpacing([float(x) for x in spacing])
+    info.SetOrigin([float(x) for x in origin])
+    info.SetDirection(itk.matrix_from_array(np.array(direction,dtype=float)))
+    return info
 
 def _image_output(img,filename=None):
     """
@@ -129,103 +261,488 @@ def _image_output(img,filename=None):
         itk.imwrite(img,filename)
     return img
 
-def _apply_operation_to_image_list(op, input_list, output_file=None):
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = reduce(op, np_list)
+def _array_output(np_result,info,filename=None):
+    """
+    Helper function to create an output image from an array, with the geometry of `info`.
+    """
     img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    img.CopyInformation(info)
+    return _image_output(img, filename)
+
+def _apply_operation_to_image_list(op, input_list, output_file=None, jobs=1, processes=1):
+    """
+    Helper function to apply the binary ufunc `op` to a list of images: op(...op(op(img1,img2),img3)...,imgN).
+    The images are processed one at a time, the result is computed in place, and scalars are broadcast.
+    With `jobs` > 1 the files are read ahead in `jobs` threads (see `read_images`).
+    With `processes` > 1 the list of files is split over a pool of processes (see `_parallel_reduce`), only for the
+    associative operations in `_reduce_ufuncs`.
+    """
+    if len(input_list) == 1:
+        return _image_output(_image_list(input_list,jobs)[0], output_file)
+    if _use_processes(input_list,processes):
+        reduction = [name for name,f in _reduce_ufuncs.items() if f is op]
+        if not reduction:
+            raise ValueError("the operation {} cannot be computed with several processes".format(op.__name__))
+        np_result, info = _parallel_reduce(input_list,reduction[0],jobs,processes)
+        return _array_output(np_result, info, output_file)
+    np_result = None
+    for img in _iter_image_list(input_list,jobs,broadcast=True):
+        np_img = _image_array(img)
+        if np_result is None:
+            info = _image_info(img)
+            np_result = np_img.copy()
+            continue
+        # same result type as op(np_result,np_img)
+        rtype = op(np.ones(1,dtype=np_result.dtype),np.ones(1,dtype=np_img.dtype)).dtype
+        if rtype != np_result.dtype:
+            np_result = np_result.astype(rtype)
+        op(np_result, np_img, out=np_result)
+    return _array_output(np_result, info, output_file)
+
+def _accumulator_type(dtype):
+    """
+    Helper function: the type of the accumulator for a sum of arrays of type `dtype`, float64 for floating point
+    types and 64 bit integers for integer types (so that the sum of integers is exact).
+    """
+    if dtype.kind in "ui":
+        return np.dtype(np.uint64 if dtype.kind == "u" else np.int64)
+    return np.dtype(np.float64)
+
+class _RunningStatistics:
+    """
+    Helper class for the streaming reductions: element-wise statistics of arrays that are added one at a time
+    (see `image_reduce` for the statistics). Only the accumulators that are needed for the requested statistics are
+    kept: the sum (see `_accumulator_type`), the mean and the sum of squared deviations from the mean (with Welford's
+    algorithm, in float64), the minimum, the maximum and the number of nonzero values.
+    """
+    def __init__(self,stats):
+        unknown = set(stats) - set(image_reduce_stats)
+        if unknown:
+            raise ValueError("unknown statistic(s) {}, should be one of {}".format(", ".join(sorted(unknown)),", ".join(image_reduce_stats)))
+        self.stats = set(stats)
+        self.variance = bool(self.stats & {"std","sem"})
+        # with the variance the mean is computed with Welford's algorithm, without the variance from the sum
+        self.summing = "sum" in self.stats or ("mean" in self.stats and not self.variance)
+        self.n = 0
+        self.dtype = None
+
+    def add(self,a):
+        """
+        Add the array `a` (the same shape for all arrays; after the first array, numpy scalars are broadcast).
+        """
+        self.n += 1
+        n = self.n
+        if n == 1:
+            self.dtype = a.dtype
+            if self.summing:
+                self.acc = a.astype(_accumulator_type(a.dtype))
+            if self.variance:
+                self.mean = a.astype(np.float64)
+                self.m2 = np.zeros_like(self.mean)
+                self.delta = np.empty_like(self.mean)
+            if "min" in self.stats:
+                self.min = a.copy()
+            if "max" in self.stats:
+                self.max = a.copy()
+            if "count" in self.stats:
+                self.count = (a != 0).astype(np.uint32)
+            return
+        self.dtype = np.result_type(self.dtype, a.dtype)
+        if self.summing:
+            acctype = np.result_type(self.acc.dtype, _accumulator_type(a.dtype))
+            if acctype != self.acc.dtype:
+                self.acc = self.acc.astype(acctype)
+            np.add(self.acc, a, out=self.acc)
+        if self.variance:
+            # mean_n = mean_n-1 + (x-mean_n-1)/n, m2_n = m2_n-1 + (n-1)/n*(x-mean_n-1)**2
+            np.subtract(a, self.mean, out=self.delta)
+            self.delta /= n
+            self.mean += self.delta
+            np.square(self.delta, out=self.delta)
+            self.delta *= n*(n-1.)
+            self.m2 += self.delta
+        for stat,op in (("min",np.minimum),("max",np.maximum)):
+            if stat in self.stats:
+                m = getattr(self, stat)
+                if np.result_type(m.dtype, a.dtype) != m.dtype:
+                    m = m.astype(np.result_type(m.dtype, a.dtype))
+                    setattr(self, stat, m)
+                op(m, a, out=m)
+        if "count" in self.stats:
+            self.count += a != 0
+
+    def merge(self,other):
+        """
+        Add the statistics `other` of another part of the list of arrays (the same statistics, at least one array in both).
+        """
+        n = self.n + other.n
+        self.dtype = np.result_type(self.dtype, other.dtype)
+        if self.summing:
+            acctype = np.result_type(self.acc.dtype, other.acc.dtype)
+            if acctype != self.acc.dtype:
+                self.acc = self.acc.astype(acctype)
+            np.add(self.acc, other.acc, out=self.acc)
+        if self.variance:
+            # Chan et al.: mean = mean_a + (mean_b-mean_a)*n_b/n, m2 = m2_a + m2_b + (mean_b-mean_a)**2*n_a*n_b/n
+            np.subtract(other.mean, self.mean, out=self.delta)
+            self.delta *= other.n/n
+            self.mean += self.delta
+            np.square(self.delta, out=self.delta)
+            self.delta *= n*self.n/other.n
+            self.m2 += self.delta
+            self.m2 += other.m2
+        for stat,op in (("min",np.minimum),("max",np.maximum)):
+            if stat in self.stats:
+                m = getattr(self, stat)
+                if np.result_type(m.dtype, getattr(other, stat).dtype) != m.dtype:
+                    m = m.astype(np.result_type(m.dtype, getattr(other, stat).dtype))
+                    setattr(self, stat, m)
+                op(m, getattr(other, stat), out=m)
+        if "count" in self.stats:
+            self.count += other.count
+        self.n = n
+
+    def result(self,stat):
+        """
+        The array with the statistic `stat`, with the type of the numpy reduction (e.g. the type of the sum of the
+        arrays for "sum", or the type of `np.mean` for "mean", "std" and "sem"), and the smallest unsigned integer type for "count".
+        """
+        if stat not in self.stats:
+            raise ValueError("the statistic '{}' was not computed".format(stat))
+        if stat == "sum":
+            return self.acc.astype(self.dtype)
+        if stat == "mean" and not self.variance:
+            return np.divide(self.acc, self.n, dtype=np.float64).astype(_mean_type(self.dtype), copy=False)
+        if stat == "mean":
+            return self.mean.astype(_mean_type(self.dtype))
+        if stat in ("std","sem"):
+            # the scratch array of the Welford updates is reused
+            u = np.divide(self.m2, self.n if stat == "std" else self.n*self.n, out=self.delta)
+            np.sqrt(u, out=u)
+            return u.astype(_mean_type(self.dtype), copy=False)
+        if stat == "count":
+            return self.count.astype(np.min_scalar_type(self.n))
+        return getattr(self, stat).copy()
+
+def _use_processes(input_list,processes):
+    """
+    Helper function: whether the reduction of `input_list` is split over `processes` processes, which is done for
+    lists of image files (and scalars) with more than one file; image objects are not sent to other processes.
+    The process pool needs multiprocessing.shared_memory (python 3.8 or newer), with older versions the reduction
+    is done in the current process, with a warning.
+    """
+    if processes > 1 and sys.version_info < (3, 8):
+        logger.warning("the reduction with several processes requires python 3.8 or newer, using a single process")
+        return False
+    return processes > 1 and sum(isinstance(item,str) for item in input_list) > 1 and \
+        not any(hasattr(item,"GetSpacing") for item in input_list)
+
+def _reduce_image_list(input_list,stats,jobs=1,processes=1):
+    """
+    Helper function for the streaming reductions: compute the statistics `stats` of a list of images (see `_iter_image_list`
+    and `image_reduce`) in a single pass. The images are read one at a time, so the memory use does not depend on the number of images.
+    With `processes` > 1, lists of files are split over a pool of processes (see `_parallel_reduce`).
+    Returns the `_RunningStatistics` and an image with the geometry of the result.
+    """
+    if _use_processes(input_list,processes):
+        return _parallel_reduce(input_list,list(stats),jobs,processes)
+    running = _RunningStatistics(stats)
+    for img in _iter_image_list(input_list,jobs,broadcast=True):
+        if running.n == 0:
+            info = _image_info(img)
+        running.add(_image_array(img))
+    return running, info
+
+# the reductions of `_parallel_reduce` that are not computed with `_RunningStatistics`
+_reduce_ufuncs = dict(product=np.multiply, min=np.minimum, max=np.maximum)
+
+# the accumulator arrays of `_RunningStatistics` (without the scratch array)
+_running_arrays = ("acc","mean","m2","min","max","count")
+
+def _reduce_partial(task):
+    """
+    Worker function for `_parallel_reduce`: reduce one part of the list of images, and copy the accumulators into new
+    shared memory blocks (that are unlinked by the main process).
+    Returns the number of images, the type of the result, the geometry of the images and the shared memory blocks.
+    """
+    from multiprocessing import shared_memory # python >= 3.8
+    reduction, input_list, jobs = task
+    if isinstance(reduction,str):
+        img = _apply_operation_to_image_list(_reduce_ufuncs[reduction],input_list,jobs=jobs)
+        arrays = dict(result=itk.array_view_from_image(img))
+        n, dtype = len(input_list), arrays["result"].dtype
+    else:
+        running, img = _reduce_image_list(input_list,reduction,jobs)
+        arrays = {name: getattr(running,name) for name in _running_arrays if hasattr(running,name)}
+        n, dtype = running.n, running.dtype
+    geometry = (tuple(_image_size(img)), tuple(img.GetSpacing()), tuple(img.GetOrigin()),
+                itk.array_from_matrix(img.GetDirection()))
+    shared = dict()
+    for name,a in arrays.items():
+        shm = shared_memory.SharedMemory(create=True,size=max(a.nbytes,1))
+        np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf)[...] = a
+        shared[name] = (shm.name,a.shape,a.dtype)
+        shm.close()
+    return n, dtype, geometry, shared
+
+def _parallel_reduce(input_list,reduction,jobs=1,processes=2):
+    """
+    Helper function: reduce a list of image files (and scalars) with a pool of `processes` worker processes.
+    `reduction` is a list of statistics (see `_RunningStatistics`) or one of the operations in `_reduce_ufuncs`.
+    Each worker reduces a contiguous part of the list (reading the files with `jobs` threads, see `read_images`)
+    into accumulators in shared memory, and the partial results are merged pairwise in a tree (the merges of one
+    level in threads), directly in the shared memory.
+    Returns the merged `_RunningStatistics` (or the array of the operation) and an image with the geometry of the result.
+    """
+    from multiprocessing import shared_memory # python >= 3.8
+    from multiprocessing import resource_tracker
+    files = [item for item in input_list if isinstance(item,str)]
+    others = [item for item in input_list if not isinstance(item,str)]
+    chunks = [list(c) for c in np.array_split(np.array(files,dtype=object),min(processes,len(files))) if len(c)]
+    # the scalars go with the first part, after its first image
+    chunks[0] += others
+    # check all the headers before starting the workers, this also finishes the lazy loading of the ITK modules
+    # before the workers are forked (instead of in each worker)
+    _check_image_files(input_list)
+    itk.ImageFileReader.New(FileName=files[0]).UpdateOutputInformation()
+    # the shared memory blocks of the workers are registered with the resource tracker of this process
+    resource_tracker.ensure_running()
+    results, shms, error = list(), list(), None
+    with multiprocessing.Pool(processes) as pool:
+        pending = [pool.apply_async(_reduce_partial,((reduction,chunk,jobs),)) for chunk in chunks]
+        for p in pending:
+            try:
+                results.append(p.get())
+            except Exception as e:
+                error = error or e
+    try:
+        for n,dtype,geometry,shared in results:
+            shms += [shared_memory.SharedMemory(name=name) for name,shape,adtype in shared.values()]
+        if error is not None:
+            raise error
+        size0, spacing0, origin0, direction0 = results[0][2]
+        for size, spacing, origin, direction in [r[2] for r in results[1:]]:
+            _check_geometry(size0,spacing0,origin0,size,spacing,origin)
+        info = _geometry_image(size0,spacing0,origin0,direction0)
+        partials, buffers = list(), iter(shms)
+        for n,dtype,geometry,shared in results:
+            arrays = {name: np.ndarray(shape,dtype=adtype,buffer=next(buffers).buf) for name,(shmname,shape,adtype) in shared.items()}
+            if isinstance(reduction,str):
+                partials.append(arrays["result"])
+                continue
+            running = _RunningStatistics(reduction)
+            running.n, running.dtype = n, dtype
+            for name,a in arrays.items():
+                setattr(running,name,a)
+            if running.variance:
+                running.delta = np.empty_like(running.mean)
+            partials.append(running)
+        def merge(a,b):
+            if not isinstance(reduction,str):
+                a.merge(b)
+                return a
+            rtype = np.result_type(a.dtype,b.dtype)
+            a = a if rtype == a.dtype else a.astype(rtype)
+            return _reduce_ufuncs[reduction](a,b,out=a)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,len(partials)//2)) as merger:
+            while len(partials) > 1:
+                merged = list(merger.map(merge,partials[0::2],partials[1::2]))
+                partials = merged + partials[len(merged)*2:]
+        result = partials[0]
+        del partials, arrays
+        # copy the result out of the shared memory
+        if isinstance(reduction,str):
+            result = result.copy()
+        else:
+            for name in _running_arrays:
+                if hasattr(result,name):
+                    setattr(result,name,getattr(result,name).copy())
+        return result, info
+    finally:
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                # after an error, arrays in the blocks can still be referenced by the traceback
+                pass
+            shm.unlink()
+
+def _mean_type(dtype):
+    """
+    Helper function: the type of the mean of arrays of type `dtype`, as with `np.mean`.
+    """
+    return dtype if dtype.kind == "f" else np.dtype(np.float64)
+
+def _reduce_output(stat,input_list,output_file,jobs,processes=1):
+    """
+    Helper function for the functions below: a single statistic of a list of images (the single image itself for a list of one image).
+    """
+    if len(input_list) == 1:
+        return _image_output(_image_list(input_list,jobs)[0], output_file)
+    running, info = _reduce_image_list(input_list,[stat],jobs,processes)
+    np_result = running.result(stat)
+    del running
+    return _array_output(np_result, info, output_file)
+
+# the statistics of image_reduce
+image_reduce_stats = ("sum","mean","std","sem","min","max","count")
 
+def image_reduce(input_list=[],stats=("sum","mean","std"),output_files=None,jobs=1,processes=1):
+    """
+    Computes several element-wise statistics of a list of images with equal geometry in a single pass, reading each
+    image (or image file) only once. The statistics are:
+    "sum", "mean", "std" (standard deviation), "sem" (standard error of the mean, std/sqrt(N)),
+    "min", "max" and "count" (the number of images in which the voxel is nonzero).
+    The images are processed one at a time (see `image_sum` and `image_std`, also for `jobs`), and only the accumulators
+    that are needed for the requested statistics are kept in memory.
+    With `processes` > 1, a list of image files is split over a pool of `processes` processes, and the partial
+    statistics are merged in a tree (see `_parallel_reduce`), with the same result up to rounding.
+    `output_files` is an optional dictionary with a filename for each statistic.
+    Returns a dictionary with an image for each statistic.
+    """
+    stats = list(stats)
+    output_files = dict() if output_files is None else output_files
+    running, info = _reduce_image_list(input_list,stats,jobs,processes)
+    logger.debug("computed {} of {} images".format(", ".join(stats),running.n))
+    return {stat: _array_output(running.result(stat), info, output_files.get(stat)) for stat in stats}
 
-def image_sum(input_list=[],output_file=None):
+def image_sum(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise sum of a list of image with equal geometry.
+    The images (or image files) are added one at a time, in double precision (64 bit integers for integer images).
+    With `jobs` > 1 the next files are read in `jobs` threads while the current image is added (see `read_images`).
+    With `processes` > 1 the files are split over `processes` processes, whose partial sums are added in a tree.
     """
-    return _apply_operation_to_image_list(operator.add,input_list,output_file)
+    return _reduce_output("sum",input_list,output_file,jobs,processes)
 
 
-def image_mean(input_list=[],output_file=None):
+def image_mean(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise mean of a list of image with equal geometry.
+    The images (or image files) are added one at a time, see `image_sum`.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = np.mean(np_list, axis=0)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    return _reduce_output("mean",input_list,output_file,jobs,processes)
     
 
-def image_std(input_list=[],output_file=None):
+def image_std(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise standard deviation of a list of image with equal geometry.
+    The images (or image files) are processed one at a time, with Welford's algorithm.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = np.std(np_list, axis=0)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    return _reduce_output("std",input_list,output_file,jobs,processes)
 
-def image_sem(input_list=[],output_file=None):
+def image_sem(input_list=[],output_file=None,jobs=1,processes=1):
     """
-    Computes element-wise standard deviation of a list of image with equal geometry.
+    Computes element-wise standard error of the mean (standard deviation/sqrt(N)) of a list of image with equal geometry.
+    The images (or image files) are processed one at a time, with Welford's algorithm.
+    The result has the pixel type of `image_std` and `image_mean`: float for float images (with numpy 2, the former
+    np.std(...)/np.sqrt(N) implementation gave double for float images), double for integer images.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    N = len(img_list)
-    np_result = np.std(np_list, axis=0)/np.sqrt(N)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    return _reduce_output("sem",input_list,output_file,jobs,processes)
     
 
-def image_product(input_list=[],output_file=None):
+def image_product(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise product of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(operator.mul,input_list,output_file)
+    return _apply_operation_to_image_list(np.multiply,input_list,output_file,jobs,processes)
 
-def image_min(input_list=[],output_file=None):
+def image_min(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise minimum of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(np.minimum,input_list,output_file)
+    return _apply_operation_to_image_list(np.minimum,input_list,output_file,jobs,processes)
 
-def image_max(input_list=[],output_file=None):
+def image_max(input_list=[],output_file=None,jobs=1,processes=1):
     """
     Computes element-wise maximum of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(np.maximum,input_list,output_file)
+    return _apply_operation_to_image_list(np.maximum,input_list,output_file,jobs,processes)
+
+# numpy types of the ITK pixel component types (see `_ImageFileInfo`)
+_component_types = {
+    "char": np.int8, "unsigned_char": np.uint8, "short": np.int16, "unsigned_short": np.uint16,
+    "int": np.int32, "unsigned_int": np.uint32, "long": np.int64, "unsigned_long": np.uint64,
+    "long_long": np.int64, "unsigned_long_long": np.uint64, "float": np.float32, "double": np.float64,
+}
+
+def _divide_result_type(input_list,numerator=None):
+    """
+    Helper function for `_divide_image_list`: the pixel type of the ratios (float32 or float64, with the type
+    promotion of np.true_divide), from the headers of the image files and the arrays of the image objects, so
+    that the output image can be allocated before any image file is read. Scalars count as float32.
+    """
+    rtype = None if numerator is None else np.dtype(np.float32)
+    for item in input_list:
+        if isinstance(item,str):
+            info = _image_file_info(item) if os.path.isfile(item) else None
+            dtype = np.dtype(_component_types.get(info.component_type if info else None, np.float32))
+        elif hasattr(item,"GetSpacing"):
+            dtype = itk.array_view_from_image(item).dtype
+        else:
+            dtype = np.dtype(np.float32)
+        rtype = dtype if rtype is None else np.true_divide(np.ones(1,dtype=rtype),np.ones(1,dtype=dtype)).dtype
+    return np.dtype(np.float64) if rtype == np.float64 else np.dtype(np.float32)
+
+def _divide_image_list(input_list,numerator=None,defval=0.,jobs=1):
+    """
+    Helper function for `image_divide` and `image_invert`: numerator/img1/img2/... or, without `numerator`,
+    img1/img2/img3/... (scalars are broadcast).
+    The output image (float or double, see `_divide_result_type`) is allocated first, with the geometry of the
+    first image, and the ratios are computed in place in its pixel buffer, so this is the only result buffer.
+    If `defval` is not None, the non-finite voxels (zero divisors, which are marked with NaN, NaN, and ratios that
+    overflow) get the value `defval`, using one boolean mask that is reused for all the divisors.
+    """
+    input_list = list(input_list)
+    rtype = _divide_result_type(input_list,numerator)
+    out = None
+    mask = None
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for img in _iter_image_list(input_list,jobs,broadcast=True):
+            a = _image_array(img)
+            if out is None:
+                out = itk.Image[itk.D if rtype == np.float64 else itk.F, img.GetImageDimension()].New()
+                out.SetRegions(img.GetLargestPossibleRegion())
+                out.CopyInformation(img)
+                out.Allocate()
+                np_result = itk.array_view_from_image(out)
+                if numerator is None:
+                    np_result[...] = a
+                    continue
+                np_result.fill(numerator)
+            if defval is None:
+                np.true_divide(np_result, a, out=np_result, casting='same_kind')
+            elif np.ndim(a) == 0:
+                if a == 0:
+                    np_result.fill(np.nan)
+                else:
+                    np_result /= a
+            else:
+                if mask is None:
+                    mask = np.empty(np_result.shape, dtype=bool)
+                # mark the voxels with a zero divisor, NaN stays NaN in the next divisions
+                np.not_equal(a, 0, out=mask)
+                np.true_divide(np_result, a, out=np_result, where=mask, casting='same_kind')
+                np.logical_not(mask, out=mask)
+                np.copyto(np_result, np.nan, where=mask)
+        if defval is not None:
+            if mask is None:
+                mask = np.empty(np_result.shape, dtype=bool)
+            np.isfinite(np_result, out=mask)
+            np.logical_not(mask, out=mask)
+            np.copyto(np_result, defval, where=mask)
+    return out
 
-def image_divide(input_list=[], defval=0.,output_file=None):
+def image_divide(input_list=[], defval=0.,output_file=None,jobs=1):
     """
-    Computes element-wise ratio of two images with equal geometry.
-    Non-finite values are replaced with defvalue (unless it's None).
+    Computes element-wise ratio of images with equal geometry: img1/img2/img3/... (scalars are broadcast).
+    Non-finite values (voxels with a zero divisor, NaN, and ratios that overflow) are replaced with defvalue (unless it's None).
+    The ratios are computed in place in the pixel buffer of the output image, without changing the numpy error settings.
     """
-    np.seterr(divide='ignore', invalid='ignore')
-    raw_result = _apply_operation_to_image_list(operator.truediv,input_list=input_list)
-    # FIXME: where do numpy/ITK store the value of the "maximum value that can be respresented with a 32bit float"?
     # FIXME: maybe we should/wish to support integer division as well?
-    mask = itk.array_view_from_image(raw_result)>1e38
-    if np.sum(mask)==0:
-        return _image_output(raw_result,output_file)
-    ratios = itk.array_from_image(raw_result)
-    ratios[mask] = defval
-    fixed_result = itk.image_from_array(ratios)
-    fixed_result.CopyInformation(raw_result)
-    return _image_output(fixed_result,output_file)
-
-def image_absolute_relative_difference_max(input_list=[], defval=0.,output_file=None):
+    return _image_output(_divide_image_list(input_list,defval=defval,jobs=jobs), output_file)
+
+def image_absolute_relative_difference_max(input_list=[], defval=0.,output_file=None,jobs=1):
     """    
     Computes element-wise absolute relative difference (|A-B|)/max(A) of
     two images with equal geometry.  Non-finite values are replaced
@@ -235,7 +752,7 @@ def image_absolute_relative_difference_max(input_list=[], defval=0.,output_file=
     if len(input_list) != 2:
         raise RuntimeError("Two images must be provided to reldiff operator")
 
-    img_list = _image_list(input_list)
+    img_list = _image_list(input_list,jobs)
     np_list = [ itk.array_view_from_image(img) for img in img_list]
     np_1 = np_list[0]
     np_2 = np_list[1]
@@ -245,28 +762,254 @@ def image_absolute_relative_difference_max(input_list=[], defval=0.,output_file=
     img.CopyInformation(img_list[0])
     return _image_output(img, output_file)
 
-def image_invert(input_list=[],output_file=None):
+def image_invert(input_list=[],output_file=None,jobs=1):
+    """
+    Computes element-wise invert of a list of image with equal geometry: 1/img1/img2/...
+    The output image is filled with ones and divided in place (see `image_divide`), voxels with a zero divisor get 0.
+    """
+    return _image_output(_divide_image_list(input_list,numerator=1.,jobs=jobs), output_file)
+
+# operators and functions that can be used in the expressions of `image_expression`
+_expression_operators = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide, ast.Pow: np.power,
+    ast.USub: np.negative, ast.UAdd: np.positive,
+    ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Eq: np.equal, ast.NotEq: np.not_equal,
+}
+_expression_functions = {
+    "abs": np.abs, "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log10": np.log10,
+    "minimum": np.minimum, "maximum": np.maximum, "where": np.where,
+}
+_expression_constants = {"pi": np.pi, "e": np.e}
+
+def _compile_expression(expression, names):
+    """
+    Helper function for `image_expression`: parse the arithmetic `expression` and return a function that evaluates
+    it for a dictionary with an array (or scalar) for each of the `names`.
+    The expression is parsed with the Python parser, but only numbers, the names, the operators in `_expression_operators`
+    and calls of the functions in `_expression_functions` are accepted (a `ValueError` is raised for anything else),
+    so evaluating it cannot have side effects.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as se:
+        raise ValueError("invalid expression '{}': {}".format(expression, se.msg))
+    def build(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in _expression_operators:
+            op, left, right = _expression_operators[type(node.op)], build(node.left), build(node.right)
+            return lambda values: op(left(values), right(values))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _expression_operators:
+            op, operand = _expression_operators[type(node.op)], build(node.operand)
+            return lambda values: op(operand(values))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _expression_operators:
+            op, left, right = _expression_operators[type(node.ops[0])], build(node.left), build(node.comparators[0])
+            return lambda values: op(left(values), right(values))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _expression_functions and not node.keywords:
+            f, args = _expression_functions[node.func.id], [build(arg) for arg in node.args]
+            return lambda values: f(*[arg(values) for arg in args])
+        if isinstance(node, ast.Name) and node.id in names:
+            name = node.id
+            return lambda values: values[name]
+        if isinstance(node, ast.Name) and node.id in _expression_constants:
+            value = _expression_constants[node.id]
+            return lambda values: value
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            return lambda values: value
+        if sys.version_info < (3, 8) and isinstance(node, ast.Num) and type(node.n) in (int, float):
+            # before python 3.8 the numbers are ast.Num nodes
+            value = node.n
+            return lambda values: value
+        if isinstance(node, ast.Name):
+            raise ValueError("unknown name '{}' in expression '{}', known names are: {}".format(node.id, expression, ", ".join(sorted(names))))
+        raise ValueError("unsupported element '{}' in expression '{}'".format(ast.dump(node), expression))
+    return build(tree.body)
+
+def image_expression(expression, inputs, output_file=None, chunk_size=2**16):
     """
-    Computes element-wise invert of a list of image with equal geometry.
-    Add image with ones at the beginning of the list and use the division
+    Computes a voxel-wise arithmetic expression of named images and scalars, e.g.
+    image_expression("(a+b)/c*0.5", dict(a=img1, b="dose2.mhd", c=img3)).
+    The `inputs` dictionary maps names to images, image filenames or scalars; all images must have equal geometry.
+    The expression can use the names, numbers, the constants pi and e, the operators + - * / ** (and comparisons,
+    which give 0 or 1), and the functions abs, sqrt, exp, log, log10, minimum(x,y), maximum(x,y) and where(condition,x,y).
+    The expression is evaluated in chunks of `chunk_size` voxels, directly into the output image (with pixel type float),
+    so apart from the input images only temporary arrays with the size of a chunk are created. Scalars are not
+    converted to images. Division by zero is not an error; the resulting non-finite values can be replaced with `where`.
     """
-    duplicator = itk.ImageDuplicator.New(input_list[0])
-    duplicator.Update()
-    InputType = type(input_list[0])
-    input_dimension = input_list[0].GetImageDimension()
-    OutputType = itk.Image[itk.F, input_dimension]
-    castFilter = itk.CastImageFilter[InputType, OutputType].New()
-    castFilter.SetInput(duplicator.GetOutput())
-    castFilter.Update()
-    scalarImage = castFilter.GetOutput()
-    scalarImage.FillBuffer(1.0)
-    input_list = [scalarImage] + input_list
-    return image_divide(input_list=input_list,output_file=output_file)
+    for name in inputs:
+        if not name.isidentifier() or name in _expression_functions or name in _expression_constants:
+            raise ValueError("invalid input name '{}'".format(name))
+    f = _compile_expression(expression, inputs)
+    names = [name for name,value in inputs.items() if isinstance(value, str) or hasattr(value, "GetSpacing")]
+    if not names:
+        raise RuntimeError("got no images")
+    img_list = _image_list([inputs[name] for name in names])
+    values = {name: value for name,value in inputs.items() if name not in names}
+    arrays = {name: itk.array_view_from_image(img).reshape(-1) for name,img in zip(names,img_list)}
+    output = itk.Image[itk.F, img_list[0].GetImageDimension()].New()
+    output.SetRegions(img_list[0].GetLargestPossibleRegion())
+    output.CopyInformation(img_list[0])
+    output.Allocate()
+    np_output = itk.array_view_from_image(output).reshape(-1)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for i0 in range(0, len(np_output), chunk_size):
+            chunk = slice(i0, i0+chunk_size)
+            values.update((name, a[chunk]) for name,a in arrays.items())
+            np_output[chunk] = f(values)
+    return _image_output(output, output_file)
+
+# numpy types of the MetaImage element types (MET_LONG is 4 bytes in MetaIO)
+_mhd_element_types = {
+    "MET_CHAR": np.int8, "MET_UCHAR": np.uint8, "MET_SHORT": np.int16, "MET_USHORT": np.uint16,
+    "MET_INT": np.int32, "MET_UINT": np.uint32, "MET_LONG": np.int32, "MET_ULONG": np.uint32,
+    "MET_LONG_LONG": np.int64, "MET_ULONG_LONG": np.uint64, "MET_FLOAT": np.float32, "MET_DOUBLE": np.float64,
+}
+
+def _read_mhd_header(filename):
+    """
+    Helper function: parse the header of a MetaImage file (.mhd or .mha) into a dictionary of strings.
+    The key "_data_offset" gives the position of the end of the header in the file (after the ElementDataFile line).
+    """
+    header = dict()
+    with open(filename, "rb") as f:
+        for line in f:
+            key, sep, value = line.decode("latin-1").partition("=")
+            if not sep:
+                raise ValueError("{} is not a MetaImage file (line '{}')".format(filename, line.strip()))
+            header[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                header["_data_offset"] = f.tell()
+                break
+    if "ElementDataFile" not in header:
+        raise ValueError("{} is not a MetaImage file (no ElementDataFile)".format(filename))
+    return header
+
+def _mhd_geometry(header):
+    """
+    Helper function: size (x,y,z order), spacing and origin in the MetaImage `header` (see `_read_mhd_header`).
+    """
+    size = [int(v) for v in header["DimSize"].split()]
+    spacing = [float(v) for v in header.get("ElementSpacing", header.get("ElementSize", " ".join(["1"]*len(size)))).split()]
+    origin = [float(v) for v in header.get("Offset", header.get("Origin", header.get("Position", " ".join(["0"]*len(size))))).split()]
+    return size, spacing, origin
+
+def _mhd_memmap(filename, mode="r"):
+    """
+    Helper function: memory map the pixel data of an uncompressed MetaImage file (header with a separate data
+    file, or .mha with the data after the header), as an array with the numpy (z,y,x) shape.
+    Returns the array and the parsed header. A `ValueError` is raised for compressed data, lists of data files
+    and multi-component pixels, which cannot be memory mapped.
+    """
+    header = _read_mhd_header(filename)
+    if header.get("CompressedData", "False").lower() == "true":
+        raise ValueError("{} has compressed data, which cannot be memory mapped".format(filename))
+    if int(header.get("ElementNumberOfChannels", "1")) != 1:
+        raise ValueError("{} has multi-component pixels, which are not supported".format(filename))
+    if header.get("ElementType") not in _mhd_element_types:
+        raise ValueError("{} has unsupported element type {}".format(filename, header.get("ElementType")))
+    dtype = np.dtype(_mhd_element_types[header["ElementType"]])
+    msb = header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False")).lower() == "true"
+    dtype = dtype.newbyteorder(">" if msb else "<")
+    size = _mhd_geometry(header)[0]
+    nbytes = int(np.prod(size))*dtype.itemsize
+    datafile = header["ElementDataFile"]
+    if datafile == "LOCAL":
+        datafile, offset = filename, header["_data_offset"]
+    elif datafile.startswith("LIST") or "%" in datafile:
+        raise ValueError("{} has a list of data files, which is not supported".format(filename))
+    else:
+        datafile = os.path.join(os.path.dirname(os.path.abspath(filename)), datafile)
+        offset = int(header.get("HeaderSize", "0"))
+    if offset < 0:
+        # HeaderSize = -1: the data are at the end of the file
+        offset = os.path.getsize(datafile) - nbytes
+    return np.memmap(datafile, dtype=dtype, mode=mode, offset=offset, shape=tuple(size[::-1])), header
+
+def _create_mhd(filename, header, dtype):
+    """
+    Helper function: create an uncompressed MetaImage file with the geometry of `header` (see `_read_mhd_header`)
+    and pixel type `dtype`, with the data in a .raw file next to it. Returns the memory mapped pixel data.
+    """
+    element_type = [k for k,v in _mhd_element_types.items() if np.dtype(v) == dtype.newbyteorder("=")][0]
+    base = os.path.splitext(filename)[0]
+    size, spacing, origin = _mhd_geometry(header)
+    lines = [("ObjectType", "Image"), ("NDims", len(size)), ("BinaryData", "True"), ("BinaryDataByteOrderMSB", "False"),
+             ("CompressedData", "False")]
+    lines += [(key, header[key]) for key in ("TransformMatrix", "CenterOfRotation") if key in header]
+    lines += [("Offset", " ".join(str(v) for v in origin))]
+    lines += [(key, header[key]) for key in ("AnatomicalOrientation",) if key in header]
+    lines += [("ElementSpacing", " ".join(str(v) for v in spacing)), ("DimSize", " ".join(str(v) for v in size)),
+              ("ElementType", element_type), ("ElementDataFile", os.path.basename(base)+".raw")]
+    with open(filename, "w") as f:
+        f.write("".join("{} = {}\n".format(k,v) for k,v in lines))
+    return np.memmap(base+".raw", dtype=dtype.newbyteorder("<"), mode="w+", shape=tuple(size[::-1]))
+
+# the operations of `image_chunked_operation`
+image_chunked_operations = ("sum","mean","product","min","max")
+
+def image_chunked_operation(operation, input_list, output_file, memory_budget=2**28):
+    """
+    Out-of-core version of `image_sum`, `image_mean`, `image_product`, `image_min` and `image_max` for uncompressed
+    MetaImage files (.mhd with a .raw data file, or .mha), for volumes that do not fit in memory.
+    The inputs (filenames and/or scalars) are memory mapped (see `_mhd_memmap`) and processed slab by slab (along
+    the slowest axis), and each slab of the result is written directly into the memory mapped data of `output_file`
+    (a .mhd file, with a .raw data file next to it, which must not be one of the input files, else a `ValueError`
+    is raised: the output data are written while the inputs are read). The slabs are chosen such that the slabs of an input, of the
+    accumulator and of the output fit in `memory_budget` bytes (at least one slice).
+    The geometries of the headers are checked before any data are read. The result type is the same as for the
+    in-memory operations (scalars count as float images, see `_image_list`).
+    Returns the name of the output file.
+    """
+    if operation not in image_chunked_operations:
+        raise ValueError("unknown operation '{}', should be one of {}".format(operation, ", ".join(image_chunked_operations)))
+    if os.path.splitext(output_file)[1].lower() != ".mhd":
+        raise ValueError("the output of an out-of-core operation should be a .mhd file, got {}".format(output_file))
+    arrays = list()
+    header0 = None
+    output_files = {os.path.realpath(f) for f in (output_file, os.path.splitext(output_file)[0]+".raw")}
+    for item in input_list:
+        if not isinstance(item, str):
+            if header0 is None:
+                raise RuntimeError("Pass an image before a scalar to have a model")
+            arrays.append(np.float32(item))
+            continue
+        a, header = _mhd_memmap(item)
+        if output_files & {os.path.realpath(item), os.path.realpath(a.filename)}:
+            raise ValueError("the output {} would overwrite the input {}".format(output_file, item))
+        if header0 is None:
+            header0, size0, spacing0, origin0 = (header,) + _mhd_geometry(header)
+        _check_geometry(size0,spacing0,origin0,*_mhd_geometry(header),name=item)
+        arrays.append(a)
+    if header0 is None:
+        raise RuntimeError("got no images")
+    rtype = np.result_type(*[a.dtype.newbyteorder("=") for a in arrays])
+    if operation == "mean":
+        rtype = _mean_type(rtype)
+    acctype = _accumulator_type(rtype) if operation in ("sum","mean") else rtype
+    op = dict(sum=np.add, mean=np.add, product=np.multiply, min=np.minimum, max=np.maximum)[operation]
+    output = _create_mhd(output_file, header0, rtype)
+    slice_bytes = output[0].size*(max(a.dtype.itemsize for a in arrays) + acctype.itemsize + rtype.itemsize)
+    nslices = max(1, int(memory_budget//slice_bytes))
+    logger.debug("{} of {} inputs in slabs of {} slice(s)".format(operation, len(arrays), nslices))
+    for z0 in range(0, output.shape[0], nslices):
+        slab = slice(z0, z0+nslices)
+        acc = np.array(arrays[0][slab] if np.ndim(arrays[0]) else arrays[0], dtype=acctype)
+        for a in arrays[1:]:
+            op(acc, a[slab] if np.ndim(a) else a, out=acc)
+        if operation == "mean":
+            acc /= len(arrays)
+        output[slab] = acc
+        del acc
+    output.flush()
+    del output
+    return output_file
 
 
 #####################################################################################
 import unittest
 import sys
+import tempfile
+import tracemalloc
+import warnings
 from datetime import datetime
 from .logging_conf import LoggedTestCase
 
@@ -450,6 +1193,55 @@ class Test_Divide(LoggedTestCase):
         self.assertTrue( np.allclose(itk.array_from_image(imgdivide),1.0))
         self.assertTrue( np.allclose(imgdivide.GetSpacing(),spacing))
         self.assertTrue( np.allclose(imgdivide.GetOrigin(),origin))
+    def test_zeros_and_scalars(self):
+        logger.info('Test_Divide test_zeros_and_scalars')
+        a = np.array([[1.,0.,-2.],[4.,0.,6.]],dtype=np.float32)
+        b = np.array([[2.,0.,0.],[0.,1.,3.]],dtype=np.float32)
+        c = np.array([[1.,1.,1.],[1.,1.,0.]],dtype=np.float32)
+        imgs = [itk.image_from_array(x) for x in (a,b,c)]
+        settings = np.geterr()
+        # zero divisors (also in the last divisor, after a valid division) get the default value
+        self.assertTrue(np.array_equal(itk.array_view_from_image(image_divide(imgs)),[[0.5,0.,0.],[0.,0.,0.]]))
+        self.assertTrue(np.array_equal(itk.array_view_from_image(image_divide(imgs,defval=-1.)),[[0.5,-1.,-1.],[-1.,0.,-1.]]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.assertTrue(np.allclose(itk.array_view_from_image(image_divide(imgs[:2],defval=None)),a/b,equal_nan=True))
+        self.assertTrue(np.allclose(itk.array_view_from_image(image_invert(imgs[1:2])),[[0.5,0.,0.],[0.,1.,1/3.]]))
+        # ratios that overflow get the default value too, without a numpy warning
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            big = itk.image_from_array(np.array([[3e38,-3e38,1.]],dtype=np.float32))
+            self.assertTrue(np.allclose(itk.array_view_from_image(image_divide([big,1e-3])),[[0.,0.,1000.]]))
+            self.assertTrue(np.allclose(itk.array_view_from_image(image_divide([big,1e-3],defval=-1.)),[[-1.,-1.,1000.]]))
+        # no global side effect on the numpy error settings
+        self.assertEqual(np.geterr(),settings)
+        # scalars are broadcast
+        self.assertTrue(np.allclose(itk.array_view_from_image(image_divide([imgs[0],2.])),a/2.))
+        self.assertTrue(np.array_equal(itk.array_view_from_image(image_divide([imgs[0],0.])),np.zeros_like(a)))
+        self.assertTrue(np.allclose(itk.array_view_from_image(image_invert([imgs[2],4.])),[[0.25,0.25,0.25],[0.25,0.25,0.]]))
+        for op,expected in [(image_sum,a+3.),(image_product,a*3.),(image_max,np.maximum(a,3.)),(image_mean,(a+3.)/2)]:
+            img = op([imgs[0],3.])
+            self.assertTrue(type(img) == itk.Image[itk.F,2])
+            self.assertTrue(np.allclose(itk.array_view_from_image(img),expected))
+        # integer images: double precision ratios, float ratios for the invert
+        i = itk.image_from_array(np.array([[1,2],[3,0]],dtype=np.uint16))
+        self.assertTrue(type(image_divide([i,i])) == itk.Image[itk.D,2])
+        self.assertTrue(type(image_invert([i])) == itk.Image[itk.F,2])
+    def test_memory(self):
+        logger.info('Test_Divide test_memory')
+        shape = (40,50,60)
+        nbytes = 4*np.prod(shape)
+        imgs = [itk.image_from_array(np.full(shape,x,dtype=np.float32)) for x in (6.,2.,3.)]
+        itk.array_view_from_image(imgs[1])[0,0,:10] = 0.
+        for op in (image_divide,image_invert):
+            tracemalloc.start()
+            img = op(imgs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            logger.debug("{}: peak numpy memory {} bytes for images of {} bytes".format(op.__name__,peak,nbytes))
+            # the result buffer is the pixel buffer of the output image, allocated by ITK (not seen by tracemalloc):
+            # a numpy result array, or a copy of it, would be seen; only the boolean mask (nbytes/4) is expected, and small objects
+            self.assertLess(peak,0.4*nbytes)
+            self.assertTrue(np.allclose(itk.array_view_from_image(img)[1:],(6./2/3.) if op is image_divide else 1./6/2/3))
 
 class Test_Invert(LoggedTestCase):
     def test_three_3D_images(self):
@@ -469,5 +1261,246 @@ class Test_Invert(LoggedTestCase):
         self.assertTrue(np.allclose(imginvert.GetSpacing(), spacing))
         self.assertTrue(np.allclose(imginvert.GetOrigin(), origin))
 
+def _write_test_images(tmpdir,arrays):
+    filenames = list()
+    for i,a in enumerate(arrays):
+        img = itk.image_from_array(a)
+        img.SetSpacing((2.,3.,4.))
+        img.SetOrigin((-1.,-2.,-3.))
+        filenames.append(os.path.join(tmpdir,"img{}.mhd".format(i)))
+        itk.imwrite(img,filenames[-1])
+    return filenames
+
+class Test_Streaming(LoggedTestCase):
+    def test_statistics(self):
+        logger.info('Test_Streaming test_statistics')
+        np.random.seed(1234)
+        arrays = [np.random.normal(100.,10.,(5,6,7)).astype(np.float32) for i in range(9)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            stack = np.array(arrays,dtype=np.float64)
+            for op,expected in [(image_sum,np.sum(stack,axis=0)),
+                                (image_mean,np.mean(stack,axis=0)),
+                                (image_std,np.std(stack,axis=0)),
+                                (image_sem,np.std(stack,axis=0)/np.sqrt(len(arrays)))]:
+                img = op(filenames)
+                self.assertTrue(type(img) == itk.Image[itk.F,3])
+                self.assertTrue(np.allclose(itk.array_view_from_image(img),expected,rtol=1e-6))
+                self.assertTrue(np.allclose(img.GetSpacing(),(2.,3.,4.)))
+                self.assertTrue(np.allclose(img.GetOrigin(),(-1.,-2.,-3.)))
+            # images and file names can be mixed
+            img = image_mean([itk.imread(filenames[0])]+filenames[1:])
+            self.assertTrue(np.allclose(itk.array_view_from_image(img),np.mean(stack,axis=0),rtol=1e-6))
+            # integer images: exact sum (with the type of the images), double precision mean
+            iarrays = [np.random.randint(0,1000,(5,6,7)).astype(np.uint16) for i in range(4)]
+            ifilenames = _write_test_images(tmpdir,iarrays)
+            self.assertTrue((itk.array_view_from_image(image_sum(ifilenames))==np.sum(iarrays,axis=0)).all())
+            self.assertTrue(np.allclose(itk.array_view_from_image(image_mean(ifilenames)),np.mean(iarrays,axis=0)))
+            # the standard error of the mean has the type of the standard deviation and of the mean
+            for files,itype in [(filenames,itk.F),(ifilenames,itk.D)]:
+                for op in (image_mean,image_std,image_sem):
+                    self.assertTrue(type(op(files)) == itk.Image[itype,3])
+    def test_jobs(self):
+        logger.info('Test_Streaming test_jobs')
+        np.random.seed(4321)
+        arrays = [np.random.uniform(0.,1.,(4,5,6)).astype(np.float32) for i in range(7)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            # the prefetching reader keeps the order of the inputs
+            for jobs in (1,2,3,10):
+                items = list(read_images(filenames+[42.],jobs))
+                self.assertEqual(len(items),len(arrays)+1)
+                self.assertEqual(items[-1],42.)
+                for img,a in zip(items,arrays):
+                    self.assertTrue(np.array_equal(itk.array_view_from_image(img),a))
+                for op in (image_sum,image_std,image_max,image_divide):
+                    self.assertTrue(np.array_equal(itk.array_view_from_image(op(filenames,jobs=jobs)),
+                                                   itk.array_view_from_image(op(filenames))))
+            # incompatible geometry
+            img = itk.image_from_array(arrays[0])
+            itk.imwrite(img,os.path.join(tmpdir,"other.mhd"))
+            with self.assertRaises(TypeError):
+                image_sum(filenames[:3]+[os.path.join(tmpdir,"other.mhd")]+filenames[3:],jobs=3)
+    def test_headers(self):
+        logger.info('Test_Streaming test_headers')
+        arrays = [np.full((4,5,6),i,dtype=np.float32) for i in range(5)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            info = _image_file_info(filenames[0])
+            self.assertEqual(info.size,(6,5,4))
+            self.assertTrue(np.allclose(info.spacing,(2.,3.,4.)))
+            self.assertTrue(np.allclose(info.origin,(-1.,-2.,-3.)))
+            self.assertEqual(info.component_type,"float")
+            # cached, until the file changes
+            self.assertTrue(_image_file_info(filenames[0]) is info)
+            other = os.path.join(tmpdir,"other.mhd")
+            itk.imwrite(itk.image_from_array(arrays[0]),other)
+            self.assertTrue(np.allclose(_image_file_info(other).spacing,(1.,1.,1.)))
+            itk.imwrite(itk.imread(filenames[0]),other)
+            self.assertTrue(np.allclose(_image_file_info(other).spacing,(2.,3.,4.)))
+            # an incompatible file at the end of the list is found before any pixel data are read
+            itk.imwrite(itk.image_from_array(np.zeros((4,5,7),dtype=np.float32)),other)
+            for filename in filenames:
+                os.remove(filename.replace(".mhd",".raw"))
+            with self.assertRaises(TypeError):
+                image_sum(filenames+[other])
+            with self.assertRaises(TypeError):
+                image_reduce(filenames+[other],["sum","std"])
+    def test_memory(self):
+        logger.info('Test_Streaming test_memory')
+        shape = (20,30,40)
+        nbytes = 8*np.prod(shape)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,[np.full(shape,i,dtype=np.float32) for i in range(12)])
+            for op in (image_sum,image_mean,image_std,image_sem):
+                peaks = list()
+                for n in (3,12):
+                    tracemalloc.start()
+                    op(filenames[:n])
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                logger.debug("{}: peak memory {} bytes for 3 images and {} bytes for 12 images".format(op.__name__,*peaks))
+                # the memory use does not depend on the number of images: at most a few double precision images
+                self.assertLess(peaks[1],1.1*peaks[0]+nbytes/10)
+                self.assertLess(peaks[1],4*nbytes)
+
+class Test_Reduce(LoggedTestCase):
+    def test_reduce(self):
+        logger.info('Test_Reduce test_reduce')
+        np.random.seed(2468)
+        arrays = [np.random.normal(1.,1.,(5,6,7)).astype(np.float32) for i in range(9)]
+        for a in arrays:
+            a[a<0.5] = 0.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            output_files = {stat: os.path.join(tmpdir,"out_{}.mhd".format(stat)) for stat in image_reduce_stats}
+            imgs = image_reduce(filenames,image_reduce_stats,output_files=output_files,jobs=2)
+            self.assertEqual(set(imgs),set(image_reduce_stats))
+            stack = np.array(arrays,dtype=np.float64)
+            expected = dict(sum=np.sum(stack,axis=0),mean=np.mean(stack,axis=0),std=np.std(stack,axis=0),
+                            sem=np.std(stack,axis=0)/3.,min=np.min(stack,axis=0),max=np.max(stack,axis=0),
+                            count=np.count_nonzero(stack,axis=0))
+            for stat,img in imgs.items():
+                self.assertTrue(np.allclose(itk.array_view_from_image(img),expected[stat],rtol=1e-6))
+                self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(output_files[stat])),expected[stat],rtol=1e-6))
+                self.assertTrue(np.allclose(img.GetSpacing(),(2.,3.,4.)))
+            # the minimum and maximum have the type of the images, the count the smallest integer type
+            self.assertTrue(type(imgs["min"]) == itk.Image[itk.F,3])
+            self.assertTrue(type(imgs["max"]) == itk.Image[itk.F,3])
+            self.assertTrue(type(imgs["count"]) == itk.Image[itk.UC,3])
+            # a subset of the statistics gives the same result
+            img = image_reduce(filenames,["std"])["std"]
+            self.assertTrue(np.allclose(itk.array_view_from_image(img),expected["std"],rtol=1e-6))
+            with self.assertRaises(ValueError):
+                image_reduce(filenames,["sum","median"])
+    @unittest.skipIf(sys.version_info < (3,8), "the reduction with several processes requires python 3.8")
+    def test_processes(self):
+        logger.info('Test_Reduce test_processes')
+        np.random.seed(1357)
+        arrays = [np.random.normal(1.,1.,(5,6,7)).astype(np.float32) for i in range(11)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            expected = image_reduce(filenames,image_reduce_stats)
+            # the partial statistics of 2, 3 or 4 parts of the list (the last ones with different numbers of images)
+            for processes in (2,3,4):
+                imgs = image_reduce(filenames,image_reduce_stats,processes=processes)
+                for stat,img in imgs.items():
+                    self.assertTrue(type(img) == type(expected[stat]))
+                    self.assertTrue(np.allclose(itk.array_view_from_image(img),itk.array_view_from_image(expected[stat]),rtol=1e-6))
+                    self.assertTrue(np.allclose(img.GetSpacing(),(2.,3.,4.)))
+                    self.assertTrue(np.allclose(img.GetOrigin(),(-1.,-2.,-3.)))
+                for op in (image_sum,image_mean,image_std,image_product,image_min,image_max):
+                    self.assertTrue(np.allclose(itk.array_view_from_image(op(filenames,processes=processes,jobs=2)),
+                                                itk.array_view_from_image(op(filenames)),rtol=1e-6))
+            img = image_sum(filenames+[42.],processes=3)
+            self.assertTrue(np.allclose(itk.array_view_from_image(img),np.sum(arrays,axis=0)+42.,rtol=1e-6))
+            # incompatible geometry in one of the parts
+            other = os.path.join(tmpdir,"other.mhd")
+            itk.imwrite(itk.image_from_array(arrays[0]),other)
+            with self.assertRaises(TypeError):
+                image_sum(filenames+[other],processes=3)
+
+class Test_Expression(LoggedTestCase):
+    def test_expression(self):
+        logger.info('Test_Expression test_expression')
+        np.random.seed(2468)
+        shape = (20,30,40)
+        a, b, c = [np.random.uniform(0.,2.,shape).astype(np.float32) for i in range(3)]
+        c[0,0,:5] = 0.
+        imgs = [itk.image_from_array(x) for x in (a,b,c)]
+        for img in imgs:
+            img.SetSpacing((2.,3.,4.))
+            img.SetOrigin((-1.,-2.,-3.))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fb = os.path.join(tmpdir,"b.mhd")
+            itk.imwrite(imgs[1],fb)
+            inputs = dict(a=imgs[0],b=fb,c=imgs[2],k=0.5)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for expression,expected in [("(a+b)/c*0.5",(a+b)/c*0.5),
+                                            ("-a**2 + sqrt(b)*k - 3",-a**2+np.sqrt(b)*0.5-3),
+                                            ("where(c > 0, a/c, 0.)",np.where(c>0,a/c,0.)),
+                                            ("maximum(a,b) - minimum(a,b) + abs(a-b) + exp(-c) + log(1+c) + pi",
+                                             np.maximum(a,b)-np.minimum(a,b)+np.abs(a-b)+np.exp(-c)+np.log(1+c)+np.pi),
+                                            ("2.5",np.full(shape,2.5))]:
+                    # small chunks, that do not divide the number of voxels
+                    img = image_expression(expression,inputs,chunk_size=1000+7)
+                    self.assertTrue(type(img) == itk.Image[itk.F,3])
+                    self.assertTrue(np.allclose(itk.array_view_from_image(img),expected,rtol=1e-5,equal_nan=True))
+                    self.assertTrue(np.allclose(img.GetSpacing(),(2.,3.,4.)))
+                    self.assertTrue(np.allclose(img.GetOrigin(),(-1.,-2.,-3.)))
+        # only temporary arrays with the size of a chunk
+        big = [itk.image_from_array(np.ones((50,60,70),dtype=np.float32)) for i in range(3)]
+        tracemalloc.start()
+        image_expression("(a+b)/c*0.5+sqrt(a*b)",dict(a=big[0],b=big[1],c=big[2]),chunk_size=1000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak,50*60*70*4/10)
+        # no side effects
+        for expression in ["__import__('os').remove('x')","a.__class__","[a,b]","a if b else c","lambda: a","sum(a)","a < b < c","x+a","a+"]:
+            with self.assertRaises(ValueError):
+                image_expression(expression,dict(a=imgs[0],b=imgs[1],c=imgs[2]))
+        with self.assertRaises(ValueError):
+            image_expression("sqrt+1",dict(sqrt=imgs[0]))
+        with self.assertRaises(TypeError):
+            image_expression("a+b",dict(a=imgs[0],b=itk.image_from_array(a)))
+
+class Test_Chunked(LoggedTestCase):
+    def test_chunked(self):
+        logger.info('Test_Chunked test_chunked')
+        np.random.seed(1357)
+        arrays = [np.random.uniform(0.5,2.,(9,6,7)).astype(np.float32) for i in range(5)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = _write_test_images(tmpdir,arrays)
+            output = os.path.join(tmpdir,"out.mhd")
+            for operation,op in [("sum",image_sum),("mean",image_mean),("product",image_product),("min",image_min),("max",image_max)]:
+                # slabs of two slices, the last one with a single slice
+                image_chunked_operation(operation,filenames,output,memory_budget=2*6*7*(4+8+4))
+                img = itk.imread(output)
+                self.assertTrue(type(img) == itk.Image[itk.F,3])
+                self.assertTrue(np.allclose(itk.array_view_from_image(img),itk.array_view_from_image(op(filenames)),rtol=1e-6))
+                self.assertTrue(np.allclose(img.GetSpacing(),(2.,3.,4.)))
+                self.assertTrue(np.allclose(img.GetOrigin(),(-1.,-2.,-3.)))
+            # scalars and integer images, with the same result as in memory
+            iarrays = [np.random.randint(0,1000,(9,6,7)).astype(np.uint16) for i in range(3)]
+            os.mkdir(os.path.join(tmpdir,"int"))
+            ifilenames = _write_test_images(os.path.join(tmpdir,"int"),iarrays)
+            image_chunked_operation("sum",ifilenames,output,memory_budget=1)
+            self.assertTrue((itk.array_view_from_image(itk.imread(output))==np.sum(iarrays,axis=0)).all())
+            image_chunked_operation("sum",filenames[:2]+[42.],output)
+            self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(output)),arrays[0]+arrays[1]+42.,rtol=1e-6))
+            # incompatible geometry, compressed data
+            other = os.path.join(tmpdir,"other.mhd")
+            itk.imwrite(itk.image_from_array(arrays[0]),other)
+            with self.assertRaises(TypeError):
+                image_chunked_operation("sum",filenames+[other],output)
+            itk.imwrite(itk.imread(filenames[0]),other,compression=True)
+            with self.assertRaises(ValueError):
+                image_chunked_operation("sum",filenames+[other],output)
+            # the output is one of the inputs: error, the input is not overwritten
+            for out in (filenames[0], os.path.join(tmpdir,".","img1.mhd")):
+                with self.assertRaises(ValueError):
+                    image_chunked_operation("sum",filenames[:2],out)
+            self.assertTrue(np.array_equal(itk.array_view_from_image(itk.imread(filenames[0])),arrays[0]))
+            self.assertTrue(np.array_equal(itk.array_view_from_image(itk.imread(filenames[1])),arrays[1]))
 
 # TODO: test division
@@ -23,8 +23,10 @@ method as explained for example in [Chetty2006]
 
 import itk
 import gatetools as gt
-from functools import reduce
-import operator
+from .image_arithm import read_images, _check_image_files, _check_geometry, _image_file_info, _image_size, _image_info, _geometry_image, _mean_type
+import os
+import re
+import glob
 import numpy as np
 import numpy.testing as npt
 import logging
@@ -58,36 +60,71 @@ def relative_uncertainty(x, sq_x, N, sigma_flag, threshold=0):
     return u
 
 
+def relative_uncertainty_slabs(x, sq_x, N, sigma_flag=False, threshold=0, dtype=np.float32, memory_budget=2**26):
+    """
+    Same as `relative_uncertainty`, with less memory: the computation is done in place, in double precision,
+    in slabs of slices (along the first axis) that fit in `memory_budget` bytes, and the slabs are written to
+    an output of type `dtype`. Only the output is allocated with the size of the image (half of the size of the
+    double precision sums with float32), instead of about six double precision temporaries. The values are those
+    of `relative_uncertainty` for double precision inputs, rounded to `dtype`.
+    """
+    uncertainty = np.empty(np.shape(x), dtype=dtype)
+    if uncertainty.size == 0:
+        return uncertainty
+    threshold = np.broadcast_to(threshold, uncertainty.shape)
+    # three double precision buffers per slice
+    nslices = max(1, int(memory_budget//(uncertainty[0].size*3*8)))
+    u, m, tmp = [np.empty((nslices,)+uncertainty.shape[1:]) for i in range(3)]
+    for z0 in range(0, uncertainty.shape[0], nslices):
+        slab = slice(z0, z0+nslices)
+        n = len(uncertainty[slab])
+        us, ms, ts = u[:n], m[:n], tmp[:n]
+        # (sq_x/N - (x/N)**2) / (N-1)
+        np.divide(sq_x[slab], N, out=us)
+        np.divide(x[slab], N, out=ms)
+        np.square(ms, out=ts)
+        us -= ts
+        us /= N-1
+        us[us<1e-40] = 0.0
+        np.sqrt(us, out=us)
+        if not sigma_flag:
+            ts.fill(1.0)
+            np.divide(us, ms, out=ts, where=x[slab] > threshold[slab])
+            us = ts
+        uncertainty[slab] = us
+    return uncertainty
+
+
 def relative_uncertainty_by_slice(x, sigma_flag, threshold=0, sq_x=[], N=0):
-    i=0
-    means = []
-    nb = []
-    uncertainty = np.copy(x)
-    uncertainty.fill(0.0)
-    use_square = False
+    # the slices are along the first axis: the threshold, the number of voxels above it and the mean
+    # uncertainty of these voxels are computed for all the slices at once
+    axes = tuple(range(1, x.ndim))
+    t = np.max(x, axis=axes, keepdims=True)*threshold
     if len(sq_x)>0:
-        use_square = True
+        uncertainty = relative_uncertainty(x, sq_x, N, sigma_flag, t)
     else:
-        sq_x = x
-
-    for s, sq in zip(x, sq_x):
-        t = np.max(s)*threshold
-        if use_square:
-            u = relative_uncertainty(s, sq, N, sigma_flag, t)
-        else:
-            u = relative_uncertainty_Poisson(s, sigma_flag, t)
-        n = len(np.where(s > t)[0])
-        if n==0:
-            mean = 1.0
-        else:
-            mean = u[np.where(s > t)].sum()
-            mean = mean/n
-        means.append(mean)
-        nb.append(n)
-        uncertainty[i] = u
-        i = i + 1
-
-    return uncertainty, means, nb
+        uncertainty = relative_uncertainty_Poisson(x, sigma_flag, t)
+    region = x > t
+    nb = np.count_nonzero(region, axis=axes)
+    means = np.sum(uncertainty, axis=axes, where=region)
+    np.divide(means, nb, out=means, where=nb > 0)
+    means[nb == 0] = 1.0
+
+    return uncertainty, means.tolist(), nb.tolist()
+
+
+def efficiency(uncertainty, time):
+    """
+    The efficiency 1/(t*u^2) of a simulation that took the time `time` to reach the (relative) uncertainty
+    `uncertainty` (array). It does not depend on the simulation time, and is higher for a faster convergence.
+    Voxels with a null uncertainty get 0; as the uncertainty is 1 below the threshold, their efficiency is 1/t.
+    """
+    if time <= 0:
+        raise RuntimeError('ERROR: the time must be positive to compute the efficiency')
+    e = np.square(uncertainty, dtype=np.float64)
+    e *= time
+    np.divide(1.0, e, out=e, where=e > 0)
+    return e
 
 
 def check_N(N):
@@ -96,50 +133,319 @@ def check_N(N):
         raise RuntimeError('ERROR: N  must be positive')
 
 
-def image_uncertainty(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0):
+def squared_filename(filename):
+    """
+    The name of the squared image that Gate writes next to the image `filename`, e.g. dose-Squared.mhd for dose.mhd.
+    """
+    base, ext = os.path.splitext(filename)
+    return base+'-Squared'+ext
+
+
+def efficiency_filename(filename):
+    """
+    The name of the efficiency image written next to the uncertainty image `filename`, e.g. u-Efficiency.mhd for u.mhd.
+    """
+    base, ext = os.path.splitext(filename)
+    return base+'-Efficiency'+ext
+
+
+class UncertaintyAccumulator:
+    """
+    Running sums of Gate dose (or edep) images X and of their squared images X-Squared, for the history by history
+    uncertainty [Chetty2006] of many merged Gate runs. The sums are kept in double precision, and the pairs of
+    images are added one at a time, so only the two sums and one pair of input images are in memory.
+    The partial sums can be saved to a checkpoint file and loaded again, so that a merge that was interrupted
+    (e.g. on a cluster node) can be resumed: the files that are already in the sums are then skipped.
+    Example:
+        acc = UncertaintyAccumulator()
+        acc.add_files(filenames, checkpoint="merge.npz")
+        uncertainty = acc.result(N)
+    """
+    def __init__(self):
+        self.n = 0
+        self.sum = None
+        self.sq_sum = None
+        self.info = None
+        self.dtype = None
+        # the (real) paths of the added files
+        self.files = []
+
+    def add(self, dose, squared):
+        """
+        Add a dose image and its squared image (image objects or filenames) to the sums.
+        """
+        files = [os.path.realpath(img) for img in (dose, squared) if isinstance(img, str)]
+        self._add(*[itk.imread(img) if isinstance(img, str) else img for img in (dose, squared)])
+        self.files += files
+
+    def _add(self, dose, squared):
+        for img in (dose, squared):
+            if self.info is None:
+                self.info = _image_info(img)
+            _check_geometry(_image_size(self.info), self.info.GetSpacing(), self.info.GetOrigin(),
+                            _image_size(img), img.GetSpacing(), img.GetOrigin())
+        a, sq = itk.array_view_from_image(dose), itk.array_view_from_image(squared)
+        if self.sum is None:
+            self.sum, self.sq_sum = np.array(a, dtype=np.float64), np.array(sq, dtype=np.float64)
+            self.dtype = np.result_type(a.dtype, sq.dtype)
+        else:
+            self.sum += a
+            self.sq_sum += sq
+            self.dtype = np.result_type(self.dtype, a.dtype, sq.dtype)
+        self.n += 1
+
+    def add_files(self, filenames, squared_filenames=None, jobs=1, checkpoint=None, checkpoint_every=10):
+        """
+        Add the image files `filenames` and their squared images (by default the Gate names, see `squared_filename`).
+        Files that are already in the sums (e.g. after `load`) are skipped. The geometries of all files are checked
+        from their headers before the images are read, and the files are read with `jobs` threads (see `gt.read_images`).
+        With a `checkpoint` filename, the sums are saved (see `save`) after every `checkpoint_every` pairs and at the end.
+        Returns the number of added pairs.
+        """
+        if squared_filenames is None:
+            squared_filenames = [squared_filename(f) for f in filenames]
+        if len(squared_filenames) != len(filenames):
+            raise RuntimeError('ERROR: got {} images and {} squared images'.format(len(filenames), len(squared_filenames)))
+        done = set(self.files)
+        pairs = [(f, sf) for f, sf in zip(filenames, squared_filenames) if os.path.realpath(f) not in done]
+        if len(pairs) < len(filenames):
+            logger.info('Skip {} file(s) that are already in the sums'.format(len(filenames)-len(pairs)))
+        _check_image_files([f for pair in pairs for f in pair])
+        images = read_images([f for pair in pairs for f in pair], jobs)
+        for i, (f, sf) in enumerate(pairs):
+            self._add(next(images), next(images))
+            self.files += [os.path.realpath(f), os.path.realpath(sf)]
+            logger.debug('Added {} and {}'.format(f, sf))
+            if checkpoint is not None and ((i+1) % checkpoint_every == 0 or i+1 == len(pairs)):
+                self.save(checkpoint)
+        return len(pairs)
+
+    def result(self, N, sigma_flag=False, threshold=0):
+        """
+        The relative uncertainty image (or the standard deviation with `sigma_flag`) for `N` events in total,
+        see `relative_uncertainty`. Voxels with a sum not larger than `threshold` times the maximum get 1.
+        The output has the pixel type of the input images (float for integer images).
+        """
+        check_N(N)
+        if self.n == 0:
+            raise RuntimeError("got no images")
+        t = np.max(self.sum)*threshold
+        uncertainty = relative_uncertainty_slabs(self.sum, self.sq_sum, N, sigma_flag, t, dtype=_mean_type(self.dtype))
+        img_uncertainty = itk.image_from_array(uncertainty)
+        img_uncertainty.CopyInformation(self.info)
+        return img_uncertainty
+
+    def save(self, filename):
+        """
+        Save the sums to the checkpoint file `filename` (numpy .npz format). The file is replaced atomically, so an
+        interruption while saving leaves the previous checkpoint intact.
+        """
+        tmp = filename+'.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, n=self.n, sum=self.sum, sq_sum=self.sq_sum, dtype=str(self.dtype), files=np.array(self.files, dtype=str),
+                     size=np.array(_image_size(self.info)), spacing=np.array(self.info.GetSpacing()),
+                     origin=np.array(self.info.GetOrigin()), direction=itk.array_from_matrix(self.info.GetDirection()))
+        os.replace(tmp, filename)
+        logger.debug('Saved the sums of {} image pair(s) to {}'.format(self.n, filename))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the sums from a checkpoint file written by `save`.
+        """
+        acc = cls()
+        with np.load(filename, allow_pickle=False) as data:
+            acc.n = int(data['n'])
+            acc.sum, acc.sq_sum = data['sum'], data['sq_sum']
+            acc.dtype = np.dtype(str(data['dtype']))
+            acc.files = [str(f) for f in data['files']]
+            acc.info = _geometry_image(data['size'], data['spacing'], data['origin'], data['direction'])
+        logger.debug('Loaded the sums of {} image pair(s) from {}'.format(acc.n, filename))
+        return acc
+
+
+def read_stat_file(filename):
+    """
+    Read the values in a Gate stat file (SimulationStatisticActor), lines like '# ElapsedTime = 12.3'.
+    Returns a dictionary, with numbers for the numerical values (e.g. NumberOfEvents, ElapsedTime) and strings otherwise.
+    """
+    values = dict()
+    with open(filename, 'r') as fp:
+        for line in fp:
+            m = re.match(r'\s*#?\s*(\w+)\s*=\s*(.*?)\s*$', line)
+            if not m:
+                continue
+            try:
+                values[m.group(1)] = float(m.group(2))
+            except ValueError:
+                values[m.group(1)] = m.group(2)
+    return values
+
+
+class UncertaintyMonitor:
+    """
+    Convergence monitor for a running Gate simulation that is split in many jobs. Each `poll` looks in `directory`
+    for the images of the jobs (`pattern`, with the squared images next to them, see `squared_filename`) and adds
+    only the jobs that have finished since the previous poll to the sums (see `UncertaintyAccumulator`); no image
+    is read twice. A job is considered finished when its image files have not changed since the previous poll.
+    `status` gives the mean relative uncertainty in a region (the voxels above `threshold` times the maximum of the
+    sum, or the nonzero voxels of the `mask` image), and the simulation time that is still needed to reach a target
+    uncertainty, extrapolated from the ElapsedTime in the stat files of the finished jobs (the uncertainty decreases
+    as 1/sqrt(t)). The number of events of a job is read from its stat file (NumberOfEvents), or is `nevents`.
+    A `TypeError` is raised if the geometry of the mask differs from that of the images of the jobs.
+    Example:
+        monitor = UncertaintyMonitor("run.XYZ", threshold=0.2)
+        while monitor.status(target=0.01)["remaining"] != 0:
+            time.sleep(60)
+            monitor.poll()
+    """
+    def __init__(self, directory, pattern="output_*/dose-Edep.mhd", stat_pattern="stat*.txt", nevents=0, threshold=0., mask=None,
+                 jobs=1, checkpoint=None):
+        self.directory, self.pattern, self.stat_pattern = directory, pattern, stat_pattern
+        self.nevents, self.threshold, self.jobs, self.checkpoint = nevents, threshold, jobs, checkpoint
+        self.mask = None
+        if mask is not None:
+            mask = itk.imread(mask) if isinstance(mask, str) else mask
+            self._mask_geometry = (_image_size(mask), mask.GetSpacing(), mask.GetOrigin())
+            self.mask = itk.array_view_from_image(mask) != 0
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            self.acc = UncertaintyAccumulator.load(checkpoint)
+        else:
+            self.acc = UncertaintyAccumulator()
+        # the state (modification times and sizes of the files) of the unfinished jobs at the previous poll
+        self._states = dict()
+        # the number of events and the elapsed time of the jobs in the sums
+        self.events, self.elapsed = 0., 0.
+        self._elapsed_known = True
+        for f in self.acc.files[0::2]:
+            self._add_stats(f)
+        if self.acc.info is not None:
+            self._check_mask(_image_size(self.acc.info), self.acc.info.GetSpacing(), self.acc.info.GetOrigin())
+
+    def _check_mask(self, size, spacing, origin):
+        if self.mask is not None:
+            _check_geometry(size, spacing, origin, *self._mask_geometry, name="mask")
+
+    def _state(self, filename):
+        # the image files of a job, including the data files next to .mhd headers
+        files = [filename, squared_filename(filename)]
+        files += [os.path.splitext(f)[0]+ext for f in files for ext in ('.raw', '.zraw') if os.path.isfile(os.path.splitext(f)[0]+ext)]
+        if not all(os.path.isfile(f) for f in files):
+            return None
+        return tuple((os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+    def _add_stats(self, filename):
+        stat_files = sorted(glob.glob(os.path.join(os.path.dirname(filename), self.stat_pattern)))
+        stats = read_stat_file(stat_files[0]) if stat_files else dict()
+        self.events += stats.get('NumberOfEvents', self.nevents)
+        if 'ElapsedTime' in stats:
+            self.elapsed += stats['ElapsedTime']
+        else:
+            self._elapsed_known = False
+
+    def poll(self):
+        """
+        Add the jobs that finished since the previous poll to the sums. Returns the number of added jobs.
+        """
+        done = set(self.acc.files)
+        finished = list()
+        for f in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            if os.path.realpath(f) in done:
+                continue
+            state = self._state(f)
+            if state is not None and self._states.get(f) == state:
+                finished.append(f)
+                del self._states[f]
+            else:
+                self._states[f] = state
+        if finished:
+            # check the mask against the header of a dose image before the jobs are added
+            info = _image_file_info(finished[0])
+            if info is not None:
+                self._check_mask(info.size, info.spacing, info.origin)
+            self.acc.add_files(finished, jobs=self.jobs, checkpoint=self.checkpoint)
+            for f in finished:
+                self._add_stats(f)
+            logger.debug('Added {} finished job(s), {} in total'.format(len(finished), self.acc.n))
+        return len(finished)
+
+    def uncertainty(self):
+        """
+        The relative uncertainty image (numpy array) of the jobs in the sums.
+        """
+        check_N(self.events)
+        t = np.max(self.acc.sum)*self.threshold
+        return relative_uncertainty_slabs(self.acc.sum, self.acc.sq_sum, self.events, False, t)
+
+    def status(self, target=None):
+        """
+        A dictionary with the number of jobs in the sums ("jobs"), their number of events ("events") and elapsed
+        time ("elapsed", None if a stat file is missing), the mean relative uncertainty in the region ("uncertainty",
+        None without finished jobs) and the number of voxels in the region ("voxels").
+        With a `target` relative uncertainty, "remaining" is the extrapolated simulation time (summed over the jobs)
+        that is still needed to reach it: 0 if it is reached, None if it cannot be estimated.
+        """
+        status = dict(jobs=self.acc.n, events=self.events, elapsed=self.elapsed if self._elapsed_known else None,
+                      uncertainty=None, voxels=0, remaining=None)
+        if self.acc.n == 0 or self.events <= 1:
+            return status
+        u = self.uncertainty()
+        region = self.acc.sum > np.max(self.acc.sum)*self.threshold if self.mask is None else self.mask
+        status["voxels"] = int(np.count_nonzero(region))
+        if status["voxels"] > 0:
+            status["uncertainty"] = float(np.mean(u[region]))
+        if target is not None and status["uncertainty"] is not None:
+            if status["uncertainty"] <= target:
+                status["remaining"] = 0.
+            elif status["elapsed"] is not None:
+                status["remaining"] = status["elapsed"]*((status["uncertainty"]/target)**2 - 1.)
+        return status
+
+
+def image_uncertainty(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0, jobs=1, checkpoint=None):
     check_N(N)
 
-    # Get the sums
-    img_sum = gt.image_sum(img_list)
-    img_sq_sum = gt.image_sum(img_squared_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-    np_sq_sum = itk.array_view_from_image(img_sq_sum)
+    # Get the sums, one pair of images at a time [Chetty 2006]
+    acc = _add_images(img_list, img_squared_list, jobs, checkpoint)
+    return acc.result(N, sigma_flag, threshold)
 
-    # Compute relative uncertainty [Chetty 2006]
-    t = np.max(np_sum)*threshold
-    uncertainty = relative_uncertainty(np_sum, np_sq_sum, N, t)
 
-    # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
-    return img_uncertainty
+def _add_images(img_list, img_squared_list, jobs, checkpoint=None):
+    # files are streamed (see UncertaintyAccumulator.add_files), with the checkpoint file if any, image objects are
+    # added as they are
+    if len(img_list) != len(img_squared_list):
+        raise RuntimeError('ERROR: got {} images and {} squared images'.format(len(img_list), len(img_squared_list)))
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        logger.info('Resume from checkpoint {}'.format(checkpoint))
+        acc = UncertaintyAccumulator.load(checkpoint)
+    else:
+        acc = UncertaintyAccumulator()
+    if all(isinstance(img, str) for img in list(img_list)+list(img_squared_list)):
+        acc.add_files(img_list, img_squared_list, jobs=jobs, checkpoint=checkpoint)
+    else:
+        for img, sq in zip(img_list, img_squared_list):
+            acc.add(img, sq)
+    return acc
 
 
-def image_uncertainty_by_slice(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0):
+def image_uncertainty_by_slice(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0, jobs=1, checkpoint=None):
     check_N(N)
 
     # Get the sums
-    img_sum = gt.image_sum(img_list)
-    img_sq_sum = gt.image_sum(img_squared_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-    np_sq_sum = itk.array_view_from_image(img_sq_sum)
+    acc = _add_images(img_list, img_squared_list, jobs, checkpoint)
 
     # compute uncertainty
-    uncertainty, means, nb = relative_uncertainty_by_slice(np_sum, sigma_flag, threshold, np_sq_sum, N)
+    uncertainty, means, nb = relative_uncertainty_by_slice(acc.sum, sigma_flag, threshold, acc.sq_sum, N)
 
     # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
+    img_uncertainty = itk.image_from_array(uncertainty.astype(_mean_type(acc.dtype), copy=False))
+    img_uncertainty.CopyInformation(acc.info)
     return img_uncertainty, means, nb
 
 
-def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0):
+def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0, jobs=1):
     # Get the sums
-    img_sum = gt.image_sum(img_list)
+    img_sum = gt.image_sum(img_list, jobs=jobs)
 
     # View as np
     np_sum = itk.array_view_from_image(img_sum)
@@ -147,12 +453,9 @@ def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0):
     # Convert to float
     np_sum = np_sum.astype(np.float64)
 
-    # Get stddev (variance is the mean)
-    sigma_flag = np.sqrt(np_sum)
-
-    # compute uncertainty
+    # compute uncertainty (the variance is the mean)
     t = np.max(np_sum)*threshold
-    uncertainty = relative_uncertainty_Poisson(np_sum, t)
+    uncertainty = relative_uncertainty_Poisson(np_sum, sigma_flag, t)
 
     # np is double, convert to float32
     uncertainty = uncertainty.astype(np.float32)
@@ -163,9 +466,9 @@ def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0):
     return img_uncertainty
 
 
-def image_uncertainty_Poisson_by_slice(img_list=[], sigma_flag=False, threshold=0):
+def image_uncertainty_Poisson_by_slice(img_list=[], sigma_flag=False, threshold=0, jobs=1):
     # Get the sums
-    img_sum = gt.image_sum(img_list)
+    img_sum = gt.image_sum(img_list, jobs=jobs)
 
     # View as np
     np_sum = itk.array_view_from_image(img_sum)
@@ -270,3 +573,161 @@ class Test_Uncertainty(LoggedTestCase):
             new_hash = hashlib.sha256(bytesNew).hexdigest()
             self.assertTrue("cb58fb2f5490546bb83b9e0e51ce1d87b13eab2f0f4ebddc4e9c767c8b98e57b" == new_hash)
         shutil.rmtree(tmpdirpath)
+    def test_by_slice(self):
+        np.random.seed(3)
+        x = np.random.poisson(20., (5, 6, 7)).astype(np.float64)
+        x[2] = 0
+        sq_x = x**2 + np.random.rand(5, 6, 7)
+        for sq, N in [([], 0), (sq_x, 1000)]:
+            u, means, nb = relative_uncertainty_by_slice(x, False, 0.5, sq, N)
+            for i, s in enumerate(x):
+                t = np.max(s)*0.5
+                us = relative_uncertainty(s, sq[i], N, False, t) if N > 0 else relative_uncertainty_Poisson(s, False, t)
+                npt.assert_allclose(u[i], us)
+                self.assertEqual(nb[i], np.count_nonzero(s > t))
+                npt.assert_allclose(means[i], us[s > t].mean() if nb[i] > 0 else 1.0)
+        self.assertEqual(nb[2], 0)
+        e = efficiency(np.array([0.1, 0., 1.]), 20.)
+        npt.assert_allclose(e, [5., 0., 0.05])
+        self.assertEqual(efficiency_filename("/a/u.mhd"), "/a/u-Efficiency.mhd")
+    def test_slabs(self):
+        np.random.seed(5)
+        doses = np.random.exponential(1., (50, 9, 10, 11))
+        doses[:, 4] = 0
+        x = doses.sum(axis=0)
+        sq_x = (doses**2).sum(axis=0)
+        for sigma_flag in (False, True):
+            expected = relative_uncertainty(x, sq_x, 50, sigma_flag, 0.2*np.max(x))
+            # double precision output, in slabs of one slice: same values
+            u = relative_uncertainty_slabs(x, sq_x, 50, sigma_flag, 0.2*np.max(x), dtype=np.float64, memory_budget=1)
+            npt.assert_array_equal(u, expected)
+            # float32 output: the float64 values rounded to float32 (relative error < 6e-8)
+            u = relative_uncertainty_slabs(x, sq_x, 50, sigma_flag, 0.2*np.max(x))
+            self.assertEqual(u.dtype, np.float32)
+            npt.assert_array_equal(u, expected.astype(np.float32))
+            npt.assert_allclose(u, expected, rtol=2**-24)
+        # thresholds by slice are broadcast
+        t = np.max(x, axis=(1, 2), keepdims=True)*0.5
+        npt.assert_allclose(relative_uncertainty_slabs(x, sq_x, 50, False, t, memory_budget=1000),
+                            relative_uncertainty(x, sq_x, 50, False, t), rtol=2**-24)
+        # sigma_flag and threshold are not mixed up
+        images = [itk.image_from_array(np.float32(d)) for d in doses[:3]]
+        squared = [itk.image_from_array(np.float32(d**2)) for d in doses[:3]]
+        u = itk.array_view_from_image(image_uncertainty(images, squared, 3, sigma_flag=True, threshold=0.5))
+        self.assertTrue(np.all(u[4] == 0))
+        u = itk.array_view_from_image(image_uncertainty(images, squared, 3, threshold=0.5))
+        self.assertTrue(np.all(u[4] == 1))
+        u = itk.array_view_from_image(image_uncertainty_Poisson(images, sigma_flag=True, threshold=0.5))
+        npt.assert_allclose(u, np.sqrt(np.float32(doses[:3]).sum(axis=0)), rtol=1e-6)
+        u = itk.array_view_from_image(image_uncertainty_Poisson(images, threshold=0.5))
+        self.assertTrue(np.all(u[4] == 1))
+    def test_accumulator(self):
+        np.random.seed(42)
+        shape = (6, 7, 8)
+        doses = [np.random.uniform(0., 2., shape).astype(np.float32) for i in range(6)]
+        tmpdirpath = tempfile.mkdtemp()
+        filenames = []
+        for i, d in enumerate(doses):
+            filenames.append(os.path.join(tmpdirpath, "dose{}.mhd".format(i)))
+            for f, a in ((filenames[-1], d), (squared_filename(filenames[-1]), 1.1*d*d)):
+                img = itk.image_from_array(a)
+                img.SetSpacing((2., 3., 4.))
+                itk.imwrite(img, f)
+        N = 1000
+        acc = UncertaintyAccumulator()
+        self.assertEqual(acc.add_files(filenames, jobs=2), 6)
+        x = np.sum(np.array(doses, dtype=np.float64), axis=0)
+        sq_x = np.sum(np.array(doses, dtype=np.float64)**2*1.1, axis=0)
+        npt.assert_allclose(acc.sum, x)
+        npt.assert_allclose(acc.sq_sum, sq_x)
+        uncertainty = acc.result(N, threshold=0.1)
+        self.assertTrue(type(uncertainty) == itk.Image[itk.F, 3])
+        self.assertTrue(np.allclose(uncertainty.GetSpacing(), (2., 3., 4.)))
+        expected = relative_uncertainty(x, sq_x, N, False, 0.1*np.max(x))
+        npt.assert_allclose(itk.array_view_from_image(uncertainty), expected, rtol=1e-6)
+        npt.assert_allclose(itk.array_view_from_image(image_uncertainty(filenames, [squared_filename(f) for f in filenames], N, threshold=0.1)),
+                            expected, rtol=1e-6)
+        # interrupted merge: resume from the checkpoint, the files that are in the sums are skipped
+        checkpoint = os.path.join(tmpdirpath, "sums.npz")
+        partial = UncertaintyAccumulator()
+        partial.add_files(filenames[:4], checkpoint=checkpoint, checkpoint_every=3)
+        resumed = UncertaintyAccumulator.load(checkpoint)
+        self.assertEqual(resumed.n, 4)
+        self.assertEqual(resumed.add_files(filenames), 2)
+        npt.assert_allclose(itk.array_view_from_image(resumed.result(N, threshold=0.1)), expected, rtol=1e-6)
+        self.assertTrue(np.allclose(resumed.result(N).GetSpacing(), (2., 3., 4.)))
+        # the same with the library functions and a checkpoint file
+        os.remove(checkpoint)
+        partial.add_files(filenames[:4], checkpoint=checkpoint, checkpoint_every=3)
+        squared = [squared_filename(f) for f in filenames]
+        npt.assert_allclose(itk.array_view_from_image(image_uncertainty(filenames, squared, N, threshold=0.1, checkpoint=checkpoint)),
+                            expected, rtol=1e-6)
+        self.assertEqual(UncertaintyAccumulator.load(checkpoint).n, 6)
+        u, means, nb = image_uncertainty_by_slice(filenames, squared, N, checkpoint=checkpoint)
+        self.assertTrue(type(u) == itk.Image[itk.F, 3])
+        npt.assert_allclose(itk.array_view_from_image(u), relative_uncertainty_by_slice(x, False, 0, sq_x, N)[0], rtol=1e-6)
+        # image objects
+        other = UncertaintyAccumulator()
+        for f in filenames:
+            other.add(itk.imread(f), squared_filename(f))
+        npt.assert_allclose(other.sum, x)
+        with self.assertRaises(TypeError):
+            other.add(itk.image_from_array(doses[0]), itk.image_from_array(doses[0]))
+        shutil.rmtree(tmpdirpath)
+    def test_monitor(self):
+        np.random.seed(24)
+        shape = (5, 6, 7)
+        tmpdirpath = tempfile.mkdtemp()
+        def write_job(i, elapsed):
+            d = np.random.uniform(1., 2., shape).astype(np.float32)
+            os.makedirs(os.path.join(tmpdirpath, "output_{}".format(i)))
+            f = os.path.join(tmpdirpath, "output_{}".format(i), "dose-Edep.mhd")
+            itk.imwrite(itk.image_from_array(d), f)
+            itk.imwrite(itk.image_from_array(d*d*1.5), squared_filename(f))
+            with open(os.path.join(tmpdirpath, "output_{}".format(i), "stat.txt"), "w") as fp:
+                fp.write("# NumberOfRun    = 1\n# NumberOfEvents = 100\n# ElapsedTime    = {}\n# StartDate      = Sun Oct 18\n".format(elapsed))
+            return f
+        files = [write_job(i, 10.+i) for i in range(3)]
+        self.assertEqual(read_stat_file(os.path.join(tmpdirpath, "output_0", "stat.txt"))["NumberOfEvents"], 100)
+        monitor = UncertaintyMonitor(tmpdirpath, threshold=0.1)
+        # the jobs are added when their files have not changed since the previous poll
+        self.assertEqual(monitor.poll(), 0)
+        self.assertEqual(monitor.status()["uncertainty"], None)
+        self.assertEqual(monitor.poll(), 3)
+        self.assertEqual(monitor.poll(), 0)
+        files.append(write_job(3, 13.))
+        self.assertEqual(monitor.poll(), 0)
+        self.assertEqual(monitor.poll(), 1)
+        status = monitor.status(target=0.01)
+        self.assertEqual(status["jobs"], 4)
+        self.assertEqual(status["events"], 400)
+        self.assertAlmostEqual(status["elapsed"], 46.)
+        acc = UncertaintyAccumulator()
+        acc.add_files(files)
+        u = relative_uncertainty(acc.sum, acc.sq_sum, 400, False, 0.1*np.max(acc.sum))
+        self.assertAlmostEqual(status["uncertainty"], np.mean(u[acc.sum > 0.1*np.max(acc.sum)]))
+        # 1/sqrt(t) extrapolation
+        self.assertAlmostEqual(status["remaining"], 46.*((status["uncertainty"]/0.01)**2-1.))
+        self.assertEqual(monitor.status(target=1.)["remaining"], 0.)
+        # mask
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[1:3, 2:4, 3:6] = 1
+        masked = UncertaintyMonitor(tmpdirpath, mask=itk.image_from_array(mask))
+        masked.poll()
+        masked.poll()
+        self.assertEqual(masked.status()["voxels"], 12)
+        self.assertAlmostEqual(masked.status()["uncertainty"], np.mean(u[mask != 0]))
+        # the geometry of the mask is checked, before the jobs are added
+        for other in (np.zeros((5, 6, 8), dtype=np.uint8), mask):
+            img = itk.image_from_array(other)
+            img.SetSpacing((1., 2., 1.))
+            masked = UncertaintyMonitor(tmpdirpath, mask=img)
+            masked.poll()
+            with self.assertRaises(TypeError):
+                masked.poll()
+            self.assertEqual(masked.acc.n, 0)
+        checkpoint = os.path.join(tmpdirpath, "sums.npz")
+        monitor.acc.save(checkpoint)
+        with self.assertRaises(TypeError):
+            UncertaintyMonitor(tmpdirpath, mask=img, checkpoint=checkpoint)
+        shutil.rmtree(tmpdirpath)
@@ -41,6 +41,7 @@ setuptools.setup(
         'bin/gt_image_convert',
         'bin/gt_image_statistics',
         'bin/gt_gamma_index',
+        'bin/gt_gamma_benchmark',
         'bin/gt_affine_transform',
         'bin/gt_write_dicom',
         'bin/gt_dicom_info',